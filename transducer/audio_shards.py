@@ -0,0 +1,239 @@
+"""
+Audio of the prepared manifests, decoded once into int16 shards.
+
+Reading every utterance from its own FLAC file costs a random file open and
+a decode per utterance and per epoch in the dataloader workers. Here, every
+split is decoded once into a few large shards of raw int16 samples, written
+in order of duration, with an index of the shard, offset and length of every
+utterance. The shards are memory-mapped: reading an utterance is a slice of
+the map, converted to a float tensor. Reading the utterances in storage
+order, a bucket of neighbours at a time (see BucketedSequentialSampler),
+turns the random reads of the files into sequential reads of the shards.
+"""
+
+import csv
+import functools
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+import speechbrain as sb
+from speechbrain.utils.logger import get_logger
+from speechbrain.utils.parallel import parallel_map
+
+logger = get_logger(__name__)
+
+# int16 full scale of the float samples of read_audio
+_SCALE = 32768.0
+
+
+def audio_shards_exist(prefix):
+    """Whether the index of a shard store exists (written last)."""
+    return os.path.isfile(prefix + "_index.npy")
+
+
+def _decode(row, replacements):
+    wav = row["wav"]
+    for key, value in replacements.items():
+        wav = wav.replace("$" + key, str(value))
+    sig = sb.dataio.dataio.read_audio(wav).numpy()
+    sig = np.clip(np.round(sig * _SCALE), -_SCALE, _SCALE - 1)
+    return sig.astype(np.int16)
+
+
+def prepare_audio_shards(
+    csv_file, prefix, shard_bytes=1 << 30, replacements=None
+):
+    """
+    Decodes the audio (column 'wav') of every utterance of a manifest into
+    int16 shards prefix + '_00000.raw', ..., and writes their index
+    prefix + '_index.npy'. Nothing is done if the index exists.
+
+    Arguments
+    ---------
+    csv_file : str
+        Manifest written by prepare_librispeech.
+    prefix : str
+        Path prefix of the files of the store.
+    shard_bytes : int
+        Size from which a new shard is started.
+    replacements : dict
+        Replacements of '$key' by value in the paths, e.g. data_root.
+    """
+    if audio_shards_exist(prefix):
+        logger.info("Audio shards %s exist, skipping", prefix)
+        return
+
+    with open(csv_file, newline="", encoding="utf-8") as fin:
+        rows = sorted(csv.DictReader(fin), key=lambda r: float(r["duration"]))
+
+    ids = [row["ID"].encode("utf-8") for row in rows]
+    dtype = [
+        ("ID", "S{}".format(max(map(len, ids), default=1))),
+        ("shard", "i4"),
+        ("offset", "i8"),
+        ("length", "i8"),
+    ]
+    index = np.zeros(len(rows), dtype=dtype)
+    index["ID"] = ids
+
+    folder = os.path.dirname(os.path.abspath(prefix))
+    os.makedirs(folder, exist_ok=True)
+    decode = functools.partial(_decode, replacements=replacements or {})
+    shard, offset, fout = 0, 0, None
+    for i, sig in enumerate(parallel_map(decode, rows, chunk_size=64)):
+        if fout is None or (offset and 2 * (offset + len(sig)) > shard_bytes):
+            if fout is not None:
+                fout.close()
+                shard += 1
+            fout = open("{}_{:05d}.raw".format(prefix, shard), "wb")
+            offset = 0
+        fout.write(sig.tobytes())
+        index[i] = (ids[i], shard, offset, len(sig))
+        offset += len(sig)
+    if fout is not None:
+        fout.close()
+    # the index is written last, it marks the store as complete
+    np.save(prefix + "_index.npy", index)
+    logger.info(
+        "Audio shards %s: %d utterances in %d shards",
+        prefix,
+        len(rows),
+        shard + 1 if rows else 0,
+    )
+
+
+class AudioShards:
+    """
+    Memory-mapped audio written by prepare_audio_shards.
+
+    Arguments
+    ---------
+    prefix : str
+        Path prefix of the files of the store.
+
+    Example
+    -------
+    >>> import soundfile
+    >>> tmpdir = getfixture("tmpdir")
+    >>> for name, n in [("a", 1600), ("b", 800)]:
+    ...     soundfile.write(str(tmpdir / name) + ".wav",
+    ...         np.linspace(-0.5, 0.5, n), 16000, subtype="PCM_16")
+    >>> csv_file = tmpdir / "dev.csv"
+    >>> _ = csv_file.write("ID,duration,wav,spk_id,wrd\\n"
+    ...     "utt1,0.1,$data_root/a.wav,1,A\\nutt2,0.05,$data_root/b.wav,1,B\\n")
+    >>> prefix = str(tmpdir / "audio" / "dev")
+    >>> prepare_audio_shards(
+    ...     str(csv_file), prefix, replacements={"data_root": str(tmpdir)})
+    >>> shards = AudioShards(prefix)
+    >>> sig = shards["utt1"]
+    >>> sig.shape, round(sig[-1].item(), 3), shards.positions(["utt1", "utt2"])
+    (torch.Size([1600]), 0.5, [1, 0])
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.index = np.load(prefix + "_index.npy")
+        # rows in the order of the IDs, to look them up by bisection
+        self._by_id = np.argsort(self.index["ID"], kind="stable")
+        self._ids = self.index["ID"][self._by_id]
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def _row(self, utt_id):
+        key = utt_id.encode("utf-8")
+        i = int(np.searchsorted(self._ids, key))
+        if i == len(self._ids) or self._ids[i] != key:
+            raise KeyError(utt_id)
+        return int(self._by_id[i])
+
+    def _map(self, shard):
+        # opened lazily, in every dataloader worker
+        if shard not in self._maps:
+            path = "{}_{:05d}.raw".format(self.prefix, shard)
+            self._maps[shard] = np.memmap(path, dtype=np.int16, mode="r")
+        return self._maps[shard]
+
+    def __getitem__(self, utt_id):
+        """Signal of an utterance, as read_audio returns it."""
+        _, shard, offset, length = self.index[self._row(utt_id)].tolist()
+        samples = self._map(shard)[offset : offset + length]
+        sig = torch.from_numpy(samples.astype(np.float32))
+        return sig.div_(_SCALE)
+
+    def positions(self, ids):
+        """Storage position of every utterance of ids."""
+        return [self._row(utt_id) for utt_id in ids]
+
+
+class BucketedSequentialSampler(Sampler):
+    """
+    Sampler reading the utterances in storage order, a bucket of neighbours
+    at a time. The buckets are visited in a new random order at every epoch,
+    and the utterances of a bucket are read sequentially. As the shards are
+    written in order of duration, a bucket also holds utterances of similar
+    durations.
+
+    Arguments
+    ---------
+    dataset : speechbrain.dataio.dataset.DynamicItemDataset
+        Dataset whose data IDs are in the store.
+    audio_shards : AudioShards
+        Store of the audio of the dataset.
+    bucket_size : int
+        Number of neighbouring utterances per bucket.
+    shuffle : bool
+        If False, the utterances are read in storage order.
+    seed : int
+        Seed of the shuffling.
+    epoch : int
+        First epoch.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        audio_shards,
+        bucket_size=1024,
+        shuffle=True,
+        seed=42,
+        epoch=0,
+    ):
+        self._positions = np.array(audio_shards.positions(dataset.data_ids))
+        self._bucket_size = bucket_size
+        self._shuffle = shuffle
+        self._seed = seed
+        self._epoch = epoch
+
+    def _order(self):
+        order = np.argsort(self._positions, kind="stable")
+        if not self._shuffle:
+            return order.tolist()
+        # deterministically shuffle based on epoch and seed; the buckets
+        # start at a random shift, so that they hold other neighbours
+        g = torch.Generator()
+        g.manual_seed(self._seed + self._epoch)
+        shift = int(torch.randint(self._bucket_size, (1,), generator=g))
+        bounds = np.arange(shift, len(order), self._bucket_size)
+        buckets = np.split(order, bounds[bounds > 0])
+        indices = []
+        for b in torch.randperm(len(buckets), generator=g).tolist():
+            indices.extend(buckets[b].tolist())
+        return indices
+
+    def __iter__(self):
+        indices = self._order()
+        # a new order at the next epoch, if set_epoch is not called
+        self._epoch += 1
+        return iter(indices)
+
+    def set_epoch(self, epoch):
+        """Sets the epoch of the shuffling, as DistributedSampler."""
+        self._epoch = epoch
+
+    def __len__(self):
+        return len(self._positions)
@@ -0,0 +1,257 @@
+"""
+Batch sampler packing batches to a budget of transducer lattice cost.
+
+The memory and time of a transducer step grow with the padded lattice
+B * T * U * V (utterances, encoder frames, target tokens + 1, vocabulary),
+not with the total duration of the batch: a batch of a few long utterances
+with long transcripts costs much more than the same seconds of short ones.
+The frames of every utterance are derived from its duration and the time
+subsampling of the CNN front-end, its tokens from the token count stored in
+the manifest. Utterances are bucketed by cost, and each bucket is cut into
+batches whose padded cost stays under the budget.
+"""
+
+import math
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+from speechbrain.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class LatticeCostBatchSampler(Sampler):
+    """
+    Dynamic batch sampler whose batches fit a budget of lattice cost.
+
+    Arguments
+    ---------
+    dataset : speechbrain.dataio.dataset.DynamicItemDataset
+        Dataset whose data points hold the duration (in seconds) and, ideally,
+        the token count of every utterance.
+    max_batch_cost : float
+        Budget of every batch: B * T * U * V of the padded lattice, or bytes
+        if a memory_model is given.
+    output_neurons : int
+        Size of the vocabulary V, blank included.
+    num_buckets : int
+        Number of buckets, between quantiles of the cost of the utterances.
+    hop_length : float
+        Hop of the features, in milliseconds.
+    subsampling : int
+        Time subsampling of the CNN front-end.
+    token_key : str
+        Key of the token count in the data points.
+    chars_per_token : float
+        Estimate of the characters per token of the transcripts (key 'wrd'),
+        used for the data points without a token count.
+    memory_model : memory_planner.TransducerMemoryModel
+        If given, the cost of a batch is its predicted peak bytes.
+    shuffle : bool
+        If True, the utterances are shuffled before being bucketed, with a
+        new order at every epoch.
+    batch_ordering : str
+        'random' | 'ascending' | 'descending', the order of the batches,
+        by cost.
+    max_batch_ex : int
+        Maximum number of utterances per batch.
+    seed : int
+        Seed of the shuffling.
+    epoch : int
+        First epoch.
+    drop_last : bool
+        If True, the incomplete batches left in the buckets are dropped.
+
+    Example
+    -------
+    >>> from speechbrain.dataio.dataset import DynamicItemDataset
+    >>> data = {
+    ...     "utt{}".format(i): {"duration": d, "n_tokens": u}
+    ...     for i, (d, u) in enumerate([(1.0, 5), (1.1, 6), (4.0, 30), (4.2, 20)])
+    ... }
+    >>> sampler = LatticeCostBatchSampler(
+    ...     DynamicItemDataset(data), max_batch_cost=5e5, output_neurons=100,
+    ...     num_buckets=2, shuffle=False, batch_ordering="ascending",
+    ... )
+    >>> list(sampler)
+    [[0, 1], [3], [2]]
+    """
+
+    def __init__(
+        self,
+        dataset,
+        max_batch_cost,
+        output_neurons,
+        num_buckets=20,
+        hop_length=10,
+        subsampling=4,
+        token_key="n_tokens",
+        chars_per_token=3.0,
+        memory_model=None,
+        shuffle=True,
+        batch_ordering="random",
+        max_batch_ex=None,
+        seed=42,
+        epoch=0,
+        drop_last=False,
+    ):
+        if batch_ordering not in ("random", "ascending", "descending"):
+            raise ValueError(
+                "Unexpected batch_ordering {}".format(batch_ordering)
+            )
+        self._dataset = dataset
+        self._max_batch_cost = max_batch_cost
+        self._output_neurons = output_neurons
+        self._hop_length = hop_length
+        self._subsampling = subsampling
+        self._memory_model = memory_model
+        self._shuffle_ex = shuffle
+        self._batch_ordering = batch_ordering
+        self._max_batch_ex = max_batch_ex or np.inf
+        self._seed = seed
+        self._epoch = epoch
+        self._drop_last = drop_last
+
+        durations, tokens, estimated = [], [], 0
+        for data_id in dataset.data_ids:
+            data_point = dataset.data[data_id]
+            durations.append(float(data_point["duration"]))
+            if data_point.get(token_key) is not None:
+                tokens.append(int(data_point[token_key]))
+            else:
+                n_chars = len(data_point.get("wrd", ""))
+                tokens.append(math.ceil(n_chars / chars_per_token))
+                estimated += 1
+        if estimated:
+            logger.warning(
+                "%d utterances have no %s, their token count is estimated "
+                "from their transcript",
+                estimated,
+                token_key,
+            )
+        self._durations = np.array(durations)
+        self._tokens = np.array(tokens)
+        self._ex_costs = np.array(
+            [self._batch_cost(1, d, u) for d, u in zip(durations, tokens)]
+        )
+
+        # quantiles of the cost of the utterances
+        quantiles = np.linspace(0, 1, num_buckets + 1)[1:-1]
+        self._bucket_boundaries = np.unique(
+            np.quantile(self._ex_costs, quantiles)
+        )
+        self._generate_batches()
+
+    def _frames(self, duration):
+        frames = duration * 1000 / self._hop_length + 1
+        return math.ceil(frames / self._subsampling)
+
+    def _batch_cost(self, batch_size, max_duration, max_tokens):
+        """Cost of a batch padded to its longest utterance and target."""
+        if self._memory_model is not None:
+            feats = self._memory_model.features(
+                batch_size, max_duration, max_tokens
+            )
+            return float(feats @ self._memory_model.coef)
+        frames = self._frames(max_duration)
+        return batch_size * frames * (max_tokens + 1) * self._output_neurons
+
+    def _generate_batches(self):
+        if self._shuffle_ex:
+            # deterministically shuffle based on epoch and seed
+            g = torch.Generator()
+            g.manual_seed(self._seed + self._epoch)
+            sampler = torch.randperm(len(self._ex_costs), generator=g).tolist()
+        else:
+            sampler = range(len(self._ex_costs))
+
+        num_buckets = len(self._bucket_boundaries) + 1
+        buckets = [[] for _ in range(num_buckets)]
+        # longest duration and target of the batch filling every bucket
+        maxima = [(0.0, 0) for _ in range(num_buckets)]
+        self._batches = []
+        self._costs = []
+        for idx in sampler:
+            bucket_id = np.searchsorted(
+                self._bucket_boundaries, self._ex_costs[idx]
+            )
+            batch = buckets[bucket_id]
+            max_duration, max_tokens = maxima[bucket_id]
+            max_duration = max(max_duration, self._durations[idx])
+            max_tokens = max(max_tokens, self._tokens[idx])
+            cost = self._batch_cost(len(batch) + 1, max_duration, max_tokens)
+            if batch and (
+                cost > self._max_batch_cost or len(batch) >= self._max_batch_ex
+            ):
+                self._close(batch)
+                batch = buckets[bucket_id] = []
+                max_duration = self._durations[idx]
+                max_tokens = self._tokens[idx]
+            batch.append(idx)
+            maxima[bucket_id] = (max_duration, max_tokens)
+
+        if not self._drop_last:
+            for batch in buckets:
+                if batch:
+                    self._close(batch)
+
+        self._permute_batches()
+        if self._epoch == 0:
+            costs = np.array(self._costs)
+            filled = self._ex_costs.sum() / max(costs.sum(), 1.0)
+            logger.info(
+                "LatticeCostBatchSampler: %d batches, %.1f%% of the budget "
+                "used on average, %.1f%% of the padded lattice filled",
+                len(self._batches),
+                100 * costs.mean() / self._max_batch_cost,
+                100 * filled,
+            )
+
+    def _close(self, batch):
+        self._batches.append(batch)
+        self._costs.append(
+            self._batch_cost(
+                len(batch),
+                self._durations[batch].max(),
+                self._tokens[batch].max(),
+            )
+        )
+
+    def _permute_batches(self):
+        if self._batch_ordering == "random":
+            # deterministically shuffle based on epoch and seed
+            g = torch.Generator()
+            g.manual_seed(self._seed + self._epoch)
+            order = torch.randperm(len(self._batches), generator=g).tolist()
+        else:
+            order = np.argsort(self._costs, kind="stable").tolist()
+            if self._batch_ordering == "descending":
+                order = order[::-1]
+        self._batches = [self._batches[i] for i in order]
+        self._costs = [self._costs[i] for i in order]
+
+    def get_durations(self, batch):
+        """Gets durations of the elements in the batch."""
+        return self._durations[batch].tolist()
+
+    def __iter__(self):
+        for batch in self._batches:
+            yield batch
+        if self._shuffle_ex:  # re-generate examples if ex_ordering == "random"
+            self._generate_batches()
+        if self._batch_ordering == "random":
+            # we randomly permute the batches only --> faster
+            self._permute_batches()
+
+    def set_epoch(self, epoch):
+        """
+        You can also just access self.epoch, but we maintain this interface
+        to mirror torch.utils.data.distributed.DistributedSampler
+        """
+        self._epoch = epoch
+        self._generate_batches()
+
+    def __len__(self):
+        return len(self._batches)
@@ -16,12 +16,22 @@ from torch.nn import Module
 
 from speechbrain.utils.logger import get_logger
 
+from lattice import (
+    COMPACT_BLANK,
+    COMPACT_LABEL,
+    checkpointed_marginal_prob,
+    compact_lattice_inputs,
+    pruned_lattice_inputs,
+    pruned_marginal_prob,
+    wavefront_marginal_prob,
+)
+
 NUMBA_VERBOSE = 0
 
 logger = get_logger(__name__)
 
 try:
-    from numba import cuda
+    from numba import cuda, njit, prange
 
     # Numba is extra verbose and this may lead to log.txt file of multiple gigabytes... we deactivate
     if not NUMBA_VERBOSE:
@@ -469,8 +479,82 @@ def cu_kernel_forward_only(log_probs, labels, alpha, log_p, log_r, emit, no_emit
 @cuda.jit()
 def cu_kernel_forward_only_grad(d_log_p, d_log_probs, labels, d_alpha, emit, no_emit, T, U, blank, lock):
     """
-    Compute forward pass for the forward-backward algorithm using Numba cuda kernel.
-    Sequence Transduction with naive implementation : https://arxiv.org/pdf/1211.3711.pdf
+    Compute backward pass of the per-prefix marginals using Numba cuda kernel,
+    reading the emit/no_emit buffers stored by cu_kernel_forward_only.
+
+    Arguments
+    ---------
+    d_log_p : torch.Tensor
+        2D Tensor of (batch x LabelLength) with the incoming gradient.
+    d_log_probs : torch.Tensor
+        4D Tensor of (batch x TimeLength x LabelLength x outputDim) receiving the gradient.
+    labels : torch.Tensor
+        2D Tensor of (batch x MaxSeqLabelLength) containing targets of the batch with zero padding.
+    d_alpha : torch.Tensor
+        3D Tensor of (batch x TimeLength x LabelLength) for backward computation.
+    emit : torch.Tensor
+        3D Tensor of (batch x TimeLength x LabelLength) with the log emission scores.
+    no_emit : torch.Tensor
+        3D Tensor of (batch x TimeLength x LabelLength) with the log no-emission scores.
+    T : torch.Tensor
+        1D Tensor of (batch) containing TimeLength of each target.
+    U : torch.Tensor
+        1D Tensor of (batch) containing LabelLength of each target.
+    blank : int
+        Blank index.
+    lock : torch.Tensor
+        2D Tensor of (batch x LabelLength) containing bool(1-0) lock for parallel computation.
+    """
+
+    # parallelize the backward algorithm over batch and target length dim
+    b = cuda.blockIdx.x
+    u = cuda.threadIdx.x
+    t = T[b] - 1
+
+    if u <= U[b]:
+        # for each (B,U) Thread
+        # wait the unlock of the computation of d_alpha[b,t,U+1]
+        # Do the computation over the whole Time sequence on d_alpha[B,U,:]
+        # and then unlock the target U-1 for computation
+        while t >= 0:
+            if u == U[b] or cuda.atomic.add(lock, (b, u), 0) < 0:
+                if t == T[b] - 1:
+                    # gradient of the normalized marginal of prefix u
+                    cuda.atomic.add(d_alpha, (b, t, u), d_log_p[b, u] / T[b])
+                    d_log_probs[b, t, u, blank] += d_log_p[b, u] / T[b]
+
+                if t > 0 and u > 0:
+                    # split d_alpha between the two incoming arcs
+                    max_val = max(emit[b, t, u], no_emit[b, t, u])
+                    exp_emit = math.exp(emit[b, t, u] - max_val)
+                    exp_no_emit = math.exp(no_emit[b, t, u] - max_val)
+                    norm = exp_emit + exp_no_emit
+                    d_emit = d_alpha[b, t, u] * (exp_emit / norm)
+                    d_no_emit = d_alpha[b, t, u] * (exp_no_emit / norm)
+                elif t > 0:
+                    d_emit = 0.0
+                    d_no_emit = d_alpha[b, t, u]
+                else:
+                    d_emit = d_alpha[b, t, u]
+                    d_no_emit = 0.0
+
+                if u > 0:
+                    cuda.atomic.add(d_alpha, (b, t, u - 1), d_emit)
+                    d_log_probs[b, t, u - 1, labels[b, u - 1]] += d_emit
+                    cuda.atomic.add(lock, (b, u - 1), -1)
+                if t > 0:
+                    cuda.atomic.add(d_alpha, (b, t - 1, u), d_no_emit)
+                    d_log_probs[b, t - 1, u, blank] += d_no_emit
+                if u < U[b]:
+                    cuda.atomic.add(lock, (b, u), 1)
+                t -= 1
+
+
+@cuda.jit()
+def cu_kernel_forward_only_alpha(log_probs, labels, alpha, log_p, T, U, blank, lock):
+    """
+    Compute the per-prefix marginals using Numba cuda kernel, like
+    cu_kernel_forward_only but without storing emit/no_emit.
 
     Arguments
     ---------
@@ -481,7 +565,7 @@ def cu_kernel_forward_only_grad(d_log_p, d_log_probs, labels, d_alpha, emit, no_
     alpha : torch.Tensor
         3D Tensor of (batch x TimeLength x LabelLength) for forward computation.
     log_p : torch.Tensor
-        1D Tensor of (batch) for forward cost computation.
+        2D Tensor of (batch x LabelLength) for the marginal of every prefix.
     T : torch.Tensor
         1D Tensor of (batch) containing TimeLength of each target.
     U : torch.Tensor
@@ -495,73 +579,292 @@ def cu_kernel_forward_only_grad(d_log_p, d_log_probs, labels, d_alpha, emit, no_
     # parallelize the forward algorithm over batch and target length dim
     b = cuda.blockIdx.x
     u = cuda.threadIdx.x
-    t = T[b] - 1
-
+    t = 0
     if u <= U[b]:
         # for each (B,U) Thread
-        # wait the unlock of the previous computation of Alpha[b,U+1,:]
+        # wait the unlock of the previous computation of Alpha[b,U-1,:]
         # Do the computation over the whole Time sequence on alpha[B,U,:]
-        # and then unlock the target U-1 for computation
-        if u == U[b] and cuda.atomic.add(lock, (b,u),0) == 0:
-            # unlock top row
-            cuda.atomic.add(lock, (b, u), -1)
-
-        while t > 0:
-
-            if u == 0 and cuda.atomic.add(lock, (b, 0), 0) < 0:
+        # and then unlock the target U+1 for computation
+        while t < T[b]:
+            if u == 0:
                 if t > 0:
-                    cuda.atomic.add(d_alpha, (b,t-1,0), d_alpha[b,t,0])
-                    cuda.atomic.add(d_log_probs, (b,t-1,0,blank), d_alpha[b,t,0])
-                t -= 1
-                cuda.atomic.add(lock, (b, U[b]), -1)
-                cuda.atomic.add(lock, (b, u), 1)
-
+                    alpha[b, t, 0] = (
+                        alpha[b, t - 1, 0] + log_probs[b, t - 1, 0, blank]
+                    )
+                cuda.atomic.add(lock, (b, u + 1), -1)
+                t += 1
             else:
                 if cuda.atomic.add(lock, (b, u), 0) < 0:
+                    if t == 0:
+                        alpha[b, 0, u] = (
+                            alpha[b, 0, u - 1]
+                            + log_probs[b, 0, u - 1, labels[b, u - 1]]
+                        )
+                    else:
+                        # compute emission prob
+                        emit = (
+                            alpha[b, t, u - 1]
+                            + log_probs[b, t, u - 1, labels[b, u - 1]]
+                        )
+                        # compute no_emission prob
+                        no_emit = (
+                            alpha[b, t - 1, u] + log_probs[b, t - 1, u, blank]
+                        )
+                        # do logsumexp between log_emit and log_no_emit
+                        alpha[b, t, u] = max(no_emit, emit) + math.log1p(
+                            math.exp(-abs(no_emit - emit))
+                        )
+                    if u < U[b]:
+                        cuda.atomic.add(lock, (b, u + 1), -1)
+                    cuda.atomic.add(lock, (b, u), 1)
+                    t += 1
+
+        # save probability of T column, and normalize by T
+        log_p[b, u] = (
+            alpha[b, T[b] - 1, u] + log_probs[b, T[b] - 1, u, blank]
+        ) / T[b]
+
+
+@cuda.jit()
+def cu_kernel_forward_only_grad_recompute(d_log_p, d_log_probs, log_probs, labels, alpha, d_alpha, T, U, blank, lock):
+    """
+    Compute backward pass of the per-prefix marginals using Numba cuda kernel.
+    The emit/no_emit scores are rebuilt on the fly from alpha and log_probs,
+    so the forward pass only has to keep alpha.
+
+    Arguments
+    ---------
+    d_log_p : torch.Tensor
+        2D Tensor of (batch x LabelLength) with the incoming gradient.
+    d_log_probs : torch.Tensor
+        4D Tensor of (batch x TimeLength x LabelLength x outputDim) receiving the gradient.
+    log_probs : torch.Tensor
+        4D Tensor of (batch x TimeLength x LabelLength x outputDim) from the Transducer network.
+    labels : torch.Tensor
+        2D Tensor of (batch x MaxSeqLabelLength) containing targets of the batch with zero padding.
+    alpha : torch.Tensor
+        3D Tensor of (batch x TimeLength x LabelLength) from the forward computation.
+    d_alpha : torch.Tensor
+        3D Tensor of (batch x TimeLength x LabelLength) for backward computation.
+    T : torch.Tensor
+        1D Tensor of (batch) containing TimeLength of each target.
+    U : torch.Tensor
+        1D Tensor of (batch) containing LabelLength of each target.
+    blank : int
+        Blank index.
+    lock : torch.Tensor
+        2D Tensor of (batch x LabelLength) containing bool(1-0) lock for parallel computation.
+    """
 
-                    if t == T[b] - 1:
-                        cuda.atomic.add(d_alpha, (b,t-1,u), d_log_p[b,u] / T[b])
-                        cuda.atomic.add(d_log_probs, (b,t-1,u,blank), d_log_p[b,u] / T[b])
-
-                    max_val = max(emit[b,t,u], no_emit[b,t,u])
-                    exp_emit = math.exp(emit[b,t,u] - max_val)
-                    exp_no_emit = math.exp(no_emit[b,t,u] - max_val)
-                    norm =  exp_emit + exp_no_emit
-                    d_emit = d_alpha[b,t,u] * (exp_emit / norm)
-                    d_no_emit = d_alpha[b,t,u] * (exp_no_emit / norm)
-
-                    cuda.atomic.add(d_alpha, (b,t,u-1), d_emit)
-                    cuda.atomic.add(d_alpha, (b,t-1,u), d_no_emit)
-
-                    # print("norm",norm)
-                    # print("no_emit", no_emit[b,t,u])
-                    # print("emit", emit[b,t,u])
-                    # print("d_no_emit", d_no_emit)
-                    # print("d_emit", d_emit)
-                    # print("before no_emit",d_log_probs[b,t-1,u,blank])
-                    cuda.atomic.add(d_log_probs, (b,t,u-1, labels[b,u-1]), d_emit)
-                    cuda.atomic.add(d_log_probs, (b,t-1,u,blank), d_no_emit)
-                    # print("after no_emit",d_log_probs[b,t-1,u,blank])
-                    # print(d_log_probs[b,t-1,u,blank])
-
-                    t -= 1
-                    # unlock u - 1 and lock u
-                    # if u < U[b]:
+    # parallelize the backward algorithm over batch and target length dim
+    b = cuda.blockIdx.x
+    u = cuda.threadIdx.x
+    t = T[b] - 1
+
+    if u <= U[b]:
+        # for each (B,U) Thread
+        # wait the unlock of the computation of d_alpha[b,t,U+1]
+        # Do the computation over the whole Time sequence on d_alpha[B,U,:]
+        # and then unlock the target U-1 for computation
+        while t >= 0:
+            if u == U[b] or cuda.atomic.add(lock, (b, u), 0) < 0:
+                if t == T[b] - 1:
+                    # gradient of the normalized marginal of prefix u
+                    cuda.atomic.add(d_alpha, (b, t, u), d_log_p[b, u] / T[b])
+                    d_log_probs[b, t, u, blank] += d_log_p[b, u] / T[b]
+
+                if t > 0 and u > 0:
+                    # rebuild the two incoming arcs and split d_alpha
+                    emit = (
+                        alpha[b, t, u - 1]
+                        + log_probs[b, t, u - 1, labels[b, u - 1]]
+                    )
+                    no_emit = (
+                        alpha[b, t - 1, u] + log_probs[b, t - 1, u, blank]
+                    )
+                    d_emit = d_alpha[b, t, u] * math.exp(emit - alpha[b, t, u])
+                    d_no_emit = d_alpha[b, t, u] * math.exp(
+                        no_emit - alpha[b, t, u]
+                    )
+                elif t > 0:
+                    d_emit = 0.0
+                    d_no_emit = d_alpha[b, t, u]
+                else:
+                    d_emit = d_alpha[b, t, u]
+                    d_no_emit = 0.0
+
+                if u > 0:
+                    cuda.atomic.add(d_alpha, (b, t, u - 1), d_emit)
+                    d_log_probs[b, t, u - 1, labels[b, u - 1]] += d_emit
                     cuda.atomic.add(lock, (b, u - 1), -1)
+                if t > 0:
+                    cuda.atomic.add(d_alpha, (b, t - 1, u), d_no_emit)
+                    d_log_probs[b, t - 1, u, blank] += d_no_emit
+                if u < U[b]:
                     cuda.atomic.add(lock, (b, u), 1)
+                t -= 1
+
+
+@njit(parallel=True)
+def cpu_kernel_forward_only(log_probs, labels, alpha, log_p, T, U, blank):
+    """
+    Compute the per-prefix marginals of the lattice on CPU using Numba.
+    Same recursion as cu_kernel_forward_only, with the batch spread over
+    cores instead of one GPU thread per label position.
+
+    Arguments
+    ---------
+    log_probs : numpy.ndarray
+        4D array of (batch x TimeLength x LabelLength x outputDim) from the Transducer network.
+    labels : numpy.ndarray
+        2D array of (batch x MaxSeqLabelLength) containing targets of the batch with zero padding.
+    alpha : numpy.ndarray
+        3D array of (batch x TimeLength x LabelLength) for forward computation.
+    log_p : numpy.ndarray
+        2D array of (batch x LabelLength) receiving the marginal of every prefix.
+    T : numpy.ndarray
+        1D array of (batch) containing TimeLength of each target.
+    U : numpy.ndarray
+        1D array of (batch) containing LabelLength of each target.
+    blank : int
+        Blank index.
+    """
+    for b in prange(log_probs.shape[0]):
+        for t in range(T[b]):
+            for u in range(U[b] + 1):
+                if t == 0:
+                    if u > 0:
+                        alpha[b, 0, u] = (
+                            alpha[b, 0, u - 1]
+                            + log_probs[b, 0, u - 1, labels[b, u - 1]]
+                        )
+                elif u == 0:
+                    alpha[b, t, 0] = (
+                        alpha[b, t - 1, 0] + log_probs[b, t - 1, 0, blank]
+                    )
+                else:
+                    emit = (
+                        alpha[b, t, u - 1]
+                        + log_probs[b, t, u - 1, labels[b, u - 1]]
+                    )
+                    no_emit = alpha[b, t - 1, u] + log_probs[b, t - 1, u, blank]
+                    alpha[b, t, u] = max(no_emit, emit) + math.log1p(
+                        math.exp(-abs(no_emit - emit))
+                    )
 
+        # save probability of T column, and normalize by T
+        for u in range(U[b] + 1):
+            log_p[b, u] = (
+                alpha[b, T[b] - 1, u] + log_probs[b, T[b] - 1, u, blank]
+            ) / T[b]
+
+
+@njit(parallel=True)
+def cpu_kernel_forward_only_grad(
+    d_log_p, d_log_probs, log_probs, labels, alpha, d_alpha, T, U, blank
+):
+    """
+    Backpropagate the per-prefix marginals through the lattice on CPU.
+    The emit/no_emit weights are rebuilt from alpha, so nothing but alpha
+    has to be kept from the forward pass.
+
+    Arguments
+    ---------
+    d_log_p : numpy.ndarray
+        2D array of (batch x LabelLength) with the incoming gradient.
+    d_log_probs : numpy.ndarray
+        4D array of (batch x TimeLength x LabelLength x outputDim) receiving the gradient.
+    log_probs : numpy.ndarray
+        4D array of (batch x TimeLength x LabelLength x outputDim) from the Transducer network.
+    labels : numpy.ndarray
+        2D array of (batch x MaxSeqLabelLength) containing targets of the batch with zero padding.
+    alpha : numpy.ndarray
+        3D array of (batch x TimeLength x LabelLength) from the forward pass.
+    d_alpha : numpy.ndarray
+        3D array of (batch x TimeLength x LabelLength) for the backward sweep.
+    T : numpy.ndarray
+        1D array of (batch) containing TimeLength of each target.
+    U : numpy.ndarray
+        1D array of (batch) containing LabelLength of each target.
+    blank : int
+        Blank index.
+    """
+    for b in prange(log_probs.shape[0]):
+        t_last = T[b] - 1
+        for u in range(U[b] + 1):
+            grad = d_log_p[b, u] / T[b]
+            d_alpha[b, t_last, u] += grad
+            d_log_probs[b, t_last, u, blank] += grad
+
+        # visit the lattice in the reverse order of the forward recursion
+        for t in range(t_last, -1, -1):
+            for u in range(U[b], -1, -1):
+                grad = d_alpha[b, t, u]
+                if t == 0:
+                    if u > 0:
+                        label = labels[b, u - 1]
+                        d_alpha[b, 0, u - 1] += grad
+                        d_log_probs[b, 0, u - 1, label] += grad
+                elif u == 0:
+                    d_alpha[b, t - 1, 0] += grad
+                    d_log_probs[b, t - 1, 0, blank] += grad
+                else:
+                    label = labels[b, u - 1]
+                    emit = alpha[b, t, u - 1] + log_probs[b, t, u - 1, label]
+                    no_emit = alpha[b, t - 1, u] + log_probs[b, t - 1, u, blank]
+                    d_emit = grad * math.exp(emit - alpha[b, t, u])
+                    d_no_emit = grad * math.exp(no_emit - alpha[b, t, u])
+                    d_alpha[b, t, u - 1] += d_emit
+                    d_log_probs[b, t, u - 1, label] += d_emit
+                    d_alpha[b, t - 1, u] += d_no_emit
+                    d_log_probs[b, t - 1, u, blank] += d_no_emit
 
 
 class ComputeMarginalProb(Function):
 
     @staticmethod
-    def forward(ctx, log_probs, labels, log_r, T, U, blank, reduction):
+    def forward(ctx, log_probs, labels, log_r, T, U, blank, reduction, recompute=False):
         log_probs = log_probs.detach()
         B, maxT, maxU, A = log_probs.shape
 
         alpha = torch.zeros(
             (B, maxT, maxU), device=log_probs.device, dtype=log_probs.dtype
         )
+        log_p_alpha = torch.zeros(
+            (B,maxU), device=log_probs.device, dtype=log_probs.dtype
+        )
+
+        ctx.shape = log_probs.shape
+        ctx.blank = blank
+        ctx.on_cpu = not log_probs.is_cuda
+
+        if ctx.on_cpu:
+            # emit and no_emit are rebuilt from alpha in the CPU backward
+            cpu_kernel_forward_only(
+                log_probs.numpy(),
+                labels.numpy(),
+                alpha.numpy(),
+                log_p_alpha.numpy(),
+                T.numpy(),
+                U.numpy(),
+                blank,
+            )
+            ctx.save_for_backward(log_probs, labels, alpha, T, U)
+            return log_p_alpha
+
+        ctx.recompute = recompute
+        if recompute:
+            # only alpha and the inputs are kept until backward, emit/no_emit
+            # are rebuilt there
+            lock = torch.zeros(
+                (B, maxU), dtype=torch.int32, device=log_probs.device
+            )
+            cu_kernel_forward_only_alpha[B, maxU](
+                log_probs, labels, alpha, log_p_alpha, T, U, blank, lock
+            )
+            ctx.save_for_backward(log_probs, labels, alpha, T, U)
+            return log_p_alpha
+
         emit = torch.zeros(
             (B, maxT, maxU), device=log_probs.device, dtype=log_probs.dtype
         )
@@ -571,9 +874,6 @@ class ComputeMarginalProb(Function):
         lock = torch.zeros(
             (B, maxU), dtype=torch.int32, device=log_probs.device
         )
-        log_p_alpha = torch.zeros(
-            (B,maxU), device=log_probs.device, dtype=log_probs.dtype
-        )
 
         cu_kernel_forward_only[B, maxU](
             log_probs, labels, alpha, log_p_alpha, log_r, emit, no_emit, T, U, blank, lock
@@ -593,23 +893,137 @@ class ComputeMarginalProb(Function):
         d_log_probs = torch.zeros_like(log_probs)
         ctx.save_for_backward(d_log_probs, labels, d_alpha, d_log_p_alpha, emit, no_emit, T, U, lock)
 
-        ctx.shape = log_probs.shape
-        ctx.blank = blank
-
         return log_p_alpha
 
     @staticmethod
     def backward(ctx, d_log_p):
         B, maxT, maxU, A = ctx.shape
         blank = ctx.blank
+
+        if ctx.on_cpu:
+            log_probs, labels, alpha, T, U = ctx.saved_tensors
+            d_log_probs = torch.zeros_like(log_probs)
+            d_alpha = torch.zeros_like(alpha)
+            cpu_kernel_forward_only_grad(
+                d_log_p.detach().contiguous().numpy(),
+                d_log_probs.numpy(),
+                log_probs.numpy(),
+                labels.numpy(),
+                alpha.numpy(),
+                d_alpha.numpy(),
+                T.numpy(),
+                U.numpy(),
+                blank,
+            )
+            return d_log_probs, None, None, None, None, None, None, None
+
+        if ctx.recompute:
+            log_probs, labels, alpha, T, U = ctx.saved_tensors
+            # backward-only buffers are allocated here, not in forward
+            d_log_probs = torch.zeros_like(log_probs)
+            d_alpha = torch.zeros_like(alpha)
+            lock = torch.zeros(
+                (B, maxU), dtype=torch.int32, device=log_probs.device
+            )
+            cu_kernel_forward_only_grad_recompute[B, maxU](
+                d_log_p.detach().contiguous(), d_log_probs, log_probs, labels, alpha, d_alpha, T, U, blank, lock
+            )
+            cuda.synchronize()
+            return d_log_probs, None, None, None, None, None, None, None
+
         d_log_probs, labels, d_alpha, d_log_p_alpha, emit, no_emit, T, U, lock = ctx.saved_tensors
 
         cu_kernel_forward_only_grad[B, maxU](
-            d_log_p, d_log_probs, labels, d_alpha, emit, no_emit, T, U, blank, lock
+            d_log_p.detach().contiguous(), d_log_probs, labels, d_alpha, emit, no_emit, T, U, blank, lock
         )
         cuda.synchronize()
         # return gradient w.r.t. log_probs and not to others
         return d_log_probs, None, None, None, None, None, None, None, None, None, None
+def _discounted_prefix_sums(x, decay, max_exponent=300.0):
+    """
+    Exclusive discounted prefix sums S[n] = sum_m<n decay ** (n - m) * x[m]
+    along the last dimension. Within a block, S is a cumsum of
+    x[m] * decay ** -m rescaled by decay ** n; the blocks are short enough
+    for decay ** -block to stay below exp(max_exponent), and the sum of the
+    previous blocks is carried over by the recurrence
+    S[n + j] = decay ** j * S[n] + (sum within the block).
+    """
+    L = x.shape[-1]
+    block = L
+    if decay < 1:
+        block = max(1, min(L, int(max_exponent / -math.log(decay))))
+    j = torch.arange(block, dtype=x.dtype, device=x.device)
+    up = decay ** -j
+    down = decay ** j
+
+    out = torch.empty_like(x)
+    carry = x.new_zeros(x.shape[:-1])
+    for start in range(0, L, block):
+        xs = x[..., start : start + block] * up[: x.shape[-1] - start]
+        n = xs.shape[-1]
+        local = torch.nn.functional.pad(xs.cumsum(-1)[..., :-1], (1, 0))
+        out[..., start : start + n] = (local + carry[..., None]) * down[:n]
+        carry = (carry + xs.sum(-1)) * decay**n
+    return out
+
+
+def sub_trajectory_balance(log_p, log_r, first, last, subtb_lambda, log_z=None):
+    """
+    SubTB(lambda) objective over all the prefix pairs m < n of every
+    utterance, weighted by lambda ** (n - m) and normalized by the sum of
+    the weights. With d[k] = 2 * log_p[k] - log_r[k], the squared
+    sub-trajectory loss of a pair is (d[n] - d[m]) ** 2, so that
+
+        sum_m<n lambda ** (n - m) * (d[n] - d[m]) ** 2
+            = sum_n d[n] ** 2 * A[n] - 2 * d[n] * B[n] + C[n]
+
+    where A, B and C are the lambda-discounted prefix sums of 1, d and d ** 2.
+    These are computed with a blocked scan in float64 (see
+    _discounted_prefix_sums), so the cost is O(U) per utterance instead of
+    the O(U^2) loop of cu_kernel_forward.
+
+    Arguments
+    ---------
+    log_p : torch.Tensor
+        2D Tensor of (batch x LabelLength) with the per-prefix marginals.
+    log_r : torch.Tensor
+        2D Tensor of (batch x MaxSeqLabelLength) with the per-prefix log-rewards.
+    first : torch.Tensor
+        1D Tensor of (batch) with the first prefix taking part in the pairs.
+    last : torch.Tensor
+        1D Tensor of (batch) with the last prefix taking part in the pairs.
+    subtb_lambda : float
+        Geometric weight lambda in (0, 1].
+    log_z : torch.Tensor
+        1D Tensor of (batch) with a learned log-partition added to the flow
+        of the first prefix.
+
+    Returns
+    -------
+    torch.Tensor
+        1D Tensor of (batch) with the loss of every utterance, zero when
+        fewer than two prefixes take part.
+    """
+    if not 0 < subtb_lambda <= 1:
+        raise ValueError("Unexpected subtb_lambda {}".format(subtb_lambda))
+    L = log_r.shape[-1]
+    k = torch.arange(L, device=log_r.device)
+    valid = (k[None, :] >= first[:, None]) & (k[None, :] <= last[:, None])
+    d = 2 * log_p[:, :L].double().to(log_r.device) - log_r.double()
+    d = torch.where(valid, d, 0.0)
+    if log_z is not None:
+        start = k[None, :] == first[:, None]
+        d = d - torch.where(start, log_z.double()[:, None], 0.0)
+
+    A = _discounted_prefix_sums(valid.double(), subtb_lambda)
+    B = _discounted_prefix_sums(d, subtb_lambda)
+    C = _discounted_prefix_sums(d ** 2, subtb_lambda)
+    total = torch.where(valid, d ** 2 * A - 2 * d * B + C, 0.0).sum(-1)
+    weight = torch.where(valid, A, 0.0).sum(-1)
+    loss = torch.where(weight > 0, total / weight.clamp(min=1e-30), 0.0)
+    return loss.to(log_p.dtype)
+
+
 def gfn_loss(
     logits,
     targets,
@@ -619,6 +1033,14 @@ def gfn_loss(
     blank_index,
     reduction="mean",
     use_torchaudio=True,
+    backend="numba",
+    compact=False,
+    recompute=False,
+    checkpoint_frames=None,
+    band_starts=None,
+    gathered=False,
+    subtb_lambda=None,
+    log_z=None,
 ):
     """Transducer loss, see `speechbrain/nnet/loss/transducer_loss.py`.
 
@@ -635,10 +1057,46 @@ def gfn_loss(
     blank_index : int
         The location of the blank symbol among the label indices.
     reduction : str
-        Specifies the reduction to apply to the output: 'mean' | 'batchmean' | 'sum'.
+        Specifies the reduction to apply to the output: 'mean' | 'batchmean' | 'sum' | 'none'.
     use_torchaudio: bool
         If True, use Transducer loss implementation from torchaudio, otherwise,
         use Speechbrain Numba implementation.
+    backend : str
+        Lattice engine computing the prefix marginals: 'numba' (CUDA or CPU
+        kernels, depending on the device of logits) | 'wavefront' (PyTorch
+        anti-diagonal sweep, differentiated by autograd) | 'checkpoint'
+        (PyTorch frame sweep storing alpha every checkpoint_frames frames,
+        recomputed in backward, for long utterances).
+    compact : bool
+        If True, gather the blank and label log-probs into a
+        [batch, maxT, maxU, 2] tensor before running the lattice engine,
+        instead of taking the log_softmax over all the labels.
+    recompute : bool
+        If True, the numba CUDA engine keeps only alpha between forward and
+        backward and rebuilds the emit/no_emit scores during the backward
+        sweep. The CPU engine always works this way.
+    checkpoint_frames : int
+        Number of frames between two stored alpha rows for the 'checkpoint'
+        backend. Defaults to ceil(sqrt(maxT)).
+    band_starts : torch.Tensor
+        First label position of the band of every frame, of shape
+        [batch, maxT], as returned by `lattice.select_band`. When given,
+        logits only cover the band, i.e. are of shape [batch, maxT, W,
+        num_labels], and the pruned lattice engine is used (backend and
+        compact are ignored). The trajectory balance then starts from the
+        shortest prefix reachable in the band of the last frame instead of
+        the empty one.
+    gathered : bool
+        If True, logits already hold the [batch, maxT, maxU|W, 2] blank and
+        label log-probs, e.g. from `lattice.chunked_joint`.
+    subtb_lambda : float
+        If given, use the SubTB(lambda) objective over all the prefix pairs
+        of every utterance, see sub_trajectory_balance, instead of the
+        trajectory balance of a single pair.
+    log_z : torch.Tensor
+        Learned log-partition of every utterance, of shape [batch], e.g.
+        from `log_partition.LogPartition`. It is added to the flow of the
+        first prefix, i.e. to the balance of the pairs starting from it.
 
     Returns
     -------
@@ -647,25 +1105,74 @@ def gfn_loss(
 
     input_lens = (input_lens * logits.shape[1]).round().int()
     target_lens = (target_lens * targets.shape[1]).round().int()
+    batch = torch.arange(logits.shape[0], device=log_r.device)
+    m = torch.zeros_like(batch)
 
     # Transducer.apply function take log_probs tensor.
-    log_probs = logits.log_softmax(-1)
-    log_p = ComputeMarginalProb.apply(
-        log_probs, targets, log_r, input_lens, target_lens, blank_index, reduction
-    )
-    B = log_p.shape[0]
-
-    m = 0
-
+    if gathered:
+        log_probs = logits
+        targets = torch.full_like(targets, COMPACT_LABEL)
+        blank_index = COMPACT_BLANK
+    elif band_starts is not None:
+        log_probs = pruned_lattice_inputs(
+            logits, targets, band_starts, blank_index
+        )
+    elif compact:
+        log_probs, targets, blank_index = compact_lattice_inputs(
+            logits, targets, blank_index
+        )
+    else:
+        log_probs = logits.log_softmax(-1)
 
-    loss_batch = torch.zeros((B,))
-    for b in range(B):
-        # full trajectory
+    if band_starts is not None:
+        log_p, m = pruned_marginal_prob(
+            log_probs, band_starts, input_lens, target_lens, targets.shape[1] + 1
+        )
+        m = m.to(log_r.device)
+    elif backend == "numba":
+        log_p = ComputeMarginalProb.apply(
+            log_probs, targets, log_r, input_lens, target_lens, blank_index, reduction, recompute
+        )
+    elif backend == "wavefront":
+        log_p = wavefront_marginal_prob(
+            log_probs, targets, input_lens, target_lens, blank_index
+        )
+    elif backend == "checkpoint":
+        log_p = checkpointed_marginal_prob(
+            log_probs, targets, input_lens, target_lens, blank_index, checkpoint_frames
+        )
+    else:
+        raise ValueError("Unexpected backend {}".format(backend))
+    if subtb_lambda is not None:
+        loss_batch = sub_trajectory_balance(
+            log_p,
+            log_r,
+            m,
+            target_lens.to(log_r.device).long() - 1,
+            subtb_lambda,
+            log_z,
+        )
+    else:
+        # trajectory balance between the prefix m (the empty one unless
+        # pruned) and the full trajectory n, computed for the whole batch on
+        # the device of log_p
         n = log_r.shape[-1] - 1
 
         # R_m + P_n
-        sub_tb_loss = (log_r[b, m] - log_r[b, n]) + 2 * (log_p[b,n] - log_p[b,m])
-
-        loss_batch[b] = loss_batch[b] + (sub_tb_loss ** 2) # add squared loss
-
-    return loss_batch.mean()
+        sub_tb_loss = (log_r[batch, m] - log_r[:, n]) + 2 * (
+            log_p[:, n] - log_p[batch, m]
+        )
+        if log_z is not None:
+            sub_tb_loss = sub_tb_loss + log_z
+        loss_batch = sub_tb_loss ** 2 # squared loss
+
+    if reduction == "mean":
+        return loss_batch.mean()
+    elif reduction == "batchmean":
+        return loss_batch.sum() / loss_batch.shape[0]
+    elif reduction == "sum":
+        return loss_batch.sum()
+    elif reduction == "none":
+        return loss_batch
+    else:
+        raise Exception("Unexpected reduction {}".format(reduction))
@@ -0,0 +1,732 @@
+"""
+Lattice engines for the transducer and GFN losses written with plain
+PyTorch tensor ops. They run on any device and rely on autograd for the
+backward pass, so no gradient kernel has to be written by hand.
+"""
+
+import math
+
+import torch
+from torch.autograd import Function
+from torch.utils.checkpoint import checkpoint
+
+# Layout of the last dimension of the compact lattice log-probs. Passing
+# labels filled with COMPACT_LABEL and blank=COMPACT_BLANK lets every lattice
+# engine read a compact tensor exactly as it reads a (B,T,U,V) one.
+COMPACT_BLANK = 0
+COMPACT_LABEL = 1
+
+
+def _neg_inf(dtype):
+    """Finite stand-in for -inf, so that logaddexp never produces NaN grads."""
+    return torch.finfo(dtype).min / 2
+
+
+def gather_blank_and_label(log_probs, labels, blank):
+    """
+    Extracts the two entries of log_probs read by the lattice recursion.
+
+    Arguments
+    ---------
+    log_probs : torch.Tensor
+        4D Tensor of (batch x TimeLength x LabelLength x outputDim).
+    labels : torch.Tensor
+        2D Tensor of (batch x MaxSeqLabelLength) containing targets of the batch with zero padding.
+    blank : int
+        Blank index.
+
+    Returns
+    -------
+    blank_lp : torch.Tensor
+        3D Tensor of (batch x TimeLength x LabelLength) with the blank log-probs.
+    label_lp : torch.Tensor
+        3D Tensor of (batch x TimeLength x LabelLength) with the log-probs of
+        emitting labels[b, u] from node (t, u). The last column reads blank.
+    """
+    B, maxT, maxU, _ = log_probs.shape
+    index = torch.nn.functional.pad(labels.long(), (0, 1), value=blank)
+    index = index[:, None, :maxU, None].expand(B, maxT, maxU, 1)
+    label_lp = log_probs.gather(-1, index).squeeze(-1)
+    return log_probs[..., blank], label_lp
+
+
+class LatticeLogProbs(Function):
+    """
+    Gathers the blank and label log-probs of every lattice node straight
+    from the logits. Only the log-normalizer is computed over the vocabulary,
+    so the (batch x TimeLength x LabelLength x outputDim) log_softmax is
+    never materialized. The gradient is scattered back to the logits with
+    the softmax identity d(x_k - logsumexp(x)) / dx = onehot(k) - softmax(x).
+
+    Arguments
+    ---------
+    logits : torch.Tensor
+        4D Tensor of (batch x TimeLength x LabelLength x outputDim).
+    index : torch.Tensor
+        3D Tensor of (batch x TimeLength x LabelLength) with the label
+        emitted from every node.
+    blank : int
+        Blank index.
+
+    Returns
+    -------
+    torch.Tensor
+        4D Tensor of (batch x TimeLength x LabelLength x 2) holding the blank
+        log-probs at COMPACT_BLANK and the label log-probs at COMPACT_LABEL.
+    """
+
+    @staticmethod
+    def forward(ctx, logits, index, blank):
+        index = index.long().unsqueeze(-1)
+        # half precision logits are normalized in float32, like log_softmax
+        # does under autocast
+        dtype = torch.promote_types(logits.dtype, torch.float32)
+        log_norm = torch.logsumexp(logits.to(dtype), dim=-1, keepdim=True)
+        compact = torch.cat(
+            (logits[..., blank, None], logits.gather(-1, index)), dim=-1
+        )
+        ctx.save_for_backward(logits, index, log_norm)
+        ctx.blank = blank
+        return compact.to(dtype) - log_norm
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        logits, index, log_norm = ctx.saved_tensors
+        grad_logits = (logits.to(log_norm.dtype) - log_norm).exp_()
+        grad_logits.mul_(-grad_output.sum(dim=-1, keepdim=True))
+        grad_logits[..., ctx.blank] += grad_output[..., COMPACT_BLANK]
+        grad_logits.scatter_add_(
+            -1, index, grad_output[..., COMPACT_LABEL, None].contiguous()
+        )
+        return grad_logits.to(logits.dtype), None, None
+
+
+def compact_lattice_inputs(logits, labels, blank):
+    """
+    Returns the arguments to hand to a lattice engine in compact mode, i.e.
+    the (batch x TimeLength x LabelLength x 2) log-probs together with the
+    labels and blank index that address them.
+
+    Arguments
+    ---------
+    logits : torch.Tensor
+        4D Tensor of (batch x TimeLength x LabelLength x outputDim).
+    labels : torch.Tensor
+        2D Tensor of (batch x MaxSeqLabelLength) containing targets of the batch with zero padding.
+    blank : int
+        Blank index.
+
+    Returns
+    -------
+    log_probs : torch.Tensor
+        4D Tensor of (batch x TimeLength x LabelLength x 2).
+    labels : torch.Tensor
+        2D Tensor of (batch x MaxSeqLabelLength) filled with COMPACT_LABEL.
+    blank : int
+        COMPACT_BLANK.
+    """
+    B, maxT, maxU, _ = logits.shape
+    index = torch.nn.functional.pad(labels.long(), (0, 1), value=blank)
+    index = index[:, None, :maxU].expand(B, maxT, maxU)
+    log_probs = LatticeLogProbs.apply(logits, index, blank)
+    return log_probs, torch.full_like(labels, COMPACT_LABEL), COMPACT_BLANK
+
+
+def _skew(x, maxT, maxU):
+    """
+    Re-indexes a (batch x TimeLength x LabelLength) tensor by anti-diagonal,
+    so that x_skew[k, b, u] = x[b, k - u, u]. Cells outside of the lattice
+    hold arbitrary values and must be masked by the caller.
+    """
+    k = torch.arange(maxT + maxU - 1, device=x.device)
+    u = torch.arange(maxU, device=x.device)
+    t = (k[:, None] - u[None, :]).clamp(0, maxT - 1)
+    return x[:, t, u[None, :].expand_as(t)].transpose(0, 1)
+
+
+def wavefront_alpha(blank_lp, label_lp, T, U):
+    """
+    Forward variables of the lattice, computed one anti-diagonal t + u = k
+    at a time. Every diagonal is a single vectorized logaddexp over the
+    whole batch, so the sweep takes maxT + maxU - 1 steps and no locks.
+
+    Arguments
+    ---------
+    blank_lp : torch.Tensor
+        3D Tensor of (batch x TimeLength x LabelLength) with the blank log-probs.
+    label_lp : torch.Tensor
+        3D Tensor of (batch x TimeLength x LabelLength) with the label log-probs.
+    T : torch.Tensor
+        1D Tensor of (batch) containing TimeLength of each target.
+    U : torch.Tensor
+        1D Tensor of (batch) containing LabelLength of each target.
+
+    Returns
+    -------
+    torch.Tensor
+        3D Tensor of (diagonal x batch x LabelLength), alpha_skew[k, b, u]
+        holds alpha[b, k - u, u].
+    """
+    B, maxT, maxU = blank_lp.shape
+    neg = _neg_inf(blank_lp.dtype)
+    blank_skew = _skew(blank_lp, maxT, maxU)
+    label_skew = _skew(label_lp, maxT, maxU)
+
+    k = torch.arange(maxT + maxU - 1, device=blank_lp.device)
+    u = torch.arange(maxU, device=blank_lp.device)
+    t = k[:, None, None] - u[None, None, :]
+    valid = (
+        (t >= 0)
+        & (t < T.to(t.device)[None, :, None])
+        & (u[None, None, :] <= U.to(t.device)[None, :, None])
+    )
+
+    alpha = blank_lp.new_full((B, maxU), neg)
+    alpha[:, 0] = 0.0
+    diagonals = [alpha]
+    pad = blank_lp.new_full((B, 1), neg)
+    for step in range(1, maxT + maxU - 1):
+        # emission comes from (t, u - 1), no emission from (t - 1, u),
+        # both of which lie on the previous diagonal
+        emit = torch.cat(
+            (pad, alpha[:, :-1] + label_skew[step - 1, :, :-1]), dim=1
+        )
+        no_emit = alpha + blank_skew[step - 1]
+        alpha = torch.where(
+            valid[step], torch.logaddexp(emit, no_emit), neg
+        )
+        diagonals.append(alpha)
+    return torch.stack(diagonals)
+
+
+def wavefront_marginal_prob(log_probs, labels, T, U, blank):
+    """
+    Per-prefix marginals log_p[b, u] of the lattice, normalized by T. This
+    is the autograd counterpart of ComputeMarginalProb in gfn_loss.py.
+
+    Arguments
+    ---------
+    log_probs : torch.Tensor
+        4D Tensor of (batch x TimeLength x LabelLength x outputDim) from the Transducer network.
+    labels : torch.Tensor
+        2D Tensor of (batch x MaxSeqLabelLength) containing targets of the batch with zero padding.
+    T : torch.Tensor
+        1D Tensor of (batch) containing TimeLength of each target.
+    U : torch.Tensor
+        1D Tensor of (batch) containing LabelLength of each target.
+    blank : int
+        Blank index.
+
+    Returns
+    -------
+    torch.Tensor
+        2D Tensor of (batch x LabelLength), zero for u > U[b].
+    """
+    B, maxT, maxU, _ = log_probs.shape
+    blank_lp, label_lp = gather_blank_and_label(log_probs, labels, blank)
+    alpha = wavefront_alpha(blank_lp, label_lp, T, U)
+
+    T = T.to(log_probs.device).long()
+    U = U.to(log_probs.device).long()
+    u = torch.arange(maxU, device=log_probs.device)
+    k = (T[:, None] - 1 + u[None, :]).clamp(max=alpha.shape[0] - 1)
+    batch = torch.arange(B, device=log_probs.device)[:, None]
+    last_blank = blank_lp[batch, (T - 1)[:, None], u[None, :]]
+    log_p = (alpha[k, batch, u[None, :]] + last_blank) / T[:, None]
+    return torch.where(u[None, :] <= U[:, None], log_p, 0.0)
+
+
+def wavefront_transducer(log_probs, labels, T, U, blank, reduction):
+    """
+    Transducer loss, i.e. the negative log-likelihood normalized by T, as
+    returned by Transducer.apply in transducer_loss.py.
+
+    Arguments
+    ---------
+    log_probs : torch.Tensor
+        4D Tensor of (batch x TimeLength x LabelLength x outputDim) from the Transducer network.
+    labels : torch.Tensor
+        2D Tensor of (batch x MaxSeqLabelLength) containing targets of the batch with zero padding.
+    T : torch.Tensor
+        1D Tensor of (batch) containing TimeLength of each target.
+    U : torch.Tensor
+        1D Tensor of (batch) containing LabelLength of each target.
+    blank : int
+        Blank index.
+    reduction : str
+        Specifies the reduction to apply to the output: 'mean' | 'sum' | 'none'.
+
+    Returns
+    -------
+    torch.Tensor
+        The computed transducer loss.
+    """
+    B = log_probs.shape[0]
+    blank_lp, label_lp = gather_blank_and_label(log_probs, labels, blank)
+    alpha = wavefront_alpha(blank_lp, label_lp, T, U)
+
+    T = T.to(log_probs.device).long()
+    U = U.to(log_probs.device).long()
+    batch = torch.arange(B, device=log_probs.device)
+    log_p = (alpha[T - 1 + U, batch, U] + blank_lp[batch, T - 1, U]) / T
+
+    if reduction == "mean":
+        return -log_p.mean()
+    elif reduction == "sum":
+        return -log_p.sum()
+    elif reduction == "none":
+        return -log_p
+    else:
+        raise Exception("Unexpected reduction {}".format(reduction))
+
+
+def _frame_segment(carry, blank_lp, label_lp, t0, T):
+    """
+    Runs the lattice recursion over the frames [t0, t0 + blank_lp.shape[1]).
+    Within a frame, alpha[t, u] = logsumexp_j<=u (no_emit[j] + sum_j<=i<u
+    label_lp[t, i]), which is a single logcumsumexp over u.
+
+    Arguments
+    ---------
+    carry : torch.Tensor
+        2D Tensor of (batch x LabelLength), alpha[t0 - 1] + blank_lp[t0 - 1].
+    blank_lp : torch.Tensor
+        3D Tensor of (batch x SegmentLength x LabelLength).
+    label_lp : torch.Tensor
+        3D Tensor of (batch x SegmentLength x LabelLength).
+    t0 : int
+        First frame of the segment.
+    T : torch.Tensor
+        1D Tensor of (batch) containing TimeLength of each target.
+
+    Returns
+    -------
+    carry : torch.Tensor
+        2D Tensor of (batch x LabelLength) to start the next segment from.
+    last : torch.Tensor
+        2D Tensor of (batch x LabelLength) holding alpha[T - 1] + blank_lp[T - 1]
+        for the utterances ending in this segment, and zero otherwise.
+    """
+    last = torch.zeros_like(carry)
+    for step in range(blank_lp.shape[1]):
+        cum_label = torch.nn.functional.pad(
+            label_lp[:, step, :-1].cumsum(-1), (1, 0)
+        )
+        alpha = cum_label + torch.logcumsumexp(carry - cum_label, dim=-1)
+        carry = alpha + blank_lp[:, step]
+        ends = (T == t0 + step + 1)[:, None]
+        last = torch.where(ends, carry, last)
+    return carry, last
+
+
+def checkpointed_marginal_prob(log_probs, labels, T, U, blank, checkpoint_frames=None):
+    """
+    Per-prefix marginals log_p[b, u] of the lattice, normalized by T, with
+    time checkpointing. The recursion runs frame by frame and only keeps the
+    alpha row every checkpoint_frames frames; each segment is recomputed
+    during the backward pass. Memory for the recursion therefore grows as
+    T / K + K rows instead of T, i.e. sqrt(T) for K = sqrt(T).
+
+    Arguments
+    ---------
+    log_probs : torch.Tensor
+        4D Tensor of (batch x TimeLength x LabelLength x outputDim) from the Transducer network.
+    labels : torch.Tensor
+        2D Tensor of (batch x MaxSeqLabelLength) containing targets of the batch with zero padding.
+    T : torch.Tensor
+        1D Tensor of (batch) containing TimeLength of each target.
+    U : torch.Tensor
+        1D Tensor of (batch) containing LabelLength of each target.
+    blank : int
+        Blank index.
+    checkpoint_frames : int
+        Number of frames K between two stored alpha rows. Defaults to
+        ceil(sqrt(maxT)).
+
+    Returns
+    -------
+    torch.Tensor
+        2D Tensor of (batch x LabelLength), zero for u > U[b].
+    """
+    B, maxT, maxU, _ = log_probs.shape
+    if not checkpoint_frames:
+        checkpoint_frames = math.ceil(math.sqrt(maxT))
+    blank_lp, label_lp = gather_blank_and_label(log_probs, labels, blank)
+
+    T = T.to(log_probs.device).long()
+    U = U.to(log_probs.device).long()
+    carry = blank_lp.new_full((B, maxU), _neg_inf(blank_lp.dtype))
+    carry[:, 0] = 0.0
+    last = torch.zeros_like(carry)
+    for t0 in range(0, maxT, checkpoint_frames):
+        t1 = min(t0 + checkpoint_frames, maxT)
+        carry, last_seg = checkpoint(
+            _frame_segment,
+            carry,
+            blank_lp[:, t0:t1],
+            label_lp[:, t0:t1],
+            t0,
+            T,
+            use_reentrant=False,
+        )
+        last = last + last_seg
+
+    u = torch.arange(maxU, device=log_probs.device)
+    return torch.where(u[None, :] <= U[:, None], last / T[:, None], 0.0)
+
+
+def _feasible_band_starts(starts, T, U, width):
+    """
+    Moves the band starts s[b, t] to the closest ones that keep a lattice
+    path inside the band: s[b, 0] = 0, the last frame ends on U[b], and
+    0 <= s[b, t] - s[b, t - 1] <= width - 1 so that consecutive bands
+    overlap. This requires (width - 1) * (T[b] - 1) >= U[b] + 1 - width,
+    i.e. (width - 1) * T[b] >= U[b], see min_band_width.
+    """
+    maxT = starts.shape[1]
+    t = torch.arange(maxT, device=starts.device)
+    slope = (width - 1) * t[None, :]
+    last = (U + 1 - width).clamp(min=0)[:, None]
+    starts = torch.minimum(starts.clamp(min=0), last)
+    starts = torch.minimum(starts, slope)
+    starts = torch.where(t[None, :] >= (T - 1)[:, None], last, starts)
+    # monotonic, then at most width - 1 labels further per frame
+    starts = starts.cummax(dim=1).values
+    starts = (starts - slope).flip(1).cummax(dim=1).values.flip(1) + slope
+    return starts
+
+
+def min_band_width(T, U):
+    """
+    Smallest band width keeping a lattice path inside the band for every
+    utterance, i.e. (width - 1) * T >= U, and at least 2.
+
+    Arguments
+    ---------
+    T : torch.Tensor
+        1D Tensor of (batch) containing TimeLength of each target.
+    U : torch.Tensor
+        1D Tensor of (batch) containing LabelLength of each target.
+
+    Returns
+    -------
+    torch.Tensor
+        1D Tensor of (batch) with the smallest width of every utterance.
+
+    Example
+    -------
+    >>> min_band_width(torch.tensor([100, 1, 3]), torch.tensor([20, 5, 30]))
+    tensor([ 2,  6, 11])
+    """
+    T = T.long().clamp(min=1)
+    return ((U.long() + T - 1) // T + 1).clamp(min=2)
+
+
+def select_band(log_probs, labels, T, U, width, blank):
+    """
+    Chooses, for every frame, the window of width label positions the
+    pruned lattice is restricted to. The frame-level log_probs of a cheap
+    first pass (e.g. the CTC branch) are used as both the blank and the
+    label scores of a transducer lattice, whose blank posteriors give the
+    expected position of the alignment at the end of each frame. The band
+    of frame t is centered between the expected positions at the end of
+    frames t - 1 and t.
+
+    Arguments
+    ---------
+    log_probs : torch.Tensor
+        3D Tensor of (batch x TimeLength x outputDim) from the first pass.
+    labels : torch.Tensor
+        2D Tensor of (batch x MaxSeqLabelLength) containing targets of the batch with zero padding.
+    T : torch.Tensor
+        1D Tensor of (batch) containing TimeLength of each target.
+    U : torch.Tensor
+        1D Tensor of (batch) containing LabelLength of each target.
+    width : int
+        Number of label positions W kept per frame, at least
+        min_band_width(T, U) for every utterance.
+    blank : int
+        Blank index.
+
+    Returns
+    -------
+    torch.Tensor
+        2D Tensor of (batch x TimeLength) with the first label position of
+        the band of every frame.
+    """
+    B, maxT, _ = log_probs.shape
+    maxU = labels.shape[1] + 1
+    T = T.to(log_probs.device).long()
+    U = U.to(log_probs.device).long()
+    needed = min_band_width(T, U)
+    if (needed > width).any():
+        narrow = (needed > width).nonzero().flatten().tolist()
+        raise ValueError(
+            "Unexpected band width {} for the utterances of (T, U) = {}, "
+            "at least {} is needed".format(
+                width,
+                [(T[b].item(), U[b].item()) for b in narrow],
+                needed.max().item(),
+            )
+        )
+    dtype = torch.promote_types(log_probs.dtype, torch.float32)
+    log_probs = log_probs.detach().to(dtype)
+
+    with torch.enable_grad():
+        index = torch.nn.functional.pad(labels.long(), (0, 1), value=blank)
+        label_lp = log_probs.gather(-1, index[:, None, :].expand(B, maxT, maxU))
+        blank_lp = log_probs[..., blank, None].expand(B, maxT, maxU).clone()
+        blank_lp.requires_grad_()
+        alpha = wavefront_alpha(blank_lp, label_lp, T, U)
+        batch = torch.arange(B, device=log_probs.device)
+        log_like = alpha[T - 1 + U, batch, U] + blank_lp[batch, T - 1, U]
+        (occupancy,) = torch.autograd.grad(log_like.sum(), blank_lp)
+
+    u = torch.arange(maxU, device=log_probs.device, dtype=dtype)
+    leave = (occupancy * u).sum(-1)
+    enter = torch.nn.functional.pad(leave[:, :-1], (1, 0))
+    starts = ((enter + leave - (width - 1)) / 2).round().long()
+    return _feasible_band_starts(starts, T, U, width)
+
+
+def gather_band(x, starts, width):
+    """
+    Gathers the band of every frame from a tensor indexed by label position.
+
+    Arguments
+    ---------
+    x : torch.Tensor
+        Tensor of (batch x LabelLength x ...), e.g. the prediction network output.
+    starts : torch.Tensor
+        2D Tensor of (batch x TimeLength) returned by select_band.
+    width : int
+        Number of label positions W kept per frame.
+
+    Returns
+    -------
+    torch.Tensor
+        Tensor of (batch x TimeLength x W x ...). Positions past the end of
+        x repeat its last entry.
+    """
+    w = torch.arange(width, device=starts.device)
+    index = (starts[..., None] + w).clamp(max=x.shape[1] - 1)
+    batch = torch.arange(x.shape[0], device=starts.device)[:, None, None]
+    return x[batch, index]
+
+
+def pruned_lattice_inputs(logits, labels, starts, blank):
+    """
+    Compact log-probs of the pruned lattice, from the joint output evaluated
+    inside the band only.
+
+    Arguments
+    ---------
+    logits : torch.Tensor
+        4D Tensor of (batch x TimeLength x W x outputDim).
+    labels : torch.Tensor
+        2D Tensor of (batch x MaxSeqLabelLength) containing targets of the batch with zero padding.
+    starts : torch.Tensor
+        2D Tensor of (batch x TimeLength) returned by select_band.
+    blank : int
+        Blank index.
+
+    Returns
+    -------
+    torch.Tensor
+        4D Tensor of (batch x TimeLength x W x 2), laid out as COMPACT_BLANK
+        and COMPACT_LABEL.
+    """
+    index = torch.nn.functional.pad(labels.long(), (0, 1), value=blank)
+    index = gather_band(index, starts, logits.shape[2])
+    return LatticeLogProbs.apply(logits, index, blank)
+
+
+def _joint_chunk(joint_fn, x, h, index, blank, starts, width):
+    """Compact log-probs of the frames of one chunk, see chunked_joint."""
+    if starts is None:
+        h = h.unsqueeze(1)
+    else:
+        h = gather_band(h, starts, width)
+    logits = joint_fn(x.unsqueeze(2), h)
+    return LatticeLogProbs.apply(logits, index, blank)
+
+
+def chunked_joint(
+    joint_fn, x, h, labels, blank, chunk_frames, band_starts=None, width=None
+):
+    """
+    Evaluates the joint network and gathers the compact lattice log-probs
+    chunk_frames frames at a time. Each chunk runs under activation
+    checkpointing, so the (batch x chunk x LabelLength x outputDim) logits
+    are only alive while their chunk is computed, in forward and again in
+    backward, and peak memory scales with chunk_frames instead of T.
+
+    Arguments
+    ---------
+    joint_fn : callable
+        Maps the encoder (batch x chunk x 1 x H) and decoder
+        (batch x 1|chunk x LabelLength x H) outputs to the logits.
+    x : torch.Tensor
+        3D Tensor of (batch x TimeLength x H) from the encoder.
+    h : torch.Tensor
+        3D Tensor of (batch x LabelLength x H) from the prediction network.
+    labels : torch.Tensor
+        2D Tensor of (batch x MaxSeqLabelLength) containing targets of the batch with zero padding.
+    blank : int
+        Blank index.
+    chunk_frames : int
+        Number of frames evaluated at once.
+    band_starts : torch.Tensor
+        2D Tensor of (batch x TimeLength) returned by select_band, to only
+        evaluate the joint inside the band. Defaults to the full lattice.
+    width : int
+        Number of label positions W kept per frame, with band_starts.
+
+    Returns
+    -------
+    torch.Tensor
+        4D Tensor of (batch x TimeLength x LabelLength|W x 2), laid out as
+        COMPACT_BLANK and COMPACT_LABEL.
+    """
+    B, maxT, _ = x.shape
+    index = torch.nn.functional.pad(labels.long(), (0, 1), value=blank)
+    if band_starts is None:
+        index = index[:, None, : h.shape[1]].expand(B, maxT, h.shape[1])
+    else:
+        index = gather_band(index, band_starts, width)
+
+    chunks = []
+    for t0 in range(0, maxT, chunk_frames):
+        t1 = min(t0 + chunk_frames, maxT)
+        starts = None if band_starts is None else band_starts[:, t0:t1]
+        chunks.append(
+            checkpoint(
+                _joint_chunk,
+                joint_fn,
+                x[:, t0:t1],
+                h,
+                index[:, t0:t1],
+                blank,
+                starts,
+                width,
+                use_reentrant=False,
+            )
+        )
+    return torch.cat(chunks, dim=1)
+
+
+def _pruned_frames(log_probs, starts, T):
+    """
+    Runs the lattice recursion frame by frame inside the band. Cell w of
+    frame t stands for the label position starts[b, t] + w, so the blank
+    transitions coming from frame t - 1 are shifted by the band move
+    starts[b, t] - starts[b, t - 1].
+
+    Returns
+    -------
+    torch.Tensor
+        2D Tensor of (batch x W) holding alpha[T - 1] + blank_lp[T - 1] in
+        the band of the last frame of every utterance.
+    """
+    B, maxT, width, _ = log_probs.shape
+    neg = _neg_inf(log_probs.dtype)
+    blank_lp = log_probs[..., COMPACT_BLANK]
+    label_lp = log_probs[..., COMPACT_LABEL]
+    w = torch.arange(width, device=log_probs.device)
+    shift = starts.diff(dim=1, prepend=starts[:, :1])
+
+    # virtual frame -1 sending a blank transition into (0, 0)
+    carry = log_probs.new_full((B, width), neg)
+    carry[:, 0] = carry[:, 0].masked_fill(starts[:, 0] == 0, 0.0)
+    last = torch.zeros_like(carry)
+    for t in range(maxT):
+        index = w[None, :] + shift[:, t, None]
+        no_emit = carry.gather(1, index.clamp(max=width - 1))
+        no_emit = torch.where(index < width, no_emit, neg)
+        cum_label = torch.nn.functional.pad(
+            label_lp[:, t, :-1].cumsum(-1), (1, 0)
+        )
+        alpha = cum_label + torch.logcumsumexp(no_emit - cum_label, dim=-1)
+        carry = alpha + blank_lp[:, t]
+        last = torch.where((T == t + 1)[:, None], carry, last)
+    return last
+
+
+def pruned_marginal_prob(log_probs, starts, T, U, maxU):
+    """
+    Per-prefix marginals log_p[b, u] of the pruned lattice, normalized by T.
+    Only the prefixes inside the band of the last frame are reachable.
+
+    Arguments
+    ---------
+    log_probs : torch.Tensor
+        4D Tensor of (batch x TimeLength x W x 2) from pruned_lattice_inputs.
+    starts : torch.Tensor
+        2D Tensor of (batch x TimeLength) returned by select_band.
+    T : torch.Tensor
+        1D Tensor of (batch) containing TimeLength of each target.
+    U : torch.Tensor
+        1D Tensor of (batch) containing LabelLength of each target.
+    maxU : int
+        Number of prefixes of the padded lattice.
+
+    Returns
+    -------
+    log_p : torch.Tensor
+        2D Tensor of (batch x maxU), zero outside of [first[b], U[b]].
+    first : torch.Tensor
+        1D Tensor of (batch) with the shortest reachable prefix.
+    """
+    B, _, width, _ = log_probs.shape
+    T = T.to(log_probs.device).long()
+    U = U.to(log_probs.device).long()
+    last = _pruned_frames(log_probs, starts, T)
+
+    batch = torch.arange(B, device=log_probs.device)
+    first = starts[batch, T - 1]
+    u = torch.arange(maxU, device=log_probs.device)
+    w = u[None, :] - first[:, None]
+    log_p = last.gather(1, w.clamp(0, width - 1)) / T[:, None]
+    valid = (w >= 0) & (u[None, :] <= U[:, None])
+    return torch.where(valid, log_p, 0.0), first
+
+
+def pruned_transducer(log_probs, starts, T, U, reduction):
+    """
+    Transducer loss of the pruned lattice, normalized by T like
+    wavefront_transducer.
+
+    Arguments
+    ---------
+    log_probs : torch.Tensor
+        4D Tensor of (batch x TimeLength x W x 2) from pruned_lattice_inputs.
+    starts : torch.Tensor
+        2D Tensor of (batch x TimeLength) returned by select_band.
+    T : torch.Tensor
+        1D Tensor of (batch) containing TimeLength of each target.
+    U : torch.Tensor
+        1D Tensor of (batch) containing LabelLength of each target.
+    reduction : str
+        Specifies the reduction to apply to the output: 'mean' | 'sum' | 'none'.
+
+    Returns
+    -------
+    torch.Tensor
+        The computed transducer loss.
+    """
+    B = log_probs.shape[0]
+    T = T.to(log_probs.device).long()
+    U = U.to(log_probs.device).long()
+    last = _pruned_frames(log_probs, starts, T)
+
+    batch = torch.arange(B, device=log_probs.device)
+    log_p = last[batch, U - starts[batch, T - 1]] / T
+
+    if reduction == "mean":
+        return -log_p.mean()
+    elif reduction == "sum":
+        return -log_p.sum()
+    elif reduction == "none":
+        return -log_p
+    else:
+        raise Exception("Unexpected reduction {}".format(reduction))
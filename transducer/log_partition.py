@@ -0,0 +1,176 @@
+"""
+Learned log-partition (log Z) of the trajectory balance objective.
+
+One scalar per utterance, or per bucket of target lengths, is kept in an
+embedding table with sparse gradients, so that an optimizer step only reads
+and writes the rows of the current batch (see torch.optim.SparseAdam). The
+rows of the utterances are assigned from the sorted IDs of the training
+manifest, the same on every process, and the mapping from utterance IDs to
+rows is saved with the table by the checkpointer. With DDP, the sparse
+gradients are averaged over the processes before every step, so that all
+the processes hold the same table.
+"""
+
+import torch
+
+from speechbrain.utils.checkpoints import (
+    mark_as_loader,
+    mark_as_saver,
+    register_checkpoint_hooks,
+)
+from speechbrain.utils.distributed import is_distributed_initialized
+
+
+@register_checkpoint_hooks
+class LogPartition(torch.nn.Module):
+    """
+    Table of learned log Z, looked up by utterance ID or target length.
+
+    It is not part of the model optimized by opt_class: dense optimizers do
+    not accept sparse gradients, the table has its own sparse optimizer.
+    The rows are given by register_ids; without it, rows are assigned on
+    first sight, which is only consistent within a single process. With
+    DDP, all_reduce_grad must be called before every step of the optimizer.
+
+    Arguments
+    ---------
+    num_entries : int
+        Number of rows: at least the number of training utterances when
+        keyed by utterance, the number of length buckets otherwise.
+    key : str
+        'utterance' (one log Z per utterance ID) | 'length' (one log Z per
+        bucket of bucket_size target lengths, the last bucket taking the
+        longer targets).
+    bucket_size : int
+        Number of target lengths per bucket when key is 'length'.
+    init : float
+        Initial value of log Z.
+
+    Example
+    -------
+    >>> log_z = LogPartition(num_entries=4)
+    >>> log_z.register_ids(["utt2", "utt1", "utt3"])
+    >>> z = log_z(["utt1", "utt2", "utt1"], torch.tensor([3, 5, 3]))
+    >>> z.sum().backward()
+    >>> log_z.weight.grad.is_sparse, z.shape
+    (True, torch.Size([3]))
+    """
+
+    def __init__(self, num_entries, key="utterance", bucket_size=1, init=0.0):
+        super().__init__()
+        if key not in ("utterance", "length"):
+            raise ValueError("Unexpected key {}".format(key))
+        self.key = key
+        self.bucket_size = bucket_size
+        self.table = torch.nn.Embedding(num_entries, 1, sparse=True)
+        torch.nn.init.constant_(self.table.weight, init)
+        self.rows = {}
+        self._registered = False
+
+    @property
+    def weight(self):
+        return self.table.weight
+
+    def register_ids(self, ids):
+        """
+        Assigns the rows of the utterances from their sorted IDs, so that
+        every process uses the same rows. Nothing is done when keyed by
+        length.
+
+        Arguments
+        ---------
+        ids : iterable
+            IDs of the training utterances, e.g. of the train csv.
+        """
+        if self.key == "length":
+            return
+        ids = sorted(set(ids))
+        if len(ids) > self.table.num_embeddings:
+            raise ValueError(
+                "More than {} utterances in the logZ table".format(
+                    self.table.num_embeddings
+                )
+            )
+        self.rows = {utt_id: row for row, utt_id in enumerate(ids)}
+        self._registered = True
+
+    def _index(self, ids, target_lens):
+        if self.key == "length":
+            index = target_lens.long() // self.bucket_size
+            return index.clamp(max=self.table.num_embeddings - 1)
+
+        for utt_id in ids:
+            if utt_id not in self.rows:
+                if self._registered:
+                    raise ValueError(
+                        "Unexpected utterance {}, not registered in the logZ "
+                        "table".format(utt_id)
+                    )
+                if len(self.rows) == self.table.num_embeddings:
+                    raise ValueError(
+                        "More than {} utterances in the logZ table".format(
+                            self.table.num_embeddings
+                        )
+                    )
+                self.rows[utt_id] = len(self.rows)
+        return torch.tensor([self.rows[utt_id] for utt_id in ids])
+
+    def all_reduce_grad(self):
+        """With DDP, replaces the sparse gradient of the table by its mean
+        over the processes, so that every process applies the same update.
+        Every process must call it, at the same steps."""
+        if not is_distributed_initialized():
+            return
+        # gradient and number of processes having touched every row, dense
+        # as NCCL does not reduce sparse tensors
+        dense = self.weight.new_zeros(self.table.num_embeddings, 2)
+        grad = self.weight.grad
+        if grad is not None:
+            grad = grad.coalesce()
+            rows = grad.indices()[0]
+            dense[rows, 0] = grad.values()[:, 0]
+            dense[rows, 1] = 1.0
+        torch.distributed.all_reduce(dense)
+        rows = dense[:, 1].nonzero().squeeze(1)
+        if not len(rows):
+            self.weight.grad = None
+            return
+        values = dense[rows, :1] / torch.distributed.get_world_size()
+        self.weight.grad = torch.sparse_coo_tensor(
+            rows[None],
+            values,
+            self.weight.shape,
+            check_invariants=False,
+            is_coalesced=True,
+        )
+
+    def forward(self, ids, target_lens):
+        """
+        Looks up log Z for a batch.
+
+        Arguments
+        ---------
+        ids : list
+            Utterance ID of every item of the batch.
+        target_lens : torch.Tensor
+            1D Tensor of (batch) with the absolute length of every target.
+
+        Returns
+        -------
+        torch.Tensor
+            1D Tensor of (batch) with log Z.
+        """
+        index = self._index(ids, target_lens).to(self.weight.device)
+        return self.table(index).squeeze(-1)
+
+    @mark_as_saver
+    def _save(self, path):
+        torch.save({"weight": self.weight.data, "rows": self.rows}, path)
+
+    @mark_as_loader
+    def _load(self, path, end_of_epoch):
+        del end_of_epoch  # Unused here
+        state = torch.load(path, map_location=self.weight.device)
+        self.weight.data.copy_(state["weight"])
+        self.rows = state["rows"]
+        self._registered = self._registered or bool(self.rows)
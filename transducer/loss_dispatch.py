@@ -0,0 +1,300 @@
+"""
+Dispatcher choosing the lattice engine of transducer_cost at run time.
+
+Every engine able to compute the objective on the device of the logits is
+timed on the first batch of each (B, T, U, V, dtype, device) shape bucket
+and loss configuration, and the fastest one is stored in a JSON cache so
+that later runs start on it directly.
+
+With DDP, the processes must run the same engine: they all read the cache
+at construction, and on a bucket missing from it they all run the default
+engine (the first candidate) for the rest of the run. The main process
+alone times the engines of the bucket, for the cache of the next runs.
+"""
+
+import json
+import os
+import time
+
+import torch
+
+from speechbrain.utils.distributed import (
+    if_main_process,
+    is_distributed_initialized,
+)
+from speechbrain.utils.logger import get_logger
+
+from gfn_loss import gfn_loss
+from transducer_loss import transducer_loss
+
+logger = get_logger(__name__)
+
+OBJECTIVES = {"gfn": gfn_loss, "transducer": transducer_loss}
+
+# name -> objectives, devices, availability check and loss kwargs
+ENGINES = {}
+
+
+def register_engine(name, objectives, devices, is_available=None, **kwargs):
+    """
+    Registers a lattice engine with the dispatcher.
+
+    Arguments
+    ---------
+    name : str
+        Name of the engine, as stored in the autotuning cache.
+    objectives : tuple
+        Objectives ('gfn' | 'transducer') the engine can compute.
+    devices : tuple
+        Device types ('cpu' | 'cuda') the engine runs on.
+    is_available : callable
+        Returns False when a dependency of the engine is missing.
+    **kwargs : dict
+        Arguments given to the loss function to select the engine.
+    """
+    ENGINES[name] = {
+        "objectives": tuple(objectives),
+        "devices": tuple(devices),
+        "is_available": is_available or (lambda: True),
+        "kwargs": kwargs,
+    }
+
+
+def _numba_available():
+    try:
+        import numba  # noqa
+    except ImportError:
+        return False
+    return True
+
+
+def _numba_cuda_available():
+    if not _numba_available():
+        return False
+    from numba import cuda
+
+    return cuda.is_available()
+
+
+def _torchaudio_available():
+    try:
+        from torchaudio.functional import rnnt_loss  # noqa
+    except ImportError:
+        return False
+    return True
+
+
+register_engine(
+    "numba-cuda",
+    ("gfn", "transducer"),
+    ("cuda",),
+    _numba_cuda_available,
+    backend="numba",
+    use_torchaudio=False,
+)
+register_engine(
+    "numba-cpu", ("gfn",), ("cpu",), _numba_available, backend="numba"
+)
+register_engine(
+    "torch-wavefront",
+    ("gfn", "transducer"),
+    ("cpu", "cuda"),
+    backend="wavefront",
+    use_torchaudio=False,
+)
+register_engine(
+    "torch-checkpoint", ("gfn",), ("cpu", "cuda"), backend="checkpoint"
+)
+# torchaudio only returns the likelihood of the full labels, not the
+# per-prefix marginals of the GFN objective
+register_engine(
+    "torchaudio",
+    ("transducer",),
+    ("cpu", "cuda"),
+    _torchaudio_available,
+    use_torchaudio=True,
+)
+
+
+def _pow2(x):
+    """Smallest power of two >= x."""
+    return 1 << max(int(x) - 1, 0).bit_length()
+
+
+class TransducerCost:
+    """
+    Callable computing transducer_cost with the fastest registered engine.
+
+    Arguments
+    ---------
+    objective : str
+        Loss to compute: 'gfn' (gfn_loss) | 'transducer' (transducer_loss).
+    cache_file : str
+        JSON file keeping the fastest engine of every shape bucket across
+        runs. Nothing is persisted if None.
+    engines : list
+        Names of the engines to choose from. Defaults to every registered
+        engine supporting the objective.
+    **loss_kwargs : dict
+        Arguments of the loss function, e.g. blank_index or reduction.
+
+    Example
+    -------
+    >>> cost = TransducerCost(objective="transducer", blank_index=0)
+    >>> logits = torch.randn((1, 2, 3, 5)).requires_grad_()
+    >>> labels = torch.Tensor([[1, 2]]).int()
+    >>> lens = torch.ones(1)
+    >>> l = cost(logits, labels, None, lens, lens)
+    >>> l.backward()
+    """
+
+    def __init__(
+        self, objective="gfn", cache_file=None, engines=None, **loss_kwargs
+    ):
+        if objective not in OBJECTIVES:
+            raise ValueError("Unexpected objective {}".format(objective))
+        self.objective = objective
+        self.cache_file = cache_file
+        self.engines = engines
+        self.loss_kwargs = loss_kwargs
+        self.cache = {}
+        if cache_file is not None and os.path.isfile(cache_file):
+            with open(cache_file, encoding="utf-8") as fin:
+                self.cache = json.load(fin)
+        # buckets tuned during a DDP run, only used by the next runs
+        self.tuned = {}
+
+    def __call__(
+        self, logits, targets, log_r, input_lens, target_lens, **kwargs
+    ):
+        """Computes the loss, autotuning the engine on a new shape bucket."""
+        kwargs = {**self.loss_kwargs, **kwargs}
+        args = (logits, targets, log_r, input_lens, target_lens)
+        if kwargs.get("band_starts") is not None:
+            # the pruned lattice has a single engine
+            return self._loss(None, *args, **kwargs)
+
+        key = self._bucket(logits, kwargs)
+        candidates = self._candidates(logits, kwargs)
+        engine = self.cache.get(key)
+        if engine not in candidates:
+            if not is_distributed_initialized():
+                engine = self._autotune(key, candidates, *args, **kwargs)
+                self.cache[key] = engine
+                self._save()
+            else:
+                if if_main_process() and key not in self.tuned:
+                    self.tuned[key] = self._autotune(
+                        key, candidates, *args, **kwargs
+                    )
+                    self._save()
+                engine = candidates[0]
+        return self._loss(engine, *args, **kwargs)
+
+    def _loss(
+        self, engine, logits, targets, log_r, input_lens, target_lens, **kwargs
+    ):
+        if engine is not None:
+            kwargs.update(ENGINES[engine]["kwargs"])
+        if self.objective == "gfn":
+            return gfn_loss(
+                logits, targets, log_r, input_lens, target_lens, **kwargs
+            )
+        return transducer_loss(
+            logits, targets, input_lens, target_lens, **kwargs
+        )
+
+    def _bucket(self, logits, kwargs):
+        B, T, U, V = logits.shape
+        key = "{}-B{}-T{}-U{}-V{}-{}-{}".format(
+            self.objective,
+            _pow2(B),
+            _pow2(T),
+            _pow2(U),
+            V,
+            str(logits.dtype).replace("torch.", ""),
+            logits.device.type,
+        )
+        # the loss arguments changing the work of the engines
+        flags = [
+            name
+            for name in ("compact", "recompute", "gathered")
+            if kwargs.get(name)
+        ]
+        if kwargs.get("subtb_lambda") is not None:
+            flags.append("subtb")
+        if kwargs.get("log_z") is not None:
+            flags.append("logz")
+        if kwargs.get("checkpoint_frames"):
+            flags.append("ckpt{}".format(kwargs["checkpoint_frames"]))
+        return "-".join([key] + flags)
+
+    def _candidates(self, logits, kwargs):
+        candidates = []
+        for name in self.engines or ENGINES:
+            engine = ENGINES[name]
+            if (
+                self.objective in engine["objectives"]
+                and logits.device.type in engine["devices"]
+                and not (kwargs.get("gathered") and name == "torchaudio")
+                and engine["is_available"]()
+            ):
+                candidates.append(name)
+        if not candidates:
+            raise ValueError(
+                "No {} engine available on {}".format(
+                    self.objective, logits.device.type
+                )
+            )
+        return candidates
+
+    def _time(self, engine, logits, *args, **kwargs):
+        # timing runs must not leave gradients in learned inputs (log_z)
+        logits = logits.detach().requires_grad_()
+        kwargs = {
+            k: v.detach() if torch.is_tensor(v) else v
+            for k, v in kwargs.items()
+        }
+        if logits.is_cuda:
+            torch.cuda.synchronize(logits.device)
+        start = time.perf_counter()
+        with torch.enable_grad():
+            self._loss(engine, logits, *args, **kwargs).backward()
+        if logits.is_cuda:
+            torch.cuda.synchronize(logits.device)
+        return time.perf_counter() - start
+
+    def _autotune(self, key, candidates, *args, **kwargs):
+        timings = {}
+        for engine in candidates:
+            try:
+                # the first call includes the compilation of numba kernels
+                self._time(engine, *args, **kwargs)
+                timings[engine] = self._time(engine, *args, **kwargs)
+            except Exception as e:
+                logger.warning("Engine %s failed on %s: %s", engine, key, e)
+        if not timings:
+            raise RuntimeError("Every engine failed on {}".format(key))
+
+        engine = min(timings, key=timings.get)
+        logger.info(
+            "Autotuned %s: %s (%s)",
+            key,
+            engine,
+            ", ".join(
+                "{} {:.2f} ms".format(k, v * 1000) for k, v in timings.items()
+            ),
+        )
+        return engine
+
+    def _save(self):
+        if self.cache_file is None or not if_main_process():
+            return
+        folder = os.path.dirname(os.path.abspath(self.cache_file))
+        os.makedirs(folder, exist_ok=True)
+        tmp_file = self.cache_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as fout:
+            json.dump(
+                {**self.tuned, **self.cache}, fout, indent=2, sort_keys=True
+            )
+        os.replace(tmp_file, self.cache_file)
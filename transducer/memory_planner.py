@@ -0,0 +1,363 @@
+"""
+Model of the peak device memory of a training step of the transducer recipe.
+
+The peak is dominated by the (B, T, U, joint_dim) activations of the joint
+network and the (B, T, U, output_neurons) logits with their gradients, next
+to the encoder (B, T) and decoder (B, U) activations and the static memory
+of the weights and optimizer states. The lattice tensors all grow as
+B * T * U, so their bytes are summed analytically into one term. The peak
+is modelled as a linear combination of the four terms, whose coefficients
+are fitted by least squares on the peaks observed during the first steps of
+training on the current device, and stored in a JSON file for later runs.
+
+The terms are fitted on the shapes actually fed to the joint network and the
+loss, after augmentation: the waveform augmentation concatenates the clean
+batch, the feature augmentation replicates it, and speed perturbation
+stretches the utterances. The largest replication and stretch observed map
+the batches of the manifest (durations, token counts) to these shapes.
+"""
+
+import json
+import math
+import os
+import zlib
+
+import numpy as np
+import torch
+
+from speechbrain.utils.distributed import if_main_process
+from speechbrain.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+FEATURES = ("static", "encoder", "decoder", "lattice")
+
+_ITEMSIZE = {"fp32": 4, "fp16": 2, "bf16": 2}
+
+
+class TransducerMemoryModel:
+    """
+    Predicts the peak bytes allocated by a training step from the durations
+    and token counts of its batch.
+
+    Arguments
+    ---------
+    joint_dim : int
+        Output size of the joint network.
+    output_neurons : int
+        Size of the vocabulary, blank included.
+    precision : str
+        'fp32' | 'fp16' | 'bf16', the precision of the activations.
+    sample_rate : int
+        Sample rate of the audio.
+    hop_length : float
+        Hop of the features, in milliseconds.
+    subsampling : int
+        Time subsampling of the CNN front-end.
+    prune_width : int
+        Width of the pruned lattice, 0 for the full lattice.
+    joint_chunk_frames : int
+        Frames per chunk of the joint network, 0 for no chunking.
+    model_config : dict
+        Other hyperparameters shaping the memory of a step, e.g. the sizes
+        of the encoder and the augmentations.
+    cache_file : str
+        JSON file keeping the fitted coefficients of every device and
+        configuration: a fit is only reused with the same precision,
+        arguments above and model_config.
+    calibration_steps : int
+        Number of observed steps before the coefficients are fitted.
+    headroom : float
+        Fraction of the device memory that batches may fill.
+
+    Example
+    -------
+    >>> model = TransducerMemoryModel(joint_dim=8, output_neurons=10)
+    >>> peak = lambda B, T, U: 1e6 + 1.5 * model.shape_features(B, T, U)[3]
+    >>> for B in range(1, 9):
+    ...     shape = (2 * B, model.frames(0.5 * B), 3 + B % 3)  # augmented
+    ...     model.observe(B, 0.5 * B, shape, peak(*shape))
+    >>> model.calibrate()
+    >>> model.replicas, model.stretch
+    (2.0, 1.0)
+    >>> expected = peak(4, model.frames(2.0), 6)
+    >>> round(float(model.predict([1.5, 2.0], [4, 6]) / expected), 3)
+    1.0
+    >>> capacity = peak(4, model.frames(2.0), 4)
+    >>> model.split([1.0, 2.0, 3.0], [4, 4, 4], capacity=capacity)
+    [[0, 1], [2]]
+    """
+
+    def __init__(
+        self,
+        joint_dim,
+        output_neurons,
+        precision="fp32",
+        sample_rate=16000,
+        hop_length=10,
+        subsampling=4,
+        prune_width=0,
+        joint_chunk_frames=0,
+        model_config=None,
+        cache_file=None,
+        calibration_steps=50,
+        headroom=0.9,
+    ):
+        if precision not in _ITEMSIZE:
+            raise ValueError("Unexpected precision {}".format(precision))
+        self.joint_dim = joint_dim
+        self.output_neurons = output_neurons
+        self.itemsize = _ITEMSIZE[precision]
+        self.sample_rate = sample_rate
+        self.hop_length = hop_length
+        self.subsampling = subsampling
+        self.prune_width = prune_width
+        self.joint_chunk_frames = joint_chunk_frames
+        self.config = {
+            "joint_dim": joint_dim,
+            "output_neurons": output_neurons,
+            "precision": precision,
+            "sample_rate": sample_rate,
+            "hop_length": hop_length,
+            "subsampling": subsampling,
+            "prune_width": prune_width,
+            "joint_chunk_frames": joint_chunk_frames,
+            "model": model_config or {},
+        }
+        self.cache_file = cache_file
+        self.calibration_steps = calibration_steps
+        self.headroom = headroom
+        self.samples = []
+
+        # uncalibrated: the lattice term only, of the batches as they are
+        self.coef = np.array([0.0, 0.0, 0.0, 1.0])
+        self.replicas = 1.0
+        self.stretch = 1.0
+        self.calibrated = False
+        if cache_file is not None and os.path.isfile(cache_file):
+            with open(cache_file, encoding="utf-8") as fin:
+                cache = json.load(fin)
+            if self._device_key() in cache:
+                entry = cache[self._device_key()]
+                self.coef = np.array(entry["coef"])
+                self.replicas = entry.get("replicas", 1.0)
+                self.stretch = entry.get("stretch", 1.0)
+                self.calibrated = True
+
+    def frames(self, duration):
+        """Number of encoder frames of an utterance of duration seconds."""
+        frames = duration * 1000 / self.hop_length + 1
+        return math.ceil(frames / self.subsampling)
+
+    def features(self, batch_size, max_duration, max_tokens):
+        """
+        Terms of the memory model of a padded batch of the manifest, once
+        augmented.
+
+        Arguments
+        ---------
+        batch_size : int
+            Number of utterances.
+        max_duration : float
+            Longest utterance, in seconds.
+        max_tokens : int
+            Longest target, in tokens.
+
+        Returns
+        -------
+        numpy.ndarray
+            One value per name of FEATURES, see shape_features.
+        """
+        return self.shape_features(
+            math.ceil(batch_size * self.replicas),
+            math.ceil(self.frames(max_duration) * self.stretch),
+            max_tokens,
+        )
+
+    def shape_features(self, batch_size, frames, max_tokens):
+        """
+        Terms of the memory model of a lattice of the given shape.
+
+        Arguments
+        ---------
+        batch_size : int
+            Number of utterances B fed to the joint network.
+        frames : int
+            Number of encoder frames T.
+        max_tokens : int
+            Longest target, in tokens.
+
+        Returns
+        -------
+        numpy.ndarray
+            One value per name of FEATURES: 1, B * T, B * U and the bytes of
+            the lattice tensors.
+        """
+        B = batch_size
+        T = frames
+        U = max_tokens + 1
+        if self.prune_width:
+            U = min(U, self.prune_width)
+        joint_T = (
+            min(T, self.joint_chunk_frames) if self.joint_chunk_frames else T
+        )
+        # joint output, tanh and gradient, logits, log-softmax and their
+        # gradients for the frames held at once, and the float32
+        # blank/label log-probs, alpha and gradients of the whole lattice
+        joint = 3 * self.joint_dim + 4 * self.output_neurons
+        lattice = B * joint_T * U * self.itemsize * joint + B * T * U * 4 * 6
+        return np.array([1.0, B * T, B * U, lattice], dtype=np.float64)
+
+    def predict(self, durations, token_counts):
+        """
+        Predicted peak bytes of a batch.
+
+        Arguments
+        ---------
+        durations : list
+            Duration of every utterance, in seconds.
+        token_counts : list
+            Number of tokens of every target.
+
+        Returns
+        -------
+        float
+            Peak bytes.
+        """
+        feats = self.features(
+            len(durations), max(durations), max(token_counts)
+        )
+        return float(feats @ self.coef)
+
+    def capacity(self, device=None):
+        """Bytes that batches may fill on the device."""
+        total = torch.cuda.get_device_properties(device).total_memory
+        return self.headroom * total
+
+    def fits(self, durations, token_counts, capacity=None):
+        """Whether a batch fits in capacity bytes (default: the device)."""
+        if capacity is None:
+            capacity = self.capacity()
+        return self.predict(durations, token_counts) <= capacity
+
+    def split(self, durations, token_counts, capacity=None):
+        """
+        Splits a batch, in its order, into micro-batches that fit.
+
+        Arguments
+        ---------
+        durations : list
+            Duration of every utterance, in seconds.
+        token_counts : list
+            Number of tokens of every target.
+        capacity : float
+            Bytes available, defaults to the device capacity.
+
+        Returns
+        -------
+        list
+            Lists of indices of the micro-batches.
+        """
+        if capacity is None:
+            capacity = self.capacity()
+        batches, current = [], []
+        max_duration, max_tokens = 0.0, 0
+        for i, (duration, tokens) in enumerate(zip(durations, token_counts)):
+            d = max(max_duration, duration)
+            u = max(max_tokens, tokens)
+            feats = self.features(len(current) + 1, d, u)
+            if current and feats @ self.coef > capacity:
+                batches.append(current)
+                current, d, u = [], duration, tokens
+            current.append(i)
+            max_duration, max_tokens = d, u
+        if current:
+            batches.append(current)
+        return batches
+
+    def observe(self, batch_size, max_duration, lattice_shape, peak_bytes):
+        """
+        Records the peak of a step, and fits the model once
+        calibration_steps steps have been observed.
+
+        Arguments
+        ---------
+        batch_size : int
+            Number of utterances of the batch, before augmentation.
+        max_duration : float
+            Longest utterance of the batch, in seconds.
+        lattice_shape : tuple
+            (B, T, U) fed to the joint network and the loss: utterances
+            after augmentation, encoder frames and longest target in tokens.
+        peak_bytes : int
+            Peak bytes allocated by the step, e.g.
+            torch.cuda.max_memory_allocated().
+        """
+        B, T, U = lattice_shape
+        self.replicas = max(self.replicas, B / batch_size)
+        self.stretch = max(self.stretch, T / self.frames(max_duration))
+        feats = self.shape_features(B, T, U)
+        self.samples.append((feats, float(peak_bytes)))
+        if not self.calibrated and len(self.samples) >= self.calibration_steps:
+            self.calibrate()
+
+    def calibrate(self):
+        """Fits the coefficients on the observed steps, by least squares
+        with non-negative coefficients."""
+        X = np.stack([feats for feats, _ in self.samples])
+        y = np.array([peak for _, peak in self.samples])
+        scale = np.abs(X).max(axis=0)
+        scale[scale == 0] = 1.0
+        X = X / scale
+
+        # least squares on the terms left after dropping the negative ones
+        active = np.ones(X.shape[1], dtype=bool)
+        coef = np.zeros(X.shape[1])
+        while active.any():
+            fit = np.linalg.lstsq(X[:, active], y, rcond=None)[0]
+            if (fit >= 0).all():
+                coef[active] = fit
+                break
+            active[np.flatnonzero(active)[fit < 0]] = False
+
+        self.coef = coef / scale
+        self.calibrated = True
+        residual = np.abs(X @ coef - y).max() / max(y.max(), 1.0)
+        logger.info(
+            "Memory model calibrated on %d steps (max error %.1f%%): %s",
+            len(self.samples),
+            100 * residual,
+            ", ".join(
+                "{} {:.3g}".format(n, c) for n, c in zip(FEATURES, self.coef)
+            ),
+        )
+        self._save()
+
+    def _device_key(self):
+        if torch.cuda.is_available():
+            name = torch.cuda.get_device_name()
+        else:
+            name = "cpu"
+        config = json.dumps(self.config, sort_keys=True).encode()
+        return "{}-{}-{:08x}".format(name, self.itemsize, zlib.crc32(config))
+
+    def _save(self):
+        if self.cache_file is None or not if_main_process():
+            return
+        cache = {}
+        if os.path.isfile(self.cache_file):
+            with open(self.cache_file, encoding="utf-8") as fin:
+                cache = json.load(fin)
+        cache[self._device_key()] = {
+            "coef": self.coef.tolist(),
+            "replicas": self.replicas,
+            "stretch": self.stretch,
+            "steps": len(self.samples),
+            "config": self.config,
+        }
+        folder = os.path.dirname(os.path.abspath(self.cache_file))
+        os.makedirs(folder, exist_ok=True)
+        tmp_file = self.cache_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as fout:
+            json.dump(cache, fout, indent=2, sort_keys=True)
+        os.replace(tmp_file, self.cache_file)
@@ -0,0 +1,153 @@
+"""
+Training metrics accumulated on the device.
+
+Reading a loss on the host (print, float, .item(), .cpu()) waits for every
+kernel queued before it, so doing it at every step stalls the accelerator.
+Here, the loss components are summed into device tensors, and every N steps
+the sums are copied to pinned host memory without blocking. The copy is
+read, and logged, at a later step once its CUDA event has completed.
+"""
+
+import torch
+
+
+class DeviceMetrics:
+    """
+    Running sums of training metrics, flushed to a train logger
+    asynchronously every flush_every steps. Non-finite values are left out
+    of the averages.
+
+    Arguments
+    ---------
+    train_logger : speechbrain.utils.train_logger.TrainLogger
+        Logger receiving the averages of every window of flush_every steps.
+        Nothing is logged if None.
+    flush_every : int
+        Number of steps between two copies of the sums to the host.
+
+    Example
+    -------
+    >>> metrics = DeviceMetrics(flush_every=2)
+    >>> for step in range(1, 5):
+    ...     metrics.append(loss=torch.tensor(float(step)), ctc=None)
+    ...     metrics.step(step)
+    >>> metrics.last
+    {'loss': 3.5}
+    >>> metrics.summarize()
+    {'loss': 2.5}
+    """
+
+    def __init__(self, train_logger=None, flush_every=100):
+        self.train_logger = train_logger
+        self.flush_every = flush_every
+        # name -> device tensor [sum, count] of the current window
+        self._sums = {}
+        # windows copied to the host: step, names, host tensor, CUDA event
+        self._pending = []
+        # name -> [sum, count] of the windows read on the host
+        self.totals = {}
+        # averages of the last window read on the host
+        self.last = {}
+
+    def append(self, **values):
+        """
+        Adds values to the sums, without synchronizing with the device.
+
+        Arguments
+        ---------
+        **values : dict
+            Tensors, averaged over their elements. Other values (e.g. a loss
+            set to 0.0 when disabled) are ignored.
+        """
+        for name, value in values.items():
+            if not torch.is_tensor(value):
+                continue
+            value = value.detach().float().flatten()
+            finite = torch.isfinite(value)
+            stat = torch.stack(
+                (torch.where(finite, value, 0.0).sum(), finite.sum().float())
+            )
+            if name in self._sums:
+                stat = stat + self._sums[name]
+            self._sums[name] = stat
+
+    def step(self, step):
+        """
+        Called once per training step: starts the copy of the window every
+        flush_every steps, and logs the windows whose copy has completed.
+
+        Arguments
+        ---------
+        step : int
+            Current training step.
+        """
+        if step % self.flush_every == 0:
+            self._launch(step)
+        self._poll()
+
+    def average(self, name):
+        """Average of a metric over the windows read on the host so far."""
+        total, count = self.totals.get(name, (0.0, 0.0))
+        return total / count if count else 0.0
+
+    def summarize(self, step=None):
+        """
+        Reads every pending window, waiting for the device, and resets.
+
+        Arguments
+        ---------
+        step : int
+            Current training step, logged with the last window.
+
+        Returns
+        -------
+        dict
+            Average of every metric since the last summarize.
+        """
+        self._launch(step)
+        self._poll(wait=True)
+        averages = {name: self.average(name) for name in self.totals}
+        self.totals = {}
+        self.last = {}
+        return averages
+
+    def _launch(self, step):
+        if not self._sums:
+            return
+        names = list(self._sums)
+        stats = torch.stack([self._sums[name] for name in names])
+        event = None
+        if stats.is_cuda:
+            host = torch.empty(stats.shape, pin_memory=True)
+            host.copy_(stats, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+        else:
+            host = stats
+        self._pending.append((step, names, host, event))
+        self._sums = {}
+
+    def _poll(self, wait=False):
+        while self._pending:
+            step, names, host, event = self._pending[0]
+            if event is not None:
+                if wait:
+                    event.synchronize()
+                elif not event.query():
+                    break
+            self._pending.pop(0)
+
+            stats = {}
+            for name, (total, count) in zip(names, host.tolist()):
+                totals = self.totals.setdefault(name, [0.0, 0.0])
+                totals[0] += total
+                totals[1] += count
+                if count:
+                    stats[name] = total / count
+            self.last = stats
+            if self.train_logger is not None and stats:
+                self.train_logger.log_stats(
+                    stats_meta={"step": step},
+                    train_stats=stats,
+                    verbose=False,
+                )
@@ -0,0 +1,229 @@
+"""
+Opt-in profiler of the stages of the training and evaluation steps.
+
+Every stage of compute_forward and compute_objectives (features,
+augmentation, encoder, joint, loss, ...) is timed with a pair of CUDA events
+on the GPU, perf_counter on CPU, so the host never waits for the device
+while profiling. A step is resolved once all its events have completed; it
+is then written as one line of a rolling JSONL file, along with the tensor
+shapes and padding ratios recorded during the step. A table summarizing
+every stage is logged at the end of each epoch.
+"""
+
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import torch
+
+from speechbrain.utils.distributed import if_main_process
+from speechbrain.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class StepProfiler:
+    """
+    Times the named stages of every step.
+
+    Arguments
+    ---------
+    path : str
+        JSONL file receiving one line per step, e.g. in output_folder.
+        Written by the main process only. Nothing is written if None.
+    enabled : bool
+        If False, stage and record do nothing.
+    max_bytes : int
+        Size at which the JSONL file is rotated to path + '.1'.
+
+    Example
+    -------
+    >>> profiler = StepProfiler()
+    >>> with profiler.stage("enc"):
+    ...     x = torch.rand(4, 8).sum()
+    >>> profiler.record(B=4, padding=torch.tensor(0.25))
+    >>> profiler.step("TRAIN")
+    >>> sorted(profiler.summary()["TRAIN"]["stages"])
+    ['enc', 'step']
+    """
+
+    def __init__(self, path=None, enabled=True, max_bytes=64 << 20):
+        self.path = path
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self._timers = []
+        self._values = {}
+        self._pending = []
+        # stage -> name -> durations (ms) or values of the resolved steps
+        self._durations = defaultdict(lambda: defaultdict(list))
+        self._records = defaultdict(lambda: defaultdict(list))
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the enclosed code as the stage name of the current step.
+
+        Arguments
+        ---------
+        name : str
+            Name of the stage, e.g. 'enc'.
+        """
+        if not self.enabled:
+            yield
+            return
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            start = torch.cuda.Event(enable_timing=True)
+            end = torch.cuda.Event(enable_timing=True)
+            start.record()
+            yield
+            end.record()
+        else:
+            start = time.perf_counter()
+            yield
+            end = time.perf_counter()
+        self._timers.append((name, start, end))
+
+    def record(self, **values):
+        """
+        Records values of the current step, e.g. shapes or padding ratios.
+        Tensors are read on the host once the step has completed.
+        """
+        if self.enabled:
+            self._values.update(values)
+
+    def step(self, stage):
+        """
+        Closes the current step, and writes the steps that have completed.
+
+        Arguments
+        ---------
+        stage : sb.Stage | str
+            Stage of the step, e.g. sb.Stage.TRAIN.
+        """
+        if not self.enabled or not self._timers:
+            return
+        stage = getattr(stage, "name", str(stage))
+        self._pending.append((stage, self._timers, self._values))
+        self._timers = []
+        self._values = {}
+        self._poll()
+
+    def summary(self):
+        """
+        Waits for the pending steps, logs a table of the stage timings and
+        resets the statistics.
+
+        Returns
+        -------
+        dict
+            Stage -> 'stages' (name -> calls, mean, p50 and p95 ms) and
+            'values' (name -> mean of the recorded values).
+        """
+        if not self.enabled:
+            return {}
+        self._poll(wait=True)
+        summary = {}
+        for stage, durations in self._durations.items():
+            stages = {}
+            for name, times in durations.items():
+                times = sorted(times)
+                stages[name] = {
+                    "calls": len(times),
+                    "mean": sum(times) / len(times),
+                    "p50": times[len(times) // 2],
+                    "p95": times[min(int(len(times) * 0.95), len(times) - 1)],
+                }
+            values = {
+                name: sum(v) / len(v)
+                for name, v in self._records[stage].items()
+                if v
+            }
+            summary[stage] = {"stages": stages, "values": values}
+            logger.info(_table(stage, stages, values))
+        self._durations.clear()
+        self._records.clear()
+        return summary
+
+    def _poll(self, wait=False):
+        lines = []
+        while self._pending:
+            stage, timers, values = self._pending[0]
+            end = timers[-1][2]
+            if isinstance(end, torch.cuda.Event):
+                if wait:
+                    end.synchronize()
+                elif not end.query():
+                    break
+            self._pending.pop(0)
+            lines.append(self._resolve(stage, timers, values))
+        if lines and self.path is not None and if_main_process():
+            self._write(lines)
+
+    def _resolve(self, stage, timers, values):
+        stages = defaultdict(float)
+        for name, start, end in timers:
+            if isinstance(start, torch.cuda.Event):
+                stages[name] += start.elapsed_time(end)
+            else:
+                stages[name] += (end - start) * 1000
+        first, last = timers[0][1], timers[-1][2]
+        if isinstance(first, torch.cuda.Event):
+            stages["step"] = first.elapsed_time(last)
+        else:
+            stages["step"] = (last - first) * 1000
+
+        values = {
+            k: v.tolist() if torch.is_tensor(v) else v
+            for k, v in values.items()
+        }
+        for name, ms in stages.items():
+            self._durations[stage][name].append(ms)
+        for name, value in values.items():
+            if isinstance(value, (int, float)):
+                self._records[stage][name].append(value)
+        return {"stage": stage, "ms": stages, **values}
+
+    def _write(self, lines):
+        folder = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(folder, exist_ok=True)
+        if (
+            os.path.isfile(self.path)
+            and os.path.getsize(self.path) > self.max_bytes
+        ):
+            os.replace(self.path, self.path + ".1")
+        with open(self.path, "a", encoding="utf-8") as fout:
+            for line in lines:
+                fout.write(json.dumps(line) + "\n")
+
+
+def _table(stage, stages, values):
+    """Formats the summary of a stage."""
+    step = stages.get("step", {}).get("mean", 0.0) or 1.0
+    rows = ["{} step profile".format(stage)]
+    rows.append(
+        "{:<16}{:>8}{:>10}{:>10}{:>10}{:>8}".format(
+            "stage", "calls", "mean ms", "p50 ms", "p95 ms", "%"
+        )
+    )
+    for name, s in sorted(stages.items(), key=lambda x: -x[1]["mean"]):
+        rows.append(
+            "{:<16}{:>8}{:>10.2f}{:>10.2f}{:>10.2f}{:>8.1f}".format(
+                name,
+                s["calls"],
+                s["mean"],
+                s["p50"],
+                s["p95"],
+                100 * s["mean"] / step,
+            )
+        )
+    if values:
+        rows.append(
+            ", ".join("{} {:.3g}".format(k, v) for k, v in values.items())
+        )
+    return "\n".join(rows)
+
+
+# profiler used when none is configured
+NO_PROFILER = StepProfiler(enabled=False)
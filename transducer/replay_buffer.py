@@ -0,0 +1,447 @@
+"""
+Replay buffer keeping past trajectories for off-policy GFN training.
+
+Trajectories are stored without any per-item Python object: the tokens of
+all trajectories are concatenated in one flat int16/int32 arena, addressed
+by per-slot offset and length arrays, next to float32 reward and log-prob
+arrays. Prioritized sampling walks a sum-tree over the slots for the whole
+mini-batch at once. Every array can be backed by a memory-mapped file.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from speechbrain.utils.distributed import get_rank
+
+# Bytes of per-slot bookkeeping: offset, seq, key, fifo ring (int64), length
+# (int32), log_r, log_pf (float32), free list (int64) and up to four sum-tree
+# nodes (float64), the tree being padded to a power of two
+_TREE_BYTES = 4 * 8
+_SLOT_BYTES = 8 + 8 + 8 + 8 + 4 + 4 + 4 + 8 + _TREE_BYTES
+
+
+class _SumTree:
+    """Binary tree of partial sums over the slot priorities."""
+
+    def __init__(self, capacity, alloc):
+        self.size = 1 << max(int(capacity) - 1, 0).bit_length()
+        self.tree = alloc("tree", 2 * self.size, np.float64)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def set(self, index, value):
+        nodes = np.asarray(index, dtype=np.int64) + self.size
+        self.tree[nodes] = value
+        nodes = np.unique(nodes // 2)
+        while nodes.size:
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+            if nodes[0] == 1:
+                break
+            nodes = np.unique(nodes // 2)
+
+    def sample(self, n, rng):
+        mass = rng.random(n) * self.total * (1 - 1e-12)
+        nodes = np.ones(n, dtype=np.int64)
+        while nodes[0] < self.size:
+            left = self.tree[2 * nodes]
+            right = mass >= left
+            mass = np.where(right, mass - left, mass)
+            nodes = 2 * nodes + right
+        return nodes - self.size
+
+
+class ReplayBuffer:
+    """
+    Fixed byte-budget store of trajectories (token sequences) with their
+    log-reward and the log-prob of the policy that sampled them.
+
+    When the budget is exhausted, 'fifo' eviction drops the oldest
+    trajectories; the arena is then used as a ring, so no token is ever
+    copied. 'reservoir' eviction keeps a uniform sample of every trajectory
+    ever added: the n-th one is admitted with probability len(buffer) / n
+    and replaces random victims. Fragmented space is reclaimed by compacting
+    the arena, after evicting an extra 1/8 of it so that compactions stay rare.
+
+    Sampling draws slots with probability proportional to
+    exp(priority_alpha * log_r), priority_alpha = 0 being uniform.
+
+    Arguments
+    ---------
+    max_bytes : int
+        Memory budget of the buffer, bookkeeping included.
+    mean_length : int
+        Expected number of tokens per trajectory, to split the budget
+        between the token arena and the per-trajectory slots.
+    eviction : str
+        'fifo' | 'reservoir'.
+    priority_alpha : float
+        Sharpness of the prioritization by reward.
+    token_dtype : str
+        'int16' (vocabularies up to 32767 tokens) | 'int32'.
+    path : str
+        Optional folder of memory-mapped files backing the arrays. Every
+        process (DDP) keeps its own buffer, in the subfolder rank<N>. An
+        existing buffer is reopened, with the same max_bytes, mean_length
+        and token_dtype.
+    seed : int
+        Seed of the eviction and sampling random generator.
+
+    Example
+    -------
+    >>> buffer = ReplayBuffer(max_bytes=1 << 16)
+    >>> buffer.add(np.array([[3, 4, 5], [6, 7, 0]]), np.array([3, 2]), np.array([-0.1, -2.0]))
+    >>> len(buffer)
+    2
+    >>> batch = buffer.sample(4)
+    >>> batch["tokens"].shape[0], batch["lengths"].shape
+    (4, (4,))
+    """
+
+    def __init__(
+        self,
+        max_bytes,
+        mean_length=32,
+        eviction="fifo",
+        priority_alpha=1.0,
+        token_dtype="int16",
+        path=None,
+        seed=None,
+    ):
+        if eviction not in ("fifo", "reservoir"):
+            raise ValueError("Unexpected eviction {}".format(eviction))
+        self.eviction = eviction
+        self.priority_alpha = priority_alpha
+        self.token_dtype = np.dtype(token_dtype)
+        if path is not None:
+            path = os.path.join(path, "rank{}".format(get_rank() or 0))
+        self.path = path
+        self.rng = np.random.default_rng(seed)
+
+        per_slot = _SLOT_BYTES + mean_length * self.token_dtype.itemsize
+        self.capacity = max(int(max_bytes) // per_slot, 1)
+
+        reopen = path is not None and os.path.isfile(self._state_file)
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+        self._reopen = reopen
+        if reopen:
+            with open(self._state_file, encoding="utf-8") as fin:
+                state = json.load(fin)
+            layout = (self.capacity, int(max_bytes), self.token_dtype.name)
+            stored = (
+                state.pop("capacity"),
+                state.pop("max_bytes"),
+                state.pop("token_dtype"),
+            )
+            if stored != layout:
+                raise ValueError(
+                    "Unexpected replay buffer layout in {}: (capacity, "
+                    "max_bytes, token_dtype) = {}, expected {}".format(
+                        path, stored, layout
+                    )
+                )
+        self.max_bytes = int(max_bytes)
+        self.tree = _SumTree(self.capacity, self._alloc)
+        slot_bytes = (
+            self.capacity * (_SLOT_BYTES - _TREE_BYTES) + self.tree.tree.nbytes
+        )
+        arena = (int(max_bytes) - slot_bytes) // self.token_dtype.itemsize
+        self.arena = self._alloc("tokens", max(arena, 1), self.token_dtype)
+
+        self.offsets = self._alloc("offsets", self.capacity, np.int64)
+        self.lengths = self._alloc("lengths", self.capacity, np.int32)
+        self.log_r = self._alloc("log_r", self.capacity, np.float32)
+        self.log_pf = self._alloc("log_pf", self.capacity, np.float32)
+        self.keys = self._alloc("keys", self.capacity, np.int64)
+        # insertion number of every slot, -1 for a free slot
+        self.seq = self._alloc("seq", self.capacity, np.int64)
+        # slots by insertion number, for fifo eviction
+        self.fifo = self._alloc("fifo", self.capacity, np.int64)
+        # stack of free slots
+        self.free = self._alloc("free", self.capacity, np.int64)
+
+        if reopen:
+            self.__dict__.update(state)
+        else:
+            self.seq[:] = -1
+            self.free[:] = np.arange(self.capacity - 1, -1, -1)
+            self.n_free = self.capacity
+            self.n_seen = 0
+            self.next_seq = 0
+            self.oldest_seq = 0
+            self.end = 0
+            self.live_tokens = 0
+        # slots whose priority changed and trajectories not copied yet, both
+        # written once per call of add
+        self._touched = []
+        self._pending = []
+        self._tokens = None
+
+    @property
+    def _state_file(self):
+        return os.path.join(self.path, "state.json")
+
+    def _alloc(self, name, size, dtype):
+        if self.path is None:
+            return np.zeros(size, dtype=dtype)
+        return np.lib.format.open_memmap(
+            os.path.join(self.path, name + ".npy"),
+            mode="r+" if self._reopen else "w+",
+            dtype=dtype,
+            shape=(size,),
+        )
+
+    def __len__(self):
+        return self.capacity - self.n_free
+
+    @property
+    def nbytes(self):
+        """Bytes held by the arrays of the buffer."""
+        arrays = (
+            self.arena,
+            self.offsets,
+            self.lengths,
+            self.log_r,
+            self.log_pf,
+            self.keys,
+            self.seq,
+            self.fifo,
+            self.free,
+            self.tree.tree,
+        )
+        return sum(a.nbytes for a in arrays)
+
+    def _priority(self, log_r):
+        return np.exp(self.priority_alpha * np.asarray(log_r, dtype=np.float64))
+
+    def _evict(self, slot):
+        self.live_tokens -= int(self.lengths[slot])
+        self.seq[slot] = -1
+        self._touched.append(slot)
+        self.free[self.n_free] = slot
+        self.n_free += 1
+
+    def _oldest(self):
+        # with fifo eviction the live trajectories are exactly the ones
+        # numbered oldest_seq to next_seq - 1
+        return self.fifo[self.oldest_seq % self.capacity]
+
+    def _evict_oldest(self):
+        self._evict(self._oldest())
+        self.oldest_seq += 1
+
+    def _evict_random(self):
+        while True:
+            slot = self.rng.integers(self.capacity)
+            if self.seq[slot] >= 0:
+                self._evict(slot)
+                return
+
+    def _compact(self):
+        self._write_pending()
+        live = np.flatnonzero(self.seq >= 0)
+        live = live[np.argsort(self.offsets[live], kind="stable")]
+        lengths = self.lengths[live].astype(np.int64)
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        gather = np.repeat(self.offsets[live] - starts, lengths)
+        gather += np.arange(gather.size)
+        self.arena[: gather.size] = self.arena[gather]
+        self.offsets[live] = starts
+        self.end = int(gather.size)
+
+    def _reserve_fifo(self, length):
+        if self.n_free == 0:
+            self._evict_oldest()
+        if self.end + length > self.arena.size:
+            # wrap around, the trajectories past end are the oldest ones
+            while len(self) and self.offsets[self._oldest()] >= self.end:
+                self._evict_oldest()
+            self.end = 0
+        # the oldest trajectories follow end, drop the ones in the way
+        while len(self) and self.offsets[self._oldest()] < self.end + length:
+            if self.offsets[self._oldest()] < self.end:
+                break
+            self._evict_oldest()
+        return self.end
+
+    def _reserve_reservoir(self, length):
+        if self.n_free == 0:
+            self._evict_random()
+        if self.end + length > self.arena.size:
+            target = (self.arena.size - length) - self.arena.size // 8
+            while len(self) and self.live_tokens > max(target, 0):
+                self._evict_random()
+            self._compact()
+        return self.end
+
+    def add(self, tokens, lengths, log_r, log_pf=None, keys=None):
+        """
+        Adds a batch of trajectories.
+
+        Arguments
+        ---------
+        tokens : numpy.ndarray
+            2D array of (batch x MaxLength) with the tokens, zero padded.
+            Torch tensors are accepted too.
+        lengths : numpy.ndarray
+            1D array of (batch) with the length of every trajectory.
+        log_r : numpy.ndarray
+            1D array of (batch) with the log-reward of every trajectory.
+        log_pf : numpy.ndarray
+            1D array of (batch) with the log-prob of the sampling policy.
+        keys : numpy.ndarray
+            1D int array of (batch) identifying e.g. the utterance.
+        """
+        tokens = _as_numpy(tokens)
+        lengths = _as_numpy(lengths).astype(np.int64)
+        log_r = _as_numpy(log_r)
+        N = lengths.shape[0]
+        log_pf = np.zeros(N) if log_pf is None else _as_numpy(log_pf)
+        keys = np.zeros(N, dtype=np.int64) if keys is None else _as_numpy(keys)
+
+        if N and lengths.max() > self.arena.size:
+            raise ValueError(
+                "Trajectory of {} tokens exceeds the buffer".format(
+                    lengths.max()
+                )
+            )
+
+        self._tokens = tokens
+        for i in range(N):
+            length = int(lengths[i])
+            self.n_seen += 1
+            if self.eviction == "reservoir" and (
+                self.n_free == 0 or self.end + length > self.arena.size
+            ):
+                if self.rng.random() >= len(self) / self.n_seen:
+                    continue
+                self._evict_random()
+
+            if self.eviction == "fifo":
+                start = self._reserve_fifo(length)
+            else:
+                start = self._reserve_reservoir(length)
+
+            self.n_free -= 1
+            slot = self.free[self.n_free]
+            self._pending.append((i, slot, self.next_seq))
+            self._touched.append(slot)
+            self.offsets[slot] = start
+            self.lengths[slot] = length
+            self.log_r[slot] = log_r[i]
+            self.log_pf[slot] = log_pf[i]
+            self.keys[slot] = keys[i]
+            self.seq[slot] = self.next_seq
+            self.fifo[self.next_seq % self.capacity] = slot
+            self.next_seq += 1
+            self.end = start + length
+            self.live_tokens += length
+        self._write_pending()
+        self._tokens = None
+
+    def _write_pending(self):
+        """Copies the tokens and priorities of the trajectories just added."""
+        if self._pending:
+            rows, slots, seqs = np.array(self._pending).T
+            # a trajectory may have been evicted later in the same call
+            kept = self.seq[slots] == seqs
+            rows, slots = rows[kept], slots[kept]
+            lengths = self.lengths[slots].astype(np.int64)
+            starts = np.cumsum(lengths) - lengths
+            cols = np.arange(lengths.sum()) - np.repeat(starts, lengths)
+            dest = np.repeat(self.offsets[slots], lengths) + cols
+            self.arena[dest] = self._tokens[np.repeat(rows, lengths), cols]
+            self._pending = []
+        if self._touched:
+            slots = np.unique(self._touched)
+            live = self.seq[slots] >= 0
+            priority = np.where(live, self._priority(self.log_r[slots]), 0.0)
+            self.tree.set(slots, priority)
+            self._touched = []
+
+    def sample(self, batch_size):
+        """
+        Draws a mini-batch of trajectories, prioritized by reward.
+
+        Arguments
+        ---------
+        batch_size : int
+            Number of trajectories to draw, with replacement.
+
+        Returns
+        -------
+        dict
+            'slots' (used by update_rewards), 'tokens' (batch x MaxLength,
+            zero padded), 'lengths', 'log_r', 'log_pf' and 'keys'.
+        """
+        if not len(self):
+            raise RuntimeError("Sampling from an empty replay buffer")
+        slots = self.tree.sample(batch_size, self.rng)
+        lengths = self.lengths[slots].astype(np.int64)
+        position = np.arange(max(int(lengths.max()), 1))
+        index = self.offsets[slots, None] + position[None, :]
+        index = np.minimum(index, self.arena.size - 1)
+        tokens = np.where(
+            position[None, :] < lengths[:, None], self.arena[index], 0
+        )
+        return {
+            "slots": slots,
+            "tokens": tokens.astype(np.int64),
+            "lengths": lengths,
+            "log_r": self.log_r[slots].copy(),
+            "log_pf": self.log_pf[slots].copy(),
+            "keys": self.keys[slots].copy(),
+        }
+
+    def update_rewards(self, slots, log_r):
+        """Replaces the log-rewards, and priorities, of sampled slots."""
+        slots = np.asarray(slots)
+        log_r = np.asarray(log_r, dtype=np.float32)
+        self.log_r[slots] = log_r
+        self.tree.set(slots, self._priority(log_r))
+
+    def flush(self):
+        """Writes the memory-mapped arrays and counters to the path folder."""
+        if self.path is None:
+            return
+        for array in (
+            self.arena,
+            self.offsets,
+            self.lengths,
+            self.log_r,
+            self.log_pf,
+            self.keys,
+            self.seq,
+            self.fifo,
+            self.free,
+            self.tree.tree,
+        ):
+            array.flush()
+        state = {
+            k: int(getattr(self, k))
+            for k in (
+                "n_free",
+                "n_seen",
+                "next_seq",
+                "oldest_seq",
+                "end",
+                "live_tokens",
+            )
+        }
+        state.update(
+            capacity=self.capacity,
+            max_bytes=self.max_bytes,
+            token_dtype=self.token_dtype.name,
+        )
+        with open(self._state_file, "w", encoding="utf-8") as fout:
+            json.dump(state, fout)
+
+
+def _as_numpy(x):
+    if hasattr(x, "detach"):
+        x = x.detach().cpu().numpy()
+    return np.asarray(x)
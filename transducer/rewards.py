@@ -0,0 +1,699 @@
+"""
+Batched rewards of the GFN objective.
+
+The distance from a reference to every prefix of a hypothesis is read from
+a single Levenshtein table, filled one hypothesis token (row) at a time: the
+last column of row i is the distance to the prefix of length i. Rows are
+computed for the whole padded batch at once, with Numba on CPU and torch on
+other devices.
+
+Rewards are registered by name with register_reward, and selected from the
+hparams through the Reward class. Every reward maps a padded batch to the
+log-reward of every prefix in tensor ops, and declares whether it can run
+in the dataloader workers.
+"""
+
+import os
+import sqlite3
+import zlib
+
+import numpy as np
+import torch
+
+from speechbrain.utils.distributed import get_rank
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+
+if njit is not None:
+
+    @njit(parallel=True)
+    def cpu_prefix_edit_distance(ref, ref_lens, hyp, hyp_lens, out):
+        """
+        Fills out[b, i] with the edit distance between ref[b, :ref_lens[b]]
+        and hyp[b, :i + 1], one utterance per core.
+
+        Arguments
+        ---------
+        ref : numpy.ndarray
+            2D array of (batch x MaxRefLength) with the reference tokens.
+        ref_lens : numpy.ndarray
+            1D array of (batch) with the length of every reference.
+        hyp : numpy.ndarray
+            2D array of (batch x MaxHypLength) with the hypothesis tokens.
+        hyp_lens : numpy.ndarray
+            1D array of (batch) with the length of every hypothesis.
+        out : numpy.ndarray
+            2D array of (batch x MaxHypLength) receiving the distances.
+        """
+        for b in prange(ref.shape[0]):
+            R = ref_lens[b]
+            prev = np.arange(R + 1)
+            cur = np.empty(R + 1, dtype=prev.dtype)
+            for i in range(1, hyp_lens[b] + 1):
+                cur[0] = i
+                for j in range(1, R + 1):
+                    cur[j] = min(
+                        prev[j] + 1,
+                        cur[j - 1] + 1,
+                        prev[j - 1] + (ref[b, j - 1] != hyp[b, i - 1]),
+                    )
+                out[b, i - 1] = cur[R]
+                prev, cur = cur, prev
+
+
+def _edit_distance_row(prev, ref, token, i):
+    """Row i of the Levenshtein tables of a batch, from their row i - 1."""
+    j = torch.arange(prev.shape[1], device=prev.device)
+    sub = (ref != token[:, None]).long()
+    moves = torch.minimum(prev[:, 1:] + 1, prev[:, :-1] + sub)
+    first = torch.as_tensor(i, device=prev.device).expand(prev.shape[0])
+    moves = torch.cat((first[:, None], moves), dim=1)
+    return (moves - j).cummin(dim=1).values + j
+
+
+def torch_prefix_edit_distance(ref, ref_lens, hyp, hyp_lens):
+    """
+    Edit distance between every reference and every prefix of its
+    hypothesis, computed with tensor ops on the device of ref. Within a row,
+    D[i, j] = min_k<=j (E[k] + j - k) where E holds the substitution and
+    deletion moves from row i - 1, i.e. a single cummin over j.
+
+    Arguments
+    ---------
+    ref : torch.Tensor
+        2D Tensor of (batch x MaxRefLength) with the reference tokens.
+    ref_lens : torch.Tensor
+        1D Tensor of (batch) with the length of every reference.
+    hyp : torch.Tensor
+        2D Tensor of (batch x MaxHypLength) with the hypothesis tokens.
+    hyp_lens : torch.Tensor
+        1D Tensor of (batch) with the length of every hypothesis.
+
+    Returns
+    -------
+    torch.Tensor
+        2D Tensor of (batch x MaxHypLength), out[b, i] being the distance
+        between ref[b, :ref_lens[b]] and hyp[b, :i + 1], zero for
+        i >= hyp_lens[b].
+    """
+    B, R = ref.shape
+    H = hyp.shape[1]
+    hyp = hyp.to(ref.device)
+    ref_lens = ref_lens.to(ref.device).long()
+    hyp_lens = hyp_lens.to(ref.device).long()
+
+    prev = torch.arange(R + 1, device=ref.device).expand(B, R + 1)
+    out = torch.zeros(B, H, dtype=torch.long, device=ref.device)
+    for i in range(1, H + 1):
+        prev = _edit_distance_row(prev, ref, hyp[:, i - 1], i)
+        out[:, i - 1] = prev.gather(1, ref_lens[:, None]).squeeze(1)
+
+    h = torch.arange(H, device=ref.device)
+    return torch.where(h[None, :] < hyp_lens[:, None], out, 0)
+
+
+def prefix_edit_distance(ref, ref_lens, hyp, hyp_lens):
+    """
+    Edit distance between every reference and every prefix of its
+    hypothesis, for a padded batch. Uses the Numba kernel for CPU tensors
+    when Numba is installed and torch_prefix_edit_distance otherwise.
+
+    Arguments
+    ---------
+    ref : torch.Tensor
+        2D Tensor of (batch x MaxRefLength) with the reference tokens.
+    ref_lens : torch.Tensor
+        1D Tensor of (batch) with the length of every reference.
+    hyp : torch.Tensor
+        2D Tensor of (batch x MaxHypLength) with the hypothesis tokens.
+    hyp_lens : torch.Tensor
+        1D Tensor of (batch) with the length of every hypothesis.
+
+    Returns
+    -------
+    torch.Tensor
+        2D Tensor of (batch x MaxHypLength), zero for i >= hyp_lens[b].
+    """
+    if ref.device.type != "cpu" or njit is None:
+        return torch_prefix_edit_distance(ref, ref_lens, hyp, hyp_lens)
+
+    out = np.zeros(hyp.shape, dtype=np.int64)
+    cpu_prefix_edit_distance(
+        ref.numpy().astype(np.int64),
+        ref_lens.cpu().numpy().astype(np.int64),
+        hyp.cpu().numpy().astype(np.int64),
+        hyp_lens.cpu().numpy().astype(np.int64),
+        out,
+    )
+    return torch.from_numpy(out)
+
+
+def prefix_log_rewards(tokens, token_lens, hyp=None, hyp_lens=None):
+    """
+    Log-rewards of the GFN objective, log_r[b, i] = -ed(ref, hyp[:i + 1]) /
+    len(ref), computed for the whole batch in one pass.
+
+    Arguments
+    ---------
+    tokens : torch.Tensor
+        2D Tensor of (batch x MaxSeqLabelLength) with the reference tokens.
+    token_lens : torch.Tensor
+        1D Tensor of (batch) with the absolute length of every reference.
+    hyp : torch.Tensor
+        2D Tensor of (batch x MaxHypLength) with the hypotheses. Defaults to
+        the references themselves, scoring every prefix of the targets.
+    hyp_lens : torch.Tensor
+        1D Tensor of (batch) with the absolute length of every hypothesis.
+
+    Returns
+    -------
+    torch.Tensor
+        2D float Tensor of (batch x MaxHypLength) on the device of tokens,
+        zero for i >= hyp_lens[b].
+    """
+    if hyp is None:
+        hyp, hyp_lens = tokens, token_lens
+    dist = prefix_edit_distance(tokens, token_lens, hyp, hyp_lens)
+    dist = dist.to(device=tokens.device, dtype=torch.float32)
+    return -dist / token_lens.to(dist.device).clamp(min=1)[:, None]
+
+
+def pad_hypotheses(hyps, pad_index=0):
+    """
+    Pads the N hypotheses of every utterance, e.g. the nbest lists of a
+    searcher, into a tensor.
+
+    Arguments
+    ---------
+    hyps : list
+        List (batch) of lists (N) of token sequences.
+    pad_index : int
+        Value used for padding.
+
+    Returns
+    -------
+    hyps : torch.Tensor
+        3D Tensor of (batch x N x MaxHypLength).
+    hyp_lens : torch.Tensor
+        2D Tensor of (batch x N) with the absolute length of every hypothesis.
+    """
+    B, N = len(hyps), max([len(h) for h in hyps] + [0])
+    H = max([len(seq) for h in hyps for seq in h] + [1])
+    out = torch.full((B, N, H), pad_index, dtype=torch.long)
+    lens = torch.zeros(B, N, dtype=torch.long)
+    for b, nbest in enumerate(hyps):
+        for n, seq in enumerate(nbest):
+            out[b, n, : len(seq)] = torch.as_tensor(seq, dtype=torch.long)
+            lens[b, n] = len(seq)
+    return out, lens
+
+
+def hypothesis_log_rewards(tokens, token_lens, hyps, hyp_lens, reward=None):
+    """
+    Log-rewards of every prefix of N sampled hypotheses per utterance,
+    log_r[b * N + n, i] = -ed(tokens[b], hyps[b, n, :i + 1]) / len(tokens[b]),
+    scored against the references in a single batched call.
+
+    The hypotheses are flattened into the batch, utterance major, so the
+    output is the log_r of gfn_loss when the targets are
+    hyps.flatten(0, 1) and the encoder outputs are repeated N times with
+    repeat_interleave.
+
+    Arguments
+    ---------
+    tokens : torch.Tensor
+        2D Tensor of (batch x MaxSeqLabelLength) with the reference tokens.
+    token_lens : torch.Tensor
+        1D Tensor of (batch) with the absolute length of every reference.
+    hyps : torch.Tensor
+        3D Tensor of (batch x N x MaxHypLength) with the hypotheses.
+    hyp_lens : torch.Tensor
+        2D Tensor of (batch x N) with the absolute length of every hypothesis.
+    reward : callable
+        Batched reward with the signature of prefix_log_rewards, e.g. a
+        Reward. Defaults to prefix_log_rewards.
+
+    Returns
+    -------
+    torch.Tensor
+        2D float Tensor of (batch * N x MaxHypLength) on the device of
+        tokens, zero past the end of every hypothesis.
+    """
+    reward = reward or prefix_log_rewards
+    N = hyps.shape[1]
+    refs = tokens.repeat_interleave(N, dim=0)
+    ref_lens = token_lens.repeat_interleave(N, dim=0)
+    return reward(refs, ref_lens, hyps.flatten(0, 1), hyp_lens.flatten())
+
+
+def token_accuracy_log_rewards(tokens, token_lens, hyp=None, hyp_lens=None):
+    """
+    Log-rewards counting the tokens of the reference matched at the same
+    position, log_r[b, i] = -(len(ref) - matches(hyp[:i + 1])) / len(ref).
+
+    Arguments
+    ---------
+    tokens : torch.Tensor
+        2D Tensor of (batch x MaxSeqLabelLength) with the reference tokens.
+    token_lens : torch.Tensor
+        1D Tensor of (batch) with the absolute length of every reference.
+    hyp : torch.Tensor
+        2D Tensor of (batch x MaxHypLength) with the hypotheses. Defaults to
+        the references themselves.
+    hyp_lens : torch.Tensor
+        1D Tensor of (batch) with the absolute length of every hypothesis.
+
+    Returns
+    -------
+    torch.Tensor
+        2D float Tensor of (batch x MaxHypLength) on the device of tokens,
+        zero for i >= hyp_lens[b].
+    """
+    if hyp is None:
+        hyp, hyp_lens = tokens, token_lens
+    hyp = hyp.to(tokens.device)
+    token_lens = token_lens.to(tokens.device).long()
+    hyp_lens = hyp_lens.to(tokens.device).long()
+    H = hyp.shape[1]
+    ref = torch.nn.functional.pad(tokens, (0, max(H - tokens.shape[1], 0)))
+    position = torch.arange(H, device=tokens.device)
+    match = (hyp == ref[:, :H]) & (position[None, :] < token_lens[:, None])
+    errors = token_lens[:, None] - match.long().cumsum(1)
+    log_r = -errors.float() / token_lens.clamp(min=1)[:, None]
+    return torch.where(position[None, :] < hyp_lens[:, None], log_r, 0.0)
+
+
+# odd multiplier of the polynomial hashes of words, int64 products wrap
+_HASH_BASE = 1000003
+
+
+def _word_hashes(tokens, lens, word_start):
+    """
+    Hashes of the words of padded SentencePiece sequences, a word starting
+    at every piece flagged by word_start (and at the first piece).
+
+    Returns
+    -------
+    running : torch.Tensor
+        (batch x Length) hash of the word of every token up to that token.
+    word : torch.Tensor
+        (batch x Length) index of the word of every token.
+    words : torch.Tensor
+        (batch x Length) hash of every complete word, zero padded.
+    n_words : torch.Tensor
+        (batch) number of words.
+    """
+    B, L = tokens.shape
+    position = torch.arange(L, device=tokens.device)
+    valid = position[None, :] < lens[:, None]
+    start = word_start[tokens] | (position[None, :] == 0)
+    word = start.long().cumsum(1) - 1
+    first = torch.where(start, position, 0).cummax(1).values
+
+    powers = torch.full((L,), _HASH_BASE, device=tokens.device)
+    powers = torch.cat((powers.new_ones(1), powers[1:].cumprod(0)))
+    piece = (tokens.long() + 1) * powers[position - first] * valid
+    total = piece.cumsum(1)
+    running = total - (total.gather(1, first) - piece.gather(1, first))
+
+    next_start = torch.nn.functional.pad(start[:, 1:], (0, 1), value=True)
+    next_valid = torch.nn.functional.pad(valid[:, 1:], (0, 1), value=False)
+    last = valid & (next_start | ~next_valid)
+    words = running.new_zeros(B, L + 1)
+    words.scatter_(1, torch.where(last, word, L), running)
+    n_words = torch.where(valid, word + 1, 0).amax(1) if L else lens * 0
+    return running, word, words[:, :L], n_words
+
+
+def word_error_rate_log_rewards(
+    tokens, token_lens, hyp=None, hyp_lens=None, word_start=None
+):
+    """
+    Log-rewards from the word error rate of every prefix,
+    log_r[b, i] = -wer(ref, hyp[:i + 1]), with the words of decode_ids: a
+    word starts at every piece beginning with the SentencePiece word marker.
+    Words are compared through hashes of their pieces, and the last word of
+    a prefix is the part of it decoded so far. The rows of the word-level
+    Levenshtein tables are computed for the whole batch, then the last row
+    of every prefix in a single batched step.
+
+    Arguments
+    ---------
+    tokens : torch.Tensor
+        2D Tensor of (batch x MaxSeqLabelLength) with the reference tokens.
+    token_lens : torch.Tensor
+        1D Tensor of (batch) with the absolute length of every reference.
+    hyp : torch.Tensor
+        2D Tensor of (batch x MaxHypLength) with the hypotheses. Defaults to
+        the references themselves.
+    hyp_lens : torch.Tensor
+        1D Tensor of (batch) with the absolute length of every hypothesis.
+    word_start : torch.Tensor
+        1D bool Tensor of (vocabulary) flagging the pieces starting a word,
+        see word_start_table.
+
+    Returns
+    -------
+    torch.Tensor
+        2D float Tensor of (batch x MaxHypLength) on the device of tokens,
+        zero for i >= hyp_lens[b].
+    """
+    if hyp is None:
+        hyp, hyp_lens = tokens, token_lens
+    device = tokens.device
+    hyp = hyp.to(device)
+    token_lens = token_lens.to(device).long()
+    hyp_lens = hyp_lens.to(device).long()
+    word_start = word_start.to(device)
+
+    _, _, ref_words, ref_n = _word_hashes(tokens, token_lens, word_start)
+    running, word, hyp_words, hyp_n = _word_hashes(hyp, hyp_lens, word_start)
+    B, R = ref_words.shape
+    H = hyp.shape[1]
+
+    # rows[:, w] is the row of the first w complete words of the hypothesis
+    rows = [torch.arange(R + 1, device=device).expand(B, R + 1)]
+    for w in range(1, max(int(hyp_n.max()), 1)):
+        rows.append(
+            _edit_distance_row(rows[-1], ref_words, hyp_words[:, w - 1], w)
+        )
+    rows = torch.stack(rows, dim=1)
+
+    # the prefix hyp[:i + 1] ends with the word of token i, decoded so far
+    prev = rows.gather(
+        1, word.clamp(max=rows.shape[1] - 1)[..., None].expand(B, H, R + 1)
+    )
+    last = _edit_distance_row(
+        prev.flatten(0, 1),
+        ref_words.repeat_interleave(H, dim=0),
+        running.flatten(),
+        (word + 1).flatten(),
+    ).view(B, H, R + 1)
+    dist = last.gather(2, ref_n[:, None, None].expand(B, H, 1)).squeeze(2)
+    log_r = -dist.float() / ref_n.clamp(min=1)[:, None]
+    position = torch.arange(H, device=device)
+    return torch.where(position[None, :] < hyp_lens[:, None], log_r, 0.0)
+
+
+def word_start_table(tokenizer):
+    """
+    Flags the pieces of a SentencePiece tokenizer starting a word.
+
+    Arguments
+    ---------
+    tokenizer : sentencepiece.SentencePieceProcessor
+        Loaded tokenizer.
+
+    Returns
+    -------
+    torch.Tensor
+        1D bool Tensor of (vocabulary).
+    """
+    return torch.tensor(
+        [
+            tokenizer.id_to_piece(i).startswith("\u2581")
+            for i in range(tokenizer.get_piece_size())
+        ],
+        dtype=torch.bool,
+    )
+
+
+@torch.no_grad()
+def lm_log_likelihood_rewards(
+    tokens, token_lens, hyp=None, hyp_lens=None, lm_model=None, bos_index=0
+):
+    """
+    Log-rewards given by a frozen language model, log_r[b, i] =
+    log p_LM(hyp[:i + 1]), from one forward pass over the padded batch.
+    The references are only used as hypotheses when hyp is None.
+
+    Arguments
+    ---------
+    tokens : torch.Tensor
+        2D Tensor of (batch x MaxSeqLabelLength) with the reference tokens.
+    token_lens : torch.Tensor
+        1D Tensor of (batch) with the absolute length of every reference.
+    hyp : torch.Tensor
+        2D Tensor of (batch x MaxHypLength) with the hypotheses. Defaults to
+        the references themselves.
+    hyp_lens : torch.Tensor
+        1D Tensor of (batch) with the absolute length of every hypothesis.
+    lm_model : torch.nn.Module
+        Language model mapping (batch x Length) tokens to (batch x Length x
+        vocabulary) logits, e.g. speechbrain.lobes.models.RNNLM.
+    bos_index : int
+        Index of the beginning-of-sentence token fed first to the LM.
+
+    Returns
+    -------
+    torch.Tensor
+        2D float Tensor of (batch x MaxHypLength) on the device of tokens,
+        zero for i >= hyp_lens[b].
+    """
+    if hyp is None:
+        hyp, hyp_lens = tokens, token_lens
+    device = next(lm_model.parameters()).device
+    hyp = hyp.to(device).long()
+    hyp_lens = hyp_lens.to(device).long()
+    bos = torch.full_like(hyp[:, :1], bos_index)
+    out = lm_model(torch.cat((bos, hyp[:, :-1]), dim=1))
+    if isinstance(out, tuple):
+        out = out[0]
+    log_probs = out.float().log_softmax(-1).gather(2, hyp[..., None])[..., 0]
+    position = torch.arange(hyp.shape[1], device=device)
+    valid = position[None, :] < hyp_lens[:, None]
+    log_r = torch.where(valid, log_probs, 0.0).cumsum(1)
+    return torch.where(valid, log_r, 0.0).to(tokens.device)
+
+
+# name -> batched reward, context it needs and whether it can run in the
+# dataloader workers (CPU only, no model)
+REWARDS = {}
+
+
+def register_reward(name, fn, worker_safe, requires=()):
+    """
+    Registers a batched reward.
+
+    Arguments
+    ---------
+    name : str
+        Name of the reward in the hparams.
+    fn : callable
+        Maps (tokens, token_lens, hyp, hyp_lens, **context) to the
+        (batch x MaxHypLength) log-rewards of every prefix.
+    worker_safe : bool
+        Whether the reward can be computed in the dataloader workers.
+    requires : tuple
+        Context given to fn by Reward: 'word_start' | 'lm_model' | 'bos_index'.
+    """
+    REWARDS[name] = {
+        "fn": fn,
+        "worker_safe": worker_safe,
+        "requires": tuple(requires),
+    }
+
+
+register_reward("prefix_edit_distance", prefix_log_rewards, True)
+register_reward("token_accuracy", token_accuracy_log_rewards, True)
+register_reward(
+    "word_error_rate", word_error_rate_log_rewards, True, ("word_start",)
+)
+register_reward(
+    "lm_log_likelihood",
+    lm_log_likelihood_rewards,
+    False,
+    ("lm_model", "bos_index"),
+)
+
+
+class Reward:
+    """
+    Batched reward selected by name from the registry.
+
+    Arguments
+    ---------
+    name : str
+        'prefix_edit_distance' | 'token_accuracy' | 'word_error_rate' |
+        'lm_log_likelihood', or any name given to register_reward.
+    tokenizer : sentencepiece.SentencePieceProcessor
+        Tokenizer splitting the pieces into words for 'word_error_rate'. It
+        may be loaded after the Reward is created.
+    lm_model : torch.nn.Module
+        Frozen language model of 'lm_log_likelihood'.
+    bos_index : int
+        Index of the beginning-of-sentence token of the LM.
+
+    Example
+    -------
+    >>> reward = Reward("token_accuracy")
+    >>> reward(torch.LongTensor([[4, 2, 7]]), torch.LongTensor([3]))
+    tensor([[-0.6667, -0.3333, -0.0000]])
+    >>> reward.worker_safe
+    True
+    """
+
+    def __init__(
+        self,
+        name="prefix_edit_distance",
+        tokenizer=None,
+        lm_model=None,
+        bos_index=0,
+    ):
+        if name not in REWARDS:
+            raise ValueError("Unexpected reward {}".format(name))
+        self.name = name
+        self.tokenizer = tokenizer
+        self.lm_model = lm_model
+        self.bos_index = bos_index
+        self._word_start = None
+
+    @property
+    def worker_safe(self):
+        """Whether the reward can be computed in the dataloader workers."""
+        return REWARDS[self.name]["worker_safe"]
+
+    def _context(self):
+        context = {}
+        for key in REWARDS[self.name]["requires"]:
+            if key == "word_start":
+                # built on first use, once the tokenizer is loaded
+                if self._word_start is None:
+                    self._word_start = word_start_table(self.tokenizer)
+                context[key] = self._word_start
+            else:
+                context[key] = getattr(self, key)
+        return context
+
+    def __call__(self, tokens, token_lens, hyp=None, hyp_lens=None):
+        """
+        Log-rewards of every prefix of a padded batch.
+
+        Arguments
+        ---------
+        tokens : torch.Tensor
+            2D Tensor of (batch x MaxSeqLabelLength) with the reference tokens.
+        token_lens : torch.Tensor
+            1D Tensor of (batch) with the absolute length of every reference.
+        hyp : torch.Tensor
+            2D Tensor of (batch x MaxHypLength) with the hypotheses. Defaults
+            to the references themselves.
+        hyp_lens : torch.Tensor
+            1D Tensor of (batch) with the absolute length of every hypothesis.
+
+        Returns
+        -------
+        torch.Tensor
+            2D float Tensor of (batch x MaxHypLength), zero past the end of
+            every hypothesis.
+        """
+        return REWARDS[self.name]["fn"](
+            tokens, token_lens, hyp, hyp_lens, **self._context()
+        )
+
+    def utterance(self, tokens):
+        """Log-rewards of every prefix of a single reference (1D tokens)."""
+        return self(tokens[None], torch.tensor([len(tokens)]))[0]
+
+    def __getstate__(self):
+        # the LM stays in the main process, workers only get CPU rewards
+        state = dict(self.__dict__)
+        state["lm_model"] = None
+        return state
+
+
+class RewardCache:
+    """
+    On-disk memo of per-utterance rewards, keyed by utterance ID and shared
+    through SQLite by the dataloader workers of a process and by later runs.
+    Each entry stores a checksum of the tokens it was computed from, so a
+    change of tokenizer recomputes it instead of returning a stale reward.
+
+    Every process (DDP) keeps its own file, next to path with its rank in
+    the name, e.g. rewards.rank0.sqlite. The default rollback journal is
+    used rather than WAL, whose shared memory index is unsafe on network
+    filesystems.
+
+    Arguments
+    ---------
+    path : str
+        SQLite file holding the cache, before the rank is added.
+    name : str
+        Name of the reward, several rewards can share a file.
+
+    Example
+    -------
+    >>> cache = RewardCache(getfixture("tmpdir") / "rewards.sqlite")
+    >>> tokens = torch.LongTensor([4, 2, 7])
+    >>> cache.get("utt1", tokens, Reward().utterance)
+    tensor([-0.6667, -0.3333, -0.0000])
+    """
+
+    def __init__(self, path, name="prefix_edit_distance"):
+        root, extension = os.path.splitext(str(path))
+        self.path = "{}.rank{}{}".format(root, get_rank() or 0, extension)
+        self.name = name
+        self._conn = None
+        self._pid = None
+
+    def _connect(self):
+        # connections cannot cross a fork, every worker opens its own
+        if self._conn is None or self._pid != os.getpid():
+            folder = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(folder, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=60)
+            with conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS rewards (name TEXT, id TEXT, "
+                    "checksum INTEGER, value BLOB, PRIMARY KEY (name, id))"
+                )
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, utt_id, tokens, compute):
+        """
+        Returns the reward of an utterance, computing and storing it on a
+        cache miss.
+
+        Arguments
+        ---------
+        utt_id : str
+            Utterance ID.
+        tokens : torch.Tensor
+            1D Tensor with the reference tokens.
+        compute : callable
+            Maps tokens to the reward tensor, e.g. Reward().utterance.
+
+        Returns
+        -------
+        torch.Tensor
+            1D float Tensor with the reward.
+        """
+        checksum = zlib.crc32(tokens.numpy().astype(np.int64).tobytes())
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT checksum, value FROM rewards WHERE name = ? AND id = ?",
+            (self.name, utt_id),
+        ).fetchone()
+        if row is not None and row[0] == checksum:
+            value = np.frombuffer(row[1], dtype=np.float32)
+            return torch.from_numpy(value.copy())
+
+        value = compute(tokens).float()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO rewards VALUES (?, ?, ?, ?)",
+                (self.name, utt_id, checksum, value.numpy().tobytes()),
+            )
+        return value
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["_conn"] = None
+        state["_pid"] = None
+        return state
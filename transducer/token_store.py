@@ -0,0 +1,135 @@
+"""
+Token ids of the prepared manifests, computed once per split.
+
+Encoding the transcripts in text_pipeline repeats the same SentencePiece
+work for every utterance, at every epoch and in every dataloader worker.
+Here, every transcript of a manifest is encoded once, after preparation, and
+the ids are stored as one flat int16 array with the offsets of every
+utterance. The arrays are memory-mapped, so the dataloader workers share
+their pages, and the token counts are available to the batch samplers
+without encoding anything. The store records a checksum of the manifest and
+the tokenizer it was built from, and is rebuilt when either changes.
+"""
+
+import csv
+import json
+import os
+import zlib
+
+import numpy as np
+
+from speechbrain.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def store_checksum(csv_file, tokenizer):
+    """CRC32 of the manifest and of the serialized SentencePiece model."""
+    with open(csv_file, "rb") as fin:
+        checksum = zlib.crc32(fin.read())
+    return zlib.crc32(tokenizer.serialized_model_proto(), checksum)
+
+
+def prepare_token_store(csv_file, prefix, tokenizer):
+    """
+    Encodes every transcript (column 'wrd') of a manifest, and writes
+    prefix + '_tokens.npy', prefix + '_offsets.npy' and prefix + '.json'
+    (utterance IDs and checksum). Nothing is done if the store exists and
+    was built from the same manifest with the same tokenizer.
+
+    Arguments
+    ---------
+    csv_file : str
+        Manifest written by prepare_librispeech.
+    prefix : str
+        Path prefix of the files of the store.
+    tokenizer : sentencepiece.SentencePieceProcessor
+        Tokenizer of the recipe, already loaded.
+    """
+    checksum = store_checksum(csv_file, tokenizer)
+    if os.path.isfile(prefix + ".json"):
+        with open(prefix + ".json", encoding="utf-8") as fin:
+            if json.load(fin)["checksum"] == checksum:
+                logger.info("Token store %s exists, skipping", prefix)
+                return
+
+    ids, tokens, offsets = [], [], [0]
+    with open(csv_file, newline="", encoding="utf-8") as fin:
+        for row in csv.DictReader(fin):
+            utt_tokens = tokenizer.encode_as_ids(row["wrd"])
+            ids.append(row["ID"])
+            tokens.extend(utt_tokens)
+            offsets.append(offsets[-1] + len(utt_tokens))
+
+    dtype = np.int16 if tokenizer.get_piece_size() <= 2**15 else np.int32
+    folder = os.path.dirname(os.path.abspath(prefix))
+    os.makedirs(folder, exist_ok=True)
+    np.save(prefix + "_tokens.npy", np.array(tokens, dtype=dtype))
+    np.save(prefix + "_offsets.npy", np.array(offsets, dtype=np.int64))
+    # the json is written last, it marks the store as complete
+    with open(prefix + ".json", "w", encoding="utf-8") as fout:
+        json.dump({"checksum": checksum, "ids": ids}, fout)
+    logger.info(
+        "Token store %s: %d utterances, %d tokens",
+        prefix,
+        len(ids),
+        len(tokens),
+    )
+
+
+class TokenStore:
+    """
+    Memory-mapped token ids of a manifest, written by prepare_token_store.
+
+    Arguments
+    ---------
+    prefix : str
+        Path prefix of the files of the store.
+
+    Example
+    -------
+    >>> class Tokenizer:
+    ...     def encode_as_ids(self, text):
+    ...         return [len(word) for word in text.split()]
+    ...     def get_piece_size(self):
+    ...         return 100
+    ...     def serialized_model_proto(self):
+    ...         return b"model"
+    >>> csv_file = getfixture("tmpdir") / "dev.csv"
+    >>> _ = csv_file.write("ID,duration,wav,spk_id,wrd\\n"
+    ...     "utt1,1.0,a.flac,1,HELLO WORLD\\nutt2,2.0,b.flac,1,A BC\\n")
+    >>> prefix = str(getfixture("tmpdir") / "tokens" / "dev")
+    >>> prepare_token_store(str(csv_file), prefix, Tokenizer())
+    >>> store = TokenStore(prefix)
+    >>> store["utt2"], store.count("utt1")
+    ([1, 2], 2)
+    """
+
+    def __init__(self, prefix):
+        with open(prefix + ".json", encoding="utf-8") as fin:
+            meta = json.load(fin)
+        self.checksum = meta["checksum"]
+        self.rows = {utt_id: i for i, utt_id in enumerate(meta["ids"])}
+        self.tokens = np.load(prefix + "_tokens.npy", mmap_mode="r")
+        self.offsets = np.load(prefix + "_offsets.npy")
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, utt_id):
+        return utt_id in self.rows
+
+    def __getitem__(self, utt_id):
+        """Token ids of an utterance, as a list."""
+        row = self.rows[utt_id]
+        return self.tokens[self.offsets[row] : self.offsets[row + 1]].tolist()
+
+    def count(self, utt_id):
+        """Number of tokens of an utterance."""
+        row = self.rows[utt_id]
+        return int(self.offsets[row + 1] - self.offsets[row])
+
+    def counts(self):
+        """Number of tokens of every utterance, by utterance ID."""
+        lengths = np.diff(self.offsets).tolist()
+        return dict(zip(self.rows, lengths))
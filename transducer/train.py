@@ -32,45 +32,73 @@ Authors
  * Peter Plantinga 2020
 """
 
+import csv
 import os
 import sys
+import zlib
 from pathlib import Path
 
 import torch
 from hyperpyyaml import load_hyperpyyaml
 
 import speechbrain as sb
+from speechbrain.dataio.batch import PaddedBatch, PaddedData
 from speechbrain.utils.distributed import if_main_process, run_on_main
 from speechbrain.utils.logger import get_logger
 
+from audio_shards import (
+    AudioShards,
+    BucketedSequentialSampler,
+    prepare_audio_shards,
+)
+from binary_manifest import BinaryManifest, load_manifest
+from cost_sampler import LatticeCostBatchSampler
+from lattice import chunked_joint, gather_band, min_band_width, select_band
+from metrics import DeviceMetrics
+from profiler import NO_PROFILER
+from rewards import Reward, RewardCache, hypothesis_log_rewards
+from tar_shards import TarShardDataset
+from token_store import TokenStore, prepare_token_store
+
 logger = get_logger(__name__)
 
 # Define training procedure
 
 
 class ASR(sb.Brain):
+    # share of the batch of the micro-batch being computed, None outside of
+    # split batches
+    micro_batch_weight = None
+
     def compute_forward(self, batch, stage):
         """Forward computations from the waveform batches to the output probabilities."""
         batch = batch.to(self.device)
         wavs, wav_lens = batch.sig
         tokens_with_bos, token_with_bos_lens = batch.tokens_bos
 
+        profiler = self.step_profiler
+
         # Add waveform augmentation if specified.
         if stage == sb.Stage.TRAIN:
             if hasattr(self.hparams, "wav_augment"):
-                wavs, wav_lens = self.hparams.wav_augment(wavs, wav_lens)
-                tokens_with_bos = self.hparams.wav_augment.replicate_labels(
-                    tokens_with_bos
-                )
+                with profiler.stage("wav_augment"):
+                    wavs, wav_lens = self.hparams.wav_augment(wavs, wav_lens)
+                    tokens_with_bos = (
+                        self.hparams.wav_augment.replicate_labels(
+                            tokens_with_bos
+                        )
+                    )
 
-        feats = self.hparams.compute_features(wavs)
+        with profiler.stage("features"):
+            feats = self.hparams.compute_features(wavs)
 
         # Add feature augmentation if specified.
         if stage == sb.Stage.TRAIN and hasattr(self.hparams, "fea_augment"):
-            feats, fea_lens = self.hparams.fea_augment(feats, wav_lens)
-            tokens_with_bos = self.hparams.fea_augment.replicate_labels(
-                tokens_with_bos
-            )
+            with profiler.stage("fea_augment"):
+                feats, fea_lens = self.hparams.fea_augment(feats, wav_lens)
+                tokens_with_bos = self.hparams.fea_augment.replicate_labels(
+                    tokens_with_bos
+                )
 
         current_epoch = self.hparams.epoch_counter.current
 
@@ -83,82 +111,227 @@ class ASR(sb.Brain):
         else:
             dynchunktrain_config = None
 
-        feats = self.modules.normalize(feats, wav_lens, epoch=current_epoch)
-
-        src = self.modules.CNN(feats)
-        x = self.modules.enc(
-            src,
-            wav_lens,
-            pad_idx=self.hparams.pad_index,
-            dynchunktrain_config=dynchunktrain_config,
-        )
-        x = self.modules.proj_enc(x)
+        with profiler.stage("normalize"):
+            feats = self.modules.normalize(
+                feats, wav_lens, epoch=current_epoch
+            )
 
-        e_in = self.modules.emb(tokens_with_bos)
-        e_in = torch.nn.functional.dropout(
-            e_in,
-            self.hparams.dec_emb_dropout,
-            training=(stage == sb.Stage.TRAIN),
+        with profiler.stage("cnn"):
+            src = self.modules.CNN(feats)
+        with profiler.stage("enc"):
+            x = self.modules.enc(
+                src,
+                wav_lens,
+                pad_idx=self.hparams.pad_index,
+                dynchunktrain_config=dynchunktrain_config,
+            )
+            x = self.modules.proj_enc(x)
+
+        with profiler.stage("dec"):
+            e_in = self.modules.emb(tokens_with_bos)
+            e_in = torch.nn.functional.dropout(
+                e_in,
+                self.hparams.dec_emb_dropout,
+                training=(stage == sb.Stage.TRAIN),
+            )
+            h, _ = self.modules.dec(e_in)
+            h = torch.nn.functional.dropout(
+                h, self.hparams.dec_dropout, training=(stage == sb.Stage.TRAIN)
+            )
+            h = self.modules.proj_dec(h)
+
+        # Extra arguments of transducer_cost describing the lattice inputs
+        lattice_kwargs = {}
+        band_starts, band_width = None, None
+        if stage == sb.Stage.TRAIN and getattr(self.hparams, "prune_width", 0):
+            with profiler.stage("select_band"):
+                band_starts, band_width = self.select_band(x, wav_lens, batch)
+            lattice_kwargs["band_starts"] = band_starts
+
+        with profiler.stage("joint"):
+            if stage == sb.Stage.TRAIN and getattr(
+                self.hparams, "joint_chunk_frames", 0
+            ):
+                # Joint network and gathering of the blank and label log-probs,
+                # a few frames at a time, recomputed chunk by chunk in backward
+                logits_transducer = chunked_joint(
+                    self.joint,
+                    x,
+                    h,
+                    tokens_with_bos[:, 1:],
+                    self.hparams.blank_index,
+                    self.hparams.joint_chunk_frames,
+                    band_starts,
+                    band_width,
+                )
+                lattice_kwargs["gathered"] = True
+            else:
+                if band_starts is not None:
+                    # only the band of every frame goes through the joint:
+                    # [B,U,H_dec] => [B,T,W,H_dec]
+                    h_joint = gather_band(h, band_starts, band_width)
+                else:
+                    # add timeseq_dim to the decoder tensor: [B,U,H_dec] => [B,1,U,H_dec]
+                    h_joint = h.unsqueeze(1)
+
+                # Joint network and output layer for transducer log-probabilities
+                # add labelseq_dim to the encoder tensor: [B,T,H_enc] => [B,T,1,H_enc]
+                logits_transducer = self.joint(x.unsqueeze(2), h_joint)
+        # shape of the lattice of this step, after augmentation
+        self.lattice_shape = (
+            x.shape[0],
+            x.shape[1],
+            tokens_with_bos.shape[1] - 1,
         )
-        h, _ = self.modules.dec(e_in)
-        h = torch.nn.functional.dropout(
-            h, self.hparams.dec_dropout, training=(stage == sb.Stage.TRAIN)
+        profiler.record(
+            B=x.shape[0],
+            T=x.shape[1],
+            U=tokens_with_bos.shape[1] - 1,
+            logits=list(logits_transducer.shape),
+            wav_padding=1 - wav_lens.mean(),
+            token_padding=1 - token_with_bos_lens.mean(),
         )
-        h = self.modules.proj_dec(h)
-
-        # Joint network
-        # add labelseq_dim to the encoder tensor: [B,T,H_enc] => [B,T,1,H_enc]
-        # add timeseq_dim to the decoder tensor: [B,U,H_dec] => [B,1,U,H_dec]
-        joint = self.modules.Tjoint(x.unsqueeze(2), h.unsqueeze(1))
-
-        # Output layer for transducer log-probabilities
-        logits_transducer = self.modules.transducer_lin(joint)
 
         # Compute outputs
         if stage == sb.Stage.TRAIN:
             p_ctc = None
             p_ce = None
 
+            with profiler.stage("heads"):
+                if (
+                    self.hparams.ctc_weight > 0.0
+                    and current_epoch <= self.hparams.number_of_ctc_epochs
+                ):
+                    # Output layer for ctc log-probabilities
+                    out_ctc = self.modules.proj_ctc(x)
+                    p_ctc = self.hparams.log_softmax(out_ctc)
+
+                if self.hparams.ce_weight > 0.0:
+                    # Output layer for ctc log-probabilities
+                    p_ce = self.modules.dec_lin(h)
+                    p_ce = self.hparams.log_softmax(p_ce)
+
+            interval = getattr(self.hparams, "replay_buffer_interval", 1)
             if (
-                self.hparams.ctc_weight > 0.0
-                and current_epoch <= self.hparams.number_of_ctc_epochs
+                hasattr(self.hparams, "replay_buffer")
+                and self.step % interval == 0
             ):
-                # Output layer for ctc log-probabilities
-                out_ctc = self.modules.proj_ctc(x)
-                p_ctc = self.hparams.log_softmax(out_ctc)
+                with profiler.stage("replay_buffer"):
+                    self.fill_replay_buffer(x, wav_lens, batch)
 
-            if self.hparams.ce_weight > 0.0:
-                # Output layer for ctc log-probabilities
-                p_ce = self.modules.dec_lin(h)
-                p_ce = self.hparams.log_softmax(p_ce)
-
-            return p_ctc, p_ce, logits_transducer, wav_lens
+            return p_ctc, p_ce, logits_transducer, wav_lens, lattice_kwargs
 
         elif stage == sb.Stage.VALID:
-            best_hyps, scores, _, _ = self.hparams.Greedysearcher(x)
+            with profiler.stage("search"):
+                best_hyps, scores, _, _ = self.hparams.Greedysearcher(x)
             return logits_transducer, wav_lens, best_hyps
         else:
-            (
-                best_hyps,
-                best_scores,
-                nbest_hyps,
-                nbest_scores,
-            ) = self.hparams.Beamsearcher(x)
+            with profiler.stage("search"):
+                (
+                    best_hyps,
+                    best_scores,
+                    nbest_hyps,
+                    nbest_scores,
+                ) = self.hparams.Beamsearcher(x)
             return logits_transducer, wav_lens, best_hyps
 
+    @property
+    def step_profiler(self):
+        """Opt-in profiler of the stages of a step, a no-op by default."""
+        return getattr(self.hparams, "step_profiler", NO_PROFILER)
+
+    def joint(self, x, h):
+        """Joint network followed by the output layer for transducer
+        log-probabilities."""
+        return self.modules.transducer_lin(self.modules.Tjoint(x, h))
+
+    def select_band(self, x, wav_lens, batch):
+        """Chooses the label positions kept per frame by the pruned lattice,
+        from an alignment of the CTC branch over the encoder output. The band
+        is widened beyond prune_width for the batches holding utterances too
+        short in frames to reach their last label within it."""
+        tokens, token_lens = batch.tokens
+        if hasattr(self.hparams, "fea_augment"):
+            tokens, token_lens = self.hparams.fea_augment.replicate_multiple_labels(
+                tokens, token_lens
+            )
+        T = (wav_lens * x.shape[1]).round().int()
+        U = (token_lens * tokens.shape[1]).round().int()
+        needed = min_band_width(T, U)
+        width = max(self.hparams.prune_width, int(needed.max()))
+        if width > self.hparams.prune_width:
+            narrow = needed > self.hparams.prune_width
+            logger.warning(
+                "Band widened from %d to %d for utterances of (T, U) = %s",
+                self.hparams.prune_width,
+                width,
+                list(zip(T[narrow].tolist(), U[narrow].tolist())),
+            )
+        with torch.no_grad():
+            p_ctc = self.hparams.log_softmax(self.modules.proj_ctc(x))
+        starts = select_band(p_ctc, tokens, T, U, width, self.hparams.blank_index)
+        return starts, width
+
+    def fill_replay_buffer(self, x, wav_lens, batch):
+        """Samples trajectories from the current model and stores them, with
+        their reward, in the replay buffer, every replay_buffer_interval
+        steps. Only the buffer is filled here: an off-policy objective
+        drawing from it is left to the recipes using it."""
+        tokens, token_lens = batch.tokens
+        keys = torch.tensor([zlib.crc32(i.encode()) for i in batch.id])
+        if hasattr(self.hparams, "fea_augment"):
+            tokens, token_lens, keys = (
+                self.hparams.fea_augment.replicate_multiple_labels(
+                    tokens, token_lens, keys
+                )
+            )
+        hyps, hyp_lens, step_log_probs, _ = self.hparams.trajectory_sampler(
+            x.detach(), wav_lens
+        )
+        abs_lens = (token_lens * tokens.shape[1]).round().int()
+        log_r = hypothesis_log_rewards(
+            tokens, abs_lens, hyps, hyp_lens, self.hparams.reward
+        )
+        # reward of the full hypothesis, the empty ones have no reward
+        hyp_lens = hyp_lens.flatten()
+        kept = hyp_lens > 0
+        last = (hyp_lens - 1).clamp(min=0)[:, None]
+        log_r = log_r.gather(1, last).squeeze(1)
+        self.hparams.replay_buffer.add(
+            hyps.flatten(0, 1)[kept],
+            hyp_lens[kept],
+            log_r[kept],
+            step_log_probs.sum(-1).flatten()[kept],
+            keys.repeat_interleave(hyps.shape[1])[kept],
+        )
+
     def compute_objectives(self, predictions, batch, stage):
         """Computes the loss (Transducer+(CTC+NLL)) given predictions and targets."""
 
+        profiler = self.step_profiler
         ids = batch.id
         tokens, token_lens = batch.tokens
         tokens_eos, token_eos_lens = batch.tokens_eos
+        if self.hparams.reward.worker_safe:
+            log_r, _ = batch.log_r
+        else:
+            with profiler.stage("reward"):
+                log_r = self.hparams.reward(
+                    tokens, (token_lens * tokens.shape[1]).round().int()
+                )
 
-        # Train returns 4 elements vs 3 for val and test
-        if len(predictions) == 4:
-            p_ctc, p_ce, logits_transducer, wav_lens = predictions
+        # Train returns 5 elements vs 3 for val and test
+        if len(predictions) == 5:
+            p_ctc, p_ce, logits_transducer, wav_lens, lattice_kwargs = predictions
         else:
             logits_transducer, wav_lens, predicted_tokens = predictions
 
+        if stage == sb.Stage.TRAIN and hasattr(self.hparams, "log_z"):
+            # one lookup per utterance, replicated with the labels below
+            lattice_kwargs["log_z"] = self.hparams.log_z(
+                ids, (token_lens * tokens.shape[1]).round().int()
+            )
+
         if stage == sb.Stage.TRAIN:
             # Labels must be extended if parallel augmentation or concatenated
             # augmentation was performed on the input (increasing the time dimension)
@@ -168,73 +341,271 @@ class ASR(sb.Brain):
                     token_lens,
                     tokens_eos,
                     token_eos_lens,
+                    log_r,
                 ) = self.hparams.fea_augment.replicate_multiple_labels(
-                    tokens, token_lens, tokens_eos, token_eos_lens
+                    tokens, token_lens, tokens_eos, token_eos_lens, log_r
                 )
-
-        import editdistance
-        log_r = torch.zeros_like(tokens, dtype=torch.float32)
-        for b, seq in enumerate(tokens):
-            seq_l = int(token_lens[b] * tokens.shape[-1])
-            for t in range(seq_l):
-                log_r[b,t] = - editdistance.eval(seq[:seq_l], seq[:t+1]) / seq_l
+                if "log_z" in lattice_kwargs:
+                    lattice_kwargs["log_z"] = (
+                        self.hparams.fea_augment.replicate_labels(
+                            lattice_kwargs["log_z"]
+                        )
+                    )
 
         if stage == sb.Stage.TRAIN:
             CTC_loss = 0.0
             CE_loss = 0.0
             if p_ctc is not None:
-                CTC_loss = self.hparams.ctc_cost(
-                    p_ctc, tokens, wav_lens, token_lens
-                )
+                with profiler.stage("ctc_loss"):
+                    CTC_loss = self.hparams.ctc_cost(
+                        p_ctc, tokens, wav_lens, token_lens
+                    )
             if p_ce is not None:
-                CE_loss = self.hparams.ce_cost(
-                    p_ce, tokens_eos, length=token_eos_lens
+                with profiler.stage("ce_loss"):
+                    CE_loss = self.hparams.ce_cost(
+                        p_ce, tokens_eos, length=token_eos_lens
+                    )
+
+            # pruned or gathered lattice inputs are only understood by the
+            # losses of this recipe, so nothing is passed for the full lattice
+            with profiler.stage("transducer_loss"):
+                loss_transducer = self.hparams.transducer_cost(
+                    logits_transducer,
+                    tokens,
+                    log_r,
+                    wav_lens,
+                    token_lens,
+                    **lattice_kwargs,
                 )
-
-            loss_transducer = self.hparams.transducer_cost(
-                logits_transducer, tokens, log_r, wav_lens, token_lens
-            )
-            print(loss_transducer)
             loss = (
                 self.hparams.ctc_weight * CTC_loss
                 + self.hparams.ce_weight * CE_loss
                 + (1 - (self.hparams.ctc_weight + self.hparams.ce_weight))
                 * loss_transducer
             )
-        else:
-            loss = self.hparams.transducer_cost(
-                logits_transducer, tokens, log_r, wav_lens, token_lens
+            values = dict(
+                loss=loss,
+                transducer=loss_transducer,
+                ctc=CTC_loss,
+                ce=CE_loss,
+                log_z=lattice_kwargs.get("log_z"),
             )
+            if self.micro_batch_weight is None:
+                self.metrics.append(**values)
+            else:
+                # appended once for the whole batch by fit_batch
+                self.micro_batch_metrics.append(
+                    (self.micro_batch_weight, values)
+                )
+        else:
+            with profiler.stage("transducer_loss"):
+                loss = self.hparams.transducer_cost(
+                    logits_transducer, tokens, log_r, wav_lens, token_lens
+                )
 
         if stage != sb.Stage.TRAIN:
-            # Decode token terms to words
-            predicted_words = [
-                self.tokenizer.decode_ids(utt_seq).split(" ")
-                for utt_seq in predicted_tokens
-            ]
-            target_words = [wrd.split(" ") for wrd in batch.wrd]
-            self.wer_metric.append(ids, predicted_words, target_words)
-            self.cer_metric.append(ids, predicted_words, target_words)
+            with profiler.stage("wer"):
+                # Decode token terms to words
+                predicted_words = [
+                    self.tokenizer.decode_ids(utt_seq).split(" ")
+                    for utt_seq in predicted_tokens
+                ]
+                target_words = [wrd.split(" ") for wrd in batch.wrd]
+                self.wer_metric.append(ids, predicted_words, target_words)
+                self.cer_metric.append(ids, predicted_words, target_words)
+
+        if self.micro_batch_weight is None:
+            profiler.step(stage)
+        return loss
+
+    def init_optimizers(self):
+        """Adds the sparse optimizer of the logZ table, if any, to the
+        optimizer of the model."""
+        super().init_optimizers()
+        if hasattr(self.hparams, "log_z"):
+            self.hparams.log_z.to(self.device)
+            self.log_z_optimizer = self.hparams.log_z_opt_class(
+                self.hparams.log_z.parameters()
+            )
+            self.optimizers_dict["log_z"] = self.log_z_optimizer
+            if self.checkpointer is not None:
+                self.checkpointer.add_recoverable("log_z", self.hparams.log_z)
+                self.checkpointer.add_recoverable(
+                    "log_z_optimizer", self.log_z_optimizer
+                )
+
+    def fit_batch(self, batch):
+        """Same as Brain.fit_batch, but the loss stays on the device: the
+        training metrics are read on the host asynchronously. With a
+        calibrated memory model, a batch predicted not to fit on the device
+        is split into micro-batches whose gradients are accumulated."""
+        should_step = (self.step % self.grad_accumulation_factor) == 0
+        self.on_fit_batch_start(batch, should_step)
+
+        parts = self.micro_batches(batch)
+        if len(parts) == 1:
+            with self.no_sync(not should_step):
+                with self.training_ctx:
+                    outputs = self.compute_forward(batch, sb.Stage.TRAIN)
+                    loss = self.compute_objectives(
+                        outputs, batch, sb.Stage.TRAIN
+                    )
+                scaled_loss = self.scaler.scale(
+                    loss / self.grad_accumulation_factor
+                )
+                self.check_loss_isfinite(scaled_loss)
+                scaled_loss.backward()
+            loss = loss.detach()
+        else:
+            outputs, loss = self.fit_micro_batches(batch, parts, should_step)
+
+        if should_step:
+            if hasattr(self.hparams, "log_z"):
+                self.hparams.log_z.all_reduce_grad()
+            self.optimizers_step()
 
+        self.on_fit_batch_end(batch, outputs, loss, should_step)
         return loss
 
+    def fit_micro_batches(self, batch, parts, should_step):
+        """Accumulates the gradients of the micro-batches of a batch. Their
+        losses are weighted by their share of the batch, and the metrics,
+        non-finite check and profiled step are those of the whole batch."""
+        self.micro_batch_metrics = []
+        loss = 0.0
+        for i, index in enumerate(parts):
+            part = micro_batch(batch, index)
+            last = i == len(parts) - 1
+            self.micro_batch_weight = len(index) / len(batch)
+            with self.no_sync(not (should_step and last)):
+                with self.training_ctx:
+                    outputs = self.compute_forward(part, sb.Stage.TRAIN)
+                    part_loss = self.compute_objectives(
+                        outputs, part, sb.Stage.TRAIN
+                    )
+                part_loss = part_loss * self.micro_batch_weight
+                self.scaler.scale(
+                    part_loss / self.grad_accumulation_factor
+                ).backward()
+            loss = loss + part_loss.detach()
+        self.micro_batch_weight = None
+
+        self.check_loss_isfinite(
+            self.scaler.scale(loss / self.grad_accumulation_factor)
+        )
+        # batch losses as sums of the weighted micro-batch losses, and
+        # per-utterance values (log_z) concatenated
+        values, per_utterance = {}, {}
+        for weight, part_values in self.micro_batch_metrics:
+            for name, value in part_values.items():
+                if not torch.is_tensor(value):
+                    continue
+                value = value.detach()
+                if value.dim() > 0:
+                    per_utterance.setdefault(name, []).append(value)
+                else:
+                    values[name] = values.get(name, 0.0) + weight * value
+        for name, parts_values in per_utterance.items():
+            values[name] = torch.cat(parts_values)
+        self.metrics.append(**values)
+        self.micro_batch_metrics = []
+        self.step_profiler.step(sb.Stage.TRAIN)
+        return outputs, loss
+
+    def micro_batches(self, batch):
+        """Indices of the micro-batches of a batch, a single one unless the
+        calibrated memory model predicts that the batch does not fit."""
+        memory_model = getattr(self.hparams, "memory_model", None)
+        if (
+            memory_model is None
+            or not memory_model.calibrated
+            or torch.device(self.device).type != "cuda"
+        ):
+            return [list(range(len(batch)))]
+        wavs, wav_lens = batch.sig
+        tokens, token_lens = batch.tokens
+        durations = wav_lens * wavs.shape[1] / self.hparams.sample_rate
+        token_counts = (token_lens * tokens.shape[1]).round().int()
+        return memory_model.split(durations.tolist(), token_counts.tolist())
+
+    def check_loss_isfinite(self, loss):
+        """Counts the non-finite training losses on the device, the patience
+        is checked when the metrics are read."""
+        if self.metrics is None:
+            return super().check_loss_isfinite(loss)
+        self.metrics.append(nonfinite=(~torch.isfinite(loss)).float())
+
+    def update_average(self, loss, avg_loss):
+        """During training, returns the average loss of the metrics read on
+        the host so far instead of waiting for the loss of this step."""
+        if self.metrics is None:
+            return super().update_average(loss, avg_loss)
+        self.metrics.step(self.step)
+        total, count = self.metrics.totals.get("nonfinite", (0.0, 0.0))
+        self.nonfinite_count = int(total)
+        if self.nonfinite_count > self.nonfinite_patience:
+            raise ValueError(
+                "Loss is not finite and patience is exhausted ({} steps)".format(
+                    self.nonfinite_count
+                )
+            )
+        return self.metrics.average("loss")
+
+    def _calibrating_memory(self):
+        memory_model = getattr(self.hparams, "memory_model", None)
+        return (
+            memory_model is not None
+            and not memory_model.calibrated
+            and torch.device(self.device).type == "cuda"
+        )
+
+    def on_fit_batch_start(self, batch, should_step):
+        """Resets the peak memory statistics while the memory model is
+        being calibrated."""
+        if self._calibrating_memory():
+            torch.cuda.reset_peak_memory_stats(self.device)
+
     def on_fit_batch_end(self, batch, outputs, loss, should_step):
         """At the end of the optimizer step, apply noam annealing."""
         if should_step:
             self.hparams.noam_annealing(self.optimizer)
 
+        if self._calibrating_memory():
+            # the allocator statistics are kept on the host, no device sync
+            wavs, _ = batch.sig
+            self.hparams.memory_model.observe(
+                wavs.shape[0],
+                wavs.shape[1] / self.hparams.sample_rate,
+                self.lattice_shape,
+                torch.cuda.max_memory_allocated(self.device),
+            )
+
     def on_stage_start(self, stage, epoch):
         """Gets called at the beginning of each epoch"""
-        if stage != sb.Stage.TRAIN:
+        self.metrics = None
+        if stage == sb.Stage.TRAIN:
+            self.metrics = DeviceMetrics(
+                self.hparams.train_logger,
+                getattr(self.hparams, "metrics_flush_every", 100),
+            )
+        else:
             self.cer_metric = self.hparams.cer_computer()
             self.wer_metric = self.hparams.error_rate_computer()
 
     def on_stage_end(self, stage, stage_loss, epoch):
         """Gets called at the end of a epoch."""
+        self.step_profiler.summary()
+
         # Compute/store important stats
         stage_stats = {"loss": stage_loss}
         if stage == sb.Stage.TRAIN:
+            # exact averages of the epoch, waiting for the last steps
+            stage_stats.update(self.metrics.summarize(self.step))
+            stage_stats.pop("nonfinite", None)
+            self.metrics = None
             self.train_stats = stage_stats
+            if hasattr(self.hparams, "replay_buffer"):
+                self.hparams.replay_buffer.flush()
         else:
             stage_stats["CER"] = self.cer_metric.summarize("error_rate")
             stage_stats["WER"] = self.wer_metric.summarize("error_rate")
@@ -304,15 +675,50 @@ class ASR(sb.Brain):
         self.hparams.model.eval()
 
 
+def micro_batch(batch, index):
+    """
+    Sub-batch of a PaddedBatch, padded to its own longest utterance.
+
+    Arguments
+    ---------
+    batch : speechbrain.dataio.batch.PaddedBatch
+        The batch.
+    index : list
+        Positions of the utterances of the sub-batch.
+
+    Returns
+    -------
+    speechbrain.dataio.batch.PaddedBatch
+        The sub-batch.
+    """
+    examples = [{} for _ in index]
+    padded_keys = []
+    # the data keys are the public attributes of the batch
+    for key, value in vars(batch).items():
+        if key.startswith("_"):
+            continue
+        if isinstance(value, PaddedData):
+            padded_keys.append(key)
+        for example, i in zip(examples, index):
+            if isinstance(value, PaddedData):
+                data, lengths = value
+                length = int(torch.round(lengths[i] * data.shape[1]))
+                example[key] = data[i, :length]
+            else:
+                example[key] = value[i]
+    return PaddedBatch(examples, padded_keys=padded_keys)
+
+
 def dataio_prepare(hparams):
     """This function prepares the datasets to be used in the brain class.
     It also defines the data processing pipeline through user-defined functions.
     """
     data_folder = hparams["data_folder"]
 
-    train_data = sb.dataio.dataset.DynamicItemDataset.from_csv(
-        csv_path=hparams["train_csv"],
-        replacements={"data_root": data_folder},
+    binary = hparams.get("binary_manifest", False)
+
+    train_data = load_manifest(
+        hparams["train_csv"], {"data_root": data_folder}, binary
     )
 
     if hparams["sorting"] == "ascending":
@@ -336,9 +742,8 @@ def dataio_prepare(hparams):
             "sorting must be random, ascending or descending"
         )
 
-    valid_data = sb.dataio.dataset.DynamicItemDataset.from_csv(
-        csv_path=hparams["valid_csv"],
-        replacements={"data_root": data_folder},
+    valid_data = load_manifest(
+        hparams["valid_csv"], {"data_root": data_folder}, binary
     )
     valid_data = valid_data.filtered_sorted(sort_key="duration")
 
@@ -346,8 +751,8 @@ def dataio_prepare(hparams):
     test_datasets = {}
     for csv_file in hparams["test_csv"]:
         name = Path(csv_file).stem
-        test_datasets[name] = sb.dataio.dataset.DynamicItemDataset.from_csv(
-            csv_path=csv_file, replacements={"data_root": data_folder}
+        test_datasets[name] = load_manifest(
+            csv_file, {"data_root": data_folder}, binary
         )
         test_datasets[name] = test_datasets[name].filtered_sorted(
             sort_key="duration"
@@ -359,38 +764,118 @@ def dataio_prepare(hparams):
     # To avoid mismatch, we have to use the same tokenizer used for LM training
     tokenizer = hparams["tokenizer"]
 
+    csv_files = [hparams["train_csv"], hparams["valid_csv"]]
+    csv_files += hparams["test_csv"]
+    # the training set streamed from tar shards (step 6) needs no audio
+    # shards nor token store
+    streaming = bool(hparams.get("tar_shard_folder"))
+
+    # Audio of every split, decoded once into memory-mapped int16 shards
+    audio_shards = [None] * len(datasets)
+    if hparams.get("audio_shard_folder"):
+        audio_shards = []
+        for i, csv_file in enumerate(csv_files):
+            if streaming and i == 0:
+                audio_shards.append(None)
+                continue
+            prefix = os.path.join(
+                hparams["audio_shard_folder"], Path(csv_file).stem
+            )
+            run_on_main(
+                prepare_audio_shards,
+                args=[csv_file, prefix],
+                kwargs={"replacements": {"data_root": data_folder}},
+            )
+            audio_shards.append(AudioShards(prefix))
+
     # 2. Define audio pipeline:
-    @sb.utils.data_pipeline.takes("wav")
-    @sb.utils.data_pipeline.provides("sig")
-    def audio_pipeline(wav):
-        sig = sb.dataio.dataio.read_audio(wav)
-        return sig
+    def audio_pipeline_from(shards):
+        @sb.utils.data_pipeline.takes("id", "wav")
+        @sb.utils.data_pipeline.provides("sig")
+        def audio_pipeline(utt_id, wav):
+            if shards is None:
+                return sb.dataio.dataio.read_audio(wav)
+            return shards[utt_id]
+
+        return audio_pipeline
+
+    for dataset, shards in zip(datasets, audio_shards):
+        sb.dataio.dataset.add_dynamic_item(
+            [dataset], audio_pipeline_from(shards)
+        )
 
-    sb.dataio.dataset.add_dynamic_item(datasets, audio_pipeline)
+    # Token ids of every split, encoded once and memory-mapped. Their counts
+    # are added to the data points for the batch samplers.
+    token_stores = [None] * len(datasets)
+    if hparams.get("token_folder"):
+        token_stores = []
+        for i, (dataset, csv_file) in enumerate(zip(datasets, csv_files)):
+            if streaming and i == 0:
+                token_stores.append(None)
+                continue
+            prefix = os.path.join(hparams["token_folder"], Path(csv_file).stem)
+            run_on_main(prepare_token_store, args=[csv_file, prefix, tokenizer])
+            token_store = TokenStore(prefix)
+            if isinstance(dataset.data, BinaryManifest):
+                dataset.data.add_column("n_tokens", token_store.counts())
+            else:
+                for utt_id, n_tokens in token_store.counts().items():
+                    if utt_id in dataset.data:
+                        dataset.data[utt_id]["n_tokens"] = n_tokens
+            token_stores.append(token_store)
 
     # 3. Define text pipeline:
-    @sb.utils.data_pipeline.takes("wrd")
-    @sb.utils.data_pipeline.provides(
-        "wrd", "tokens_list", "tokens_bos", "tokens_eos", "tokens"
-    )
-    def text_pipeline(wrd):
-        yield wrd
-        tokens_list = tokenizer.encode_as_ids(wrd)
-        yield tokens_list
-        tokens_bos = torch.LongTensor([hparams["bos_index"]] + (tokens_list))
-        yield tokens_bos
-        tokens_eos = torch.LongTensor(tokens_list + [hparams["eos_index"]])
-        yield tokens_eos
-        tokens = torch.LongTensor(tokens_list)
-        yield tokens
-
-    sb.dataio.dataset.add_dynamic_item(datasets, text_pipeline)
+    def text_pipeline_from(token_store):
+        @sb.utils.data_pipeline.takes("id", "wrd")
+        @sb.utils.data_pipeline.provides(
+            "wrd", "tokens_list", "tokens_bos", "tokens_eos", "tokens"
+        )
+        def text_pipeline(utt_id, wrd):
+            yield wrd
+            if token_store is None:
+                tokens_list = tokenizer.encode_as_ids(wrd)
+            else:
+                tokens_list = token_store[utt_id]
+            yield tokens_list
+            tokens_bos = torch.LongTensor(
+                [hparams["bos_index"]] + (tokens_list)
+            )
+            yield tokens_bos
+            tokens_eos = torch.LongTensor(tokens_list + [hparams["eos_index"]])
+            yield tokens_eos
+            tokens = torch.LongTensor(tokens_list)
+            yield tokens
+
+        return text_pipeline
+
+    for dataset, token_store in zip(datasets, token_stores):
+        sb.dataio.dataset.add_dynamic_item(
+            [dataset], text_pipeline_from(token_store)
+        )
+
+    output_keys = ["id", "sig", "wrd", "tokens_bos", "tokens_eos", "tokens"]
+
+    # GFN rewards of every prefix of the tokens, computed in the dataloader
+    # workers and memoized on disk across epochs and runs. The other rewards
+    # are computed on the training device by compute_objectives.
+    reward = hparams["reward"]
+    if reward.worker_safe:
+        reward_cache = None
+        if hparams.get("reward_cache"):
+            reward_cache = RewardCache(hparams["reward_cache"], reward.name)
+
+        @sb.utils.data_pipeline.takes("id", "tokens")
+        @sb.utils.data_pipeline.provides("log_r")
+        def reward_pipeline(utt_id, tokens):
+            if reward_cache is None:
+                return reward.utterance(tokens)
+            return reward_cache.get(utt_id, tokens, reward.utterance)
+
+        sb.dataio.dataset.add_dynamic_item(datasets, reward_pipeline)
+        output_keys.append("log_r")
 
     # 4. Set output:
-    sb.dataio.dataset.set_output_keys(
-        datasets,
-        ["id", "sig", "wrd", "tokens_bos", "tokens_eos", "tokens"],
-    )
+    sb.dataio.dataset.set_output_keys(datasets, output_keys)
 
     # 5. If Dynamic Batching is used, we instantiate the needed samplers.
     train_batch_sampler = None
@@ -401,23 +886,113 @@ def dataio_prepare(hparams):
         dynamic_hparams = hparams["dynamic_batch_sampler"]
         num_buckets = dynamic_hparams["num_buckets"]
 
-        train_batch_sampler = DynamicBatchSampler(
-            train_data,
-            dynamic_hparams["max_batch_len"],
-            num_buckets=num_buckets,
-            length_func=lambda x: x["duration"],
-            shuffle=dynamic_hparams["shuffle_ex"],
-            batch_ordering=dynamic_hparams["batch_ordering"],
+        if dynamic_hparams.get("max_batch_cost"):
+            # batches packed to a budget of padded lattice cost B * T * U * V,
+            # or of predicted peak bytes when the memory model is configured
+            memory_model = hparams.get("memory_model")
+            if memory_model is not None and not memory_model.calibrated:
+                logger.warning(
+                    "Memory model not calibrated on this device yet, the "
+                    "batch budgets only cover the lattice bytes"
+                )
+            train_batch_sampler = LatticeCostBatchSampler(
+                train_data,
+                dynamic_hparams["max_batch_cost"],
+                hparams["output_neurons"],
+                num_buckets=num_buckets,
+                subsampling=dynamic_hparams["subsampling"],
+                shuffle=dynamic_hparams["shuffle_ex"],
+                batch_ordering=dynamic_hparams["batch_ordering"],
+                max_batch_ex=dynamic_hparams["max_batch_ex"],
+                memory_model=memory_model,
+            )
+
+            valid_batch_sampler = LatticeCostBatchSampler(
+                valid_data,
+                dynamic_hparams["max_batch_cost_val"],
+                hparams["output_neurons"],
+                num_buckets=num_buckets,
+                subsampling=dynamic_hparams["subsampling"],
+                shuffle=dynamic_hparams["shuffle_ex"],
+                batch_ordering=dynamic_hparams["batch_ordering"],
+                max_batch_ex=dynamic_hparams["max_batch_ex"],
+                memory_model=memory_model,
+            )
+        else:
+            train_batch_sampler = DynamicBatchSampler(
+                train_data,
+                dynamic_hparams["max_batch_len"],
+                num_buckets=num_buckets,
+                length_func=lambda x: x["duration"],
+                shuffle=dynamic_hparams["shuffle_ex"],
+                batch_ordering=dynamic_hparams["batch_ordering"],
+            )
+
+            valid_batch_sampler = DynamicBatchSampler(
+                valid_data,
+                dynamic_hparams["max_batch_len_val"],
+                num_buckets=num_buckets,
+                length_func=lambda x: x["duration"],
+                shuffle=dynamic_hparams["shuffle_ex"],
+                batch_ordering=dynamic_hparams["batch_ordering"],
+            )
+    elif audio_shards[0] is not None and hparams["sorting"] == "random":
+        # sequential reads of the shards, a bucket of neighbours at a time
+        hparams["train_dataloader_opts"]["sampler"] = (
+            BucketedSequentialSampler(train_data, audio_shards[0])
+        )
+
+    # 6. Streaming of the training set from tar shards (e.g. on a network
+    # filesystem), in batches of batch_size utterances.
+    if streaming:
+        from librispeech_prepare import export_tar_shards  # noqa
+
+        run_on_main(
+            export_tar_shards,
+            args=[hparams["train_csv"], hparams["tar_shard_folder"]],
+            kwargs={
+                "samples_per_shard": hparams["tar_samples_per_shard"],
+                "tokenizer": tokenizer,
+                "replacements": {"data_root": data_folder},
+            },
         )
 
-        valid_batch_sampler = DynamicBatchSampler(
-            valid_data,
-            dynamic_hparams["max_batch_len_val"],
-            num_buckets=num_buckets,
-            length_func=lambda x: x["duration"],
-            shuffle=dynamic_hparams["shuffle_ex"],
-            batch_ordering=dynamic_hparams["batch_ordering"],
+        def tar_pipeline(utt):
+            """Outputs of the pipelines above, for an utterance of a shard."""
+            if "tokens" in utt:
+                tokens_list = utt["tokens"]
+            else:
+                tokens_list = tokenizer.encode_as_ids(utt["wrd"])
+            item = {
+                "id": utt["id"],
+                "sig": utt["sig"],
+                "wrd": utt["wrd"],
+                "tokens_bos": torch.LongTensor(
+                    [hparams["bos_index"]] + tokens_list
+                ),
+                "tokens_eos": torch.LongTensor(
+                    tokens_list + [hparams["eos_index"]]
+                ),
+                "tokens": torch.LongTensor(tokens_list),
+            }
+            if "log_r" in output_keys:
+                item["log_r"] = reward_pipeline(item["id"], item["tokens"])
+            return item
+
+        name = Path(hparams["train_csv"]).stem
+        index_file = os.path.join(hparams["tar_shard_folder"], name + ".json")
+        train_data = TarShardDataset(
+            index_file,
+            pipeline=tar_pipeline,
+            shuffle=hparams["sorting"] == "random",
+            shuffle_buffer=hparams["tar_shuffle_buffer"],
+            epoch_counter=hparams["epoch_counter"],
         )
+        train_batch_sampler = None
+        # the dataset shuffles by itself, through its shuffle buffer
+        hparams["train_dataloader_opts"].pop("shuffle", None)
+        hparams["train_dataloader_opts"].pop("sampler", None)
+        hparams["train_dataloader_opts"]["collate_fn"] = PaddedBatch
 
     return (
         train_data,
@@ -433,13 +1008,6 @@ if __name__ == "__main__":
     # CLI:
     hparams_file, run_opts, overrides = sb.parse_arguments(sys.argv[1:])
 
-    # Use torchaudio if the device is CPU
-    if run_opts.get("device") == "cpu":
-        if "use_torchaudio: True" in overrides:
-            overrides.replace("use_torchaudio: True", "use_torchaudio: False")
-        else:
-            overrides += "\nuse_torchaudio: True"
-
     # create ddp_group with the right communication protocol
     sb.utils.distributed.ddp_init_group(run_opts)
 
@@ -468,9 +1036,20 @@ if __name__ == "__main__":
             "merge_lst": hparams["train_splits"],
             "merge_name": "train.csv",
             "skip_prep": hparams["skip_prep"],
+            "binary_manifest": hparams.get("binary_manifest", False),
         },
     )
 
+    # default GFN reward of older hparams files
+    hparams.setdefault("reward", Reward())
+
+    # We download the pretrained LM and the tokenizer from HuggingFace (or elsewhere
+    # depending on the path given in the YAML file). The tokenizer is loaded at
+    # the same time, before the token stores and tar shards of the manifests
+    # are built with it.
+    hparams["pretrainer"].collect_files()
+    hparams["pretrainer"].load_collected()
+
     # here we create the datasets objects as well as tokenization and encoding
     (
         train_data,
@@ -481,11 +1060,13 @@ if __name__ == "__main__":
         valid_bsampler,
     ) = dataio_prepare(hparams)
 
-    # We download the pretrained LM and the tokenizer from HuggingFace (or elsewhere
-    # depending on the path given in the YAML file). The tokenizer is loaded at
-    # the same time.
-    hparams["pretrainer"].collect_files()
-    hparams["pretrainer"].load_collected()
+    # rows of the logZ table from the training manifest, the same on every
+    # process
+    if "log_z" in hparams:
+        with open(hparams["train_csv"], newline="", encoding="utf-8") as fin:
+            hparams["log_z"].register_ids(
+                row["ID"] for row in csv.DictReader(fin)
+            )
 
     # Trainer initialization
     asr_brain = ASR(
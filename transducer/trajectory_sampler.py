@@ -0,0 +1,294 @@
+"""
+Samplers drawing alignment trajectories from a transducer model, to feed
+the GFN objective with exploration samples. All the K samples of all the
+utterances of a batch advance together, one lattice step at a time, so the
+cost grows with K * B tensor rows rather than with Python work per
+hypothesis. Sampling uses the Gumbel-max trick on the log-probs divided by
+the temperature, and runs on any device.
+"""
+
+import torch
+
+from lattice import gather_blank_and_label
+
+
+def _gumbel(shape, device, generator=None):
+    """Standard Gumbel noise."""
+    u = torch.rand(shape, device=device, generator=generator)
+    return -torch.log(-torch.log(u.clamp(min=1e-20)))
+
+
+@torch.no_grad()
+def sample_lattice_paths(
+    log_probs,
+    labels,
+    T,
+    U,
+    blank,
+    num_samples=1,
+    temperature=1.0,
+    generator=None,
+):
+    """
+    Draws num_samples paths per utterance through the lattice of the
+    (batch x TimeLength x LabelLength x outputDim) output of the joint
+    network. From node (t, u), a path either emits blank and moves to
+    (t + 1, u), or emits labels[b, u] and moves to (t, u + 1); the choice is
+    sampled between these two arcs only. A path ends after its T[b] blanks,
+    on the prefix labels[b, :u] it reached, and its log-prob under the
+    model is the sum of the returned step log-probs.
+
+    Arguments
+    ---------
+    log_probs : torch.Tensor
+        4D Tensor of (batch x TimeLength x LabelLength x outputDim), normalized.
+    labels : torch.Tensor
+        2D Tensor of (batch x MaxSeqLabelLength) containing targets of the batch with zero padding.
+    T : torch.Tensor
+        1D Tensor of (batch) containing TimeLength of each target.
+    U : torch.Tensor
+        1D Tensor of (batch) containing LabelLength of each target.
+    blank : int
+        Blank index.
+    num_samples : int
+        Number of paths K drawn per utterance.
+    temperature : float
+        Temperature applied to the log-probs before sampling.
+    generator : torch.Generator
+        Optional random generator.
+
+    Returns
+    -------
+    tokens : torch.Tensor
+        3D Tensor of (batch x K x MaxSeqLabelLength), the prefix of labels
+        reached by every path, zero padded.
+    token_lens : torch.Tensor
+        2D Tensor of (batch x K) with the length of the prefixes.
+    step_log_probs : torch.Tensor
+        3D Tensor of (batch x K x Steps) with the model log-prob of every
+        arc taken, zero after the end of the path.
+    paths : torch.Tensor
+        4D Tensor of (batch x K x Steps x 2) with the (t, u) node every arc
+        leaves from, -1 after the end of the path.
+    """
+    B, maxT, maxU, _ = log_probs.shape
+    K = num_samples
+    device = log_probs.device
+    blank_lp, label_lp = gather_blank_and_label(log_probs, labels, blank)
+    T = T.to(device).long()[:, None].expand(B, K)
+    U = U.to(device).long()[:, None].expand(B, K)
+
+    steps = maxT + maxU - 1
+    step_log_probs = blank_lp.new_zeros(B, K, steps)
+    paths = torch.full((B, K, steps, 2), -1, dtype=torch.long, device=device)
+    batch = torch.arange(B, device=device)[:, None].expand(B, K)
+    t = torch.zeros(B, K, dtype=torch.long, device=device)
+    u = torch.zeros_like(t)
+    for step in range(steps):
+        active = t < T
+        if not active.any():
+            break
+        tc = t.clamp(max=maxT - 1)
+        b_lp = blank_lp[batch, tc, u]
+        l_lp = label_lp[batch, tc, u]
+        noise = _gumbel((2, B, K), device, generator)
+        emit = (u < U) & (
+            l_lp / temperature + noise[1] > b_lp / temperature + noise[0]
+        )
+        step_log_probs[:, :, step] = torch.where(
+            active, torch.where(emit, l_lp, b_lp), 0.0
+        )
+        paths[:, :, step] = torch.where(
+            active[..., None], torch.stack((t, u), dim=-1), -1
+        )
+        u = u + (active & emit).long()
+        t = t + (active & ~emit).long()
+
+    L = labels.shape[1]
+    position = torch.arange(L, device=device)
+    tokens = labels.to(device)[:, None, :].expand(B, K, L)
+    tokens = torch.where(position < u[..., None], tokens, 0)
+    return tokens, u, step_log_probs, paths
+
+
+class TrajectorySampler(torch.nn.Module):
+    """
+    Samples K hypotheses per utterance from the transducer, running the
+    prediction network on the sampled tokens, so that hypotheses may leave
+    the reference lattice. The samples of the whole batch are processed
+    together, frame by frame, with up to max_symbols_per_step emissions per
+    frame like the greedy searcher.
+
+    Arguments
+    ---------
+    decode_network_lst : list
+        List of prediction network (PN) layers.
+    tjoint : torch.nn.Module
+        Module joining the transcription and prediction networks.
+    classifier_network : list
+        List of output layers (after performing joint between TN and PN).
+    blank_id : int
+        The blank symbol/index.
+    num_samples : int
+        Number of trajectories K drawn per utterance.
+    temperature : float
+        Temperature applied to the log-probs before sampling.
+    max_symbols_per_step : int
+        Maximum number of non-blank symbols sampled per frame, blank is
+        forced afterwards.
+
+    Example
+    -------
+    >>> from speechbrain.nnet.transducer.transducer_joint import Transducer_joint
+    >>> from speechbrain.nnet.RNN import GRU
+    >>> from speechbrain.nnet.linear import Linear
+    >>> from speechbrain.nnet.embedding import Embedding
+    >>> emb = Embedding(num_embeddings=5, consider_as_one_hot=True, blank_id=0)
+    >>> dec = GRU(hidden_size=35, input_shape=(1, 40, 4), bidirectional=False)
+    >>> joint = Transducer_joint(joint="sum")
+    >>> out = Linear(input_shape=(1, 40, 35), n_neurons=5)
+    >>> sampler = TrajectorySampler([emb, dec], joint, [out], 0, num_samples=3)
+    >>> tokens, token_lens, step_log_probs, paths = sampler(torch.rand(2, 6, 35))
+    >>> tokens.shape[:2], paths.shape[-1]
+    (torch.Size([2, 3]), 2)
+    """
+
+    def __init__(
+        self,
+        decode_network_lst,
+        tjoint,
+        classifier_network,
+        blank_id,
+        num_samples=1,
+        temperature=1.0,
+        max_symbols_per_step=5,
+    ):
+        super().__init__()
+        self.decode_network_lst = decode_network_lst
+        self.tjoint = tjoint
+        self.classifier_network = classifier_network
+        self.blank_id = blank_id
+        self.num_samples = num_samples
+        self.temperature = temperature
+        self.max_symbols_per_step = max_symbols_per_step
+
+    def _forward_PN(self, out_PN, hidden=None):
+        for layer in self.decode_network_lst:
+            if layer.__class__.__name__ in [
+                "RNN",
+                "LSTM",
+                "GRU",
+                "LiGRU",
+                "LiGRU_Layer",
+            ]:
+                out_PN, hidden = layer(out_PN, hidden)
+            else:
+                out_PN = layer(out_PN)
+        return out_PN, hidden
+
+    def _log_probs(self, tn_step, out_PN):
+        out = self.tjoint(tn_step[:, None, None, :], out_PN[:, None, :, :])
+        for layer in self.classifier_network:
+            out = layer(out)
+        return out[:, 0, 0].float().log_softmax(-1)
+
+    @staticmethod
+    def _update_hiddens(mask, new, old):
+        """Keeps the new (layers x batch x hiddens) state where mask is set."""
+        if isinstance(old, tuple):
+            return tuple(
+                torch.where(mask[None, :, None], n, o) for n, o in zip(new, old)
+            )
+        return torch.where(mask[None, :, None], new, old)
+
+    @torch.no_grad()
+    def forward(self, tn_output, tn_lens=None, generator=None):
+        """
+        Samples the trajectories.
+
+        Arguments
+        ---------
+        tn_output : torch.Tensor
+            Output from transcription network with shape
+            [batch, time_len, hiddens].
+        tn_lens : torch.Tensor
+            Relative length of every utterance. Defaults to full length.
+        generator : torch.Generator
+            Optional random generator.
+
+        Returns
+        -------
+        tokens : torch.Tensor
+            3D Tensor of (batch x K x MaxHypLength), zero padded.
+        token_lens : torch.Tensor
+            2D Tensor of (batch x K) with the length of every hypothesis.
+        step_log_probs : torch.Tensor
+            3D Tensor of (batch x K x Steps) with the model log-prob of every
+            step (emission or blank), zero after the end of the trajectory.
+        paths : torch.Tensor
+            4D Tensor of (batch x K x Steps x 2) with the (t, u) node every
+            step leaves from, -1 after the end of the trajectory.
+        """
+        B, maxT, _ = tn_output.shape
+        K = self.num_samples
+        BK = B * K
+        device = tn_output.device
+        if tn_lens is None:
+            T = torch.full((B,), maxT, device=device, dtype=torch.long)
+        else:
+            T = (tn_lens.to(device) * maxT).round().long()
+        T = T.repeat_interleave(K)
+        tn_output = tn_output.repeat_interleave(K, dim=0)
+
+        max_steps = maxT * (self.max_symbols_per_step + 1)
+        tokens = torch.zeros(
+            BK, maxT * self.max_symbols_per_step, dtype=torch.long, device=device
+        )
+        step_log_probs = torch.zeros(BK, max_steps, device=device)
+        paths = torch.full((BK, max_steps, 2), -1, dtype=torch.long, device=device)
+
+        # BOS = blank for the prediction network
+        input_PN = torch.full((BK, 1), self.blank_id, device=device, dtype=torch.long)
+        out_PN, hidden = self._forward_PN(input_PN)
+        rows = torch.arange(BK, device=device)
+        u = torch.zeros(BK, dtype=torch.long, device=device)
+        n_steps = torch.zeros_like(u)
+        for t in range(maxT):
+            pending = t < T
+            for count in range(self.max_symbols_per_step + 1):
+                if not pending.any():
+                    break
+                log_probs = self._log_probs(tn_output[:, t], out_PN)
+                scores = log_probs / self.temperature + _gumbel(
+                    log_probs.shape, device, generator
+                )
+                token = scores.argmax(-1)
+                if count == self.max_symbols_per_step:
+                    token = torch.full_like(token, self.blank_id)
+
+                idx = rows[pending]
+                step = n_steps[idx]
+                step_log_probs[idx, step] = log_probs[idx, token[idx]]
+                paths[idx, step, 0] = t
+                paths[idx, step, 1] = u[idx]
+                n_steps = n_steps + pending.long()
+
+                emit = pending & (token != self.blank_id)
+                if emit.any():
+                    tokens[rows[emit], u[emit]] = token[emit]
+                    u = u + emit.long()
+                    new_PN, new_hidden = self._forward_PN(
+                        token[:, None], hidden
+                    )
+                    out_PN = torch.where(emit[:, None, None], new_PN, out_PN)
+                    hidden = self._update_hiddens(emit, new_hidden, hidden)
+                pending = emit
+
+        L = max(int(u.max()), 1)
+        S = max(int(n_steps.max()), 1)
+        return (
+            tokens[:, :L].view(B, K, L),
+            u.view(B, K),
+            step_log_probs[:, :S].view(B, K, S),
+            paths[:, :S].view(B, K, S, 2),
+        )
@@ -16,6 +16,15 @@ from torch.nn import Module
 
 from speechbrain.utils.logger import get_logger
 
+from lattice import (
+    COMPACT_BLANK,
+    COMPACT_LABEL,
+    compact_lattice_inputs,
+    pruned_lattice_inputs,
+    pruned_transducer,
+    wavefront_transducer,
+)
+
 NUMBA_VERBOSE = 0
 
 logger = get_logger(__name__)
@@ -410,6 +419,10 @@ def transducer_loss(
     blank_index,
     reduction="mean",
     use_torchaudio=True,
+    backend="numba",
+    compact=False,
+    band_starts=None,
+    gathered=False,
 ):
     """Transducer loss, see `speechbrain/nnet/loss/transducer_loss.py`.
 
@@ -430,6 +443,24 @@ def transducer_loss(
     use_torchaudio: bool
         If True, use Transducer loss implementation from torchaudio, otherwise,
         use Speechbrain Numba implementation.
+    backend : str
+        Lattice engine used when use_torchaudio is False: 'numba' (CUDA
+        kernels) | 'wavefront' (PyTorch anti-diagonal sweep, runs on CPU,
+        differentiated by autograd).
+    compact : bool
+        If True (and use_torchaudio is False), gather the blank and label
+        log-probs into a [batch, maxT, maxU, 2] tensor before running the
+        lattice engine, instead of taking the log_softmax over all the labels.
+    band_starts : torch.Tensor
+        First label position of the band of every frame, of shape
+        [batch, maxT], as returned by `lattice.select_band`. When given,
+        logits only cover the band, i.e. are of shape [batch, maxT, W,
+        num_labels], and the pruned lattice engine is used instead of
+        torchaudio or the engine selected by backend.
+    gathered : bool
+        If True, logits already hold the [batch, maxT, maxU|W, 2] blank and
+        label log-probs, e.g. from `lattice.chunked_joint`, and the numba or
+        wavefront engine is used instead of torchaudio.
 
     Returns
     -------
@@ -438,7 +469,16 @@ def transducer_loss(
     input_lens = (input_lens * logits.shape[1]).round().int()
     target_lens = (target_lens * targets.shape[1]).round().int()
 
-    if use_torchaudio:
+    if band_starts is not None:
+        if not gathered:
+            logits = pruned_lattice_inputs(
+                logits, targets, band_starts, blank_index
+            )
+        return pruned_transducer(
+            logits, band_starts, input_lens, target_lens, reduction
+        )
+
+    if use_torchaudio and not gathered:
         try:
             from torchaudio.functional import rnnt_loss
         except ImportError:
@@ -457,10 +497,24 @@ def transducer_loss(
             blank=blank_index,
             reduction=reduction,
         )
-    else:
 
-        # Transducer.apply function take log_probs tensor.
+    # Transducer.apply function take log_probs tensor.
+    if gathered:
+        log_probs = logits
+        targets = torch.full_like(targets, COMPACT_LABEL)
+        blank_index = COMPACT_BLANK
+    elif compact:
+        log_probs, targets, blank_index = compact_lattice_inputs(
+            logits, targets, blank_index
+        )
+    else:
         log_probs = logits.log_softmax(-1)
+
+    if backend == "wavefront":
+        return wavefront_transducer(
+            log_probs, targets, input_lens, target_lens, blank_index, reduction
+        )
+    else:
         return Transducer.apply(
             log_probs, targets, input_lens, target_lens, blank_index, reduction
         )
@@ -0,0 +1,259 @@
+"""
+Columnar binary manifests, memory-mapped instead of parsed.
+
+DynamicItemDataset.from_csv parses the whole manifest into Python dicts at
+every start, and every forked dataloader worker touches, hence copies, these
+dicts. A binary manifest keeps the same columns in two files written once by
+the data preparation:
+
+ * prefix + '_index.npy': a NumPy structured array with one row per
+   utterance, sorted by ID: the fixed-width ID, the duration and the
+   (offset, length) of every other column in the string blob;
+ * prefix + '_strings.bin': the UTF-8 bytes of the string columns (paths,
+   speakers, words).
+
+Both are memory-mapped, so loading is near-instant and all the workers
+share the same pages. A row is decoded into a data point only when it is
+read.
+"""
+
+import csv
+import os
+from collections.abc import Mapping
+
+import numpy as np
+
+import speechbrain as sb
+from speechbrain.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+def binary_manifest_exists(prefix):
+    """Whether both files of a binary manifest exist."""
+    return os.path.isfile(prefix + "_index.npy") and os.path.isfile(
+        prefix + "_strings.bin"
+    )
+
+
+def write_binary_manifest(csv_file, prefix=None):
+    """
+    Converts a manifest to a binary manifest.
+
+    Arguments
+    ---------
+    csv_file : str
+        Manifest with an 'ID' and a 'duration' column.
+    prefix : str
+        Path prefix of the binary manifest, defaults to csv_file without
+        its extension.
+    """
+    if prefix is None:
+        prefix = os.path.splitext(csv_file)[0]
+
+    with open(csv_file, newline="", encoding="utf-8") as fin:
+        reader = csv.DictReader(fin)
+        columns = [c for c in reader.fieldnames if c not in ("ID", "duration")]
+        rows = sorted(reader, key=lambda row: row["ID"])
+
+    ids = [row["ID"].encode("utf-8") for row in rows]
+    dtype = [("ID", "S{}".format(max(map(len, ids), default=1)))]
+    dtype += [("duration", "f8")]
+    dtype += [(column, "i8", (2,)) for column in columns]
+    index = np.zeros(len(rows), dtype=dtype)
+    index["ID"] = ids
+    index["duration"] = [float(row["duration"]) for row in rows]
+
+    # the strings of every row, column after column
+    values = [row[column].encode("utf-8") for row in rows for column in columns]
+    lengths = np.array([len(value) for value in values], dtype=np.int64)
+    offsets = np.cumsum(lengths) - lengths
+    spans = np.stack((offsets, lengths), axis=-1)
+    spans = spans.reshape(len(rows), len(columns), 2)
+    for i, column in enumerate(columns):
+        index[column] = spans[:, i]
+
+    folder = os.path.dirname(os.path.abspath(prefix))
+    os.makedirs(folder, exist_ok=True)
+    # an old index must not be read with the new strings
+    if os.path.isfile(prefix + "_index.npy"):
+        os.remove(prefix + "_index.npy")
+    with open(prefix + "_strings.bin", "wb") as fout:
+        fout.write(b"".join(values))
+    # the index is written last, it marks the manifest as complete
+    np.save(prefix + "_index.npy", index)
+    logger.info("Binary manifest %s: %d utterances", prefix, len(rows))
+
+
+class BinaryManifest(Mapping):
+    """
+    Read-only mapping from utterance IDs to data points, backed by a binary
+    manifest. It can be passed as the data of a DynamicItemDataset.
+
+    Arguments
+    ---------
+    prefix : str
+        Path prefix of the binary manifest.
+    replacements : dict
+        Replacements of '$key' by value in the string columns, as in
+        DynamicItemDataset.from_csv.
+
+    Example
+    -------
+    >>> csv_file = getfixture("tmpdir") / "dev.csv"
+    >>> _ = csv_file.write("ID,duration,wav,spk_id,wrd\\n"
+    ...     "utt2,2.0,$data_root/b.flac,1,A BC\\n"
+    ...     "utt1,1.5,$data_root/a.flac,1,HELLO WORLD\\n")
+    >>> write_binary_manifest(str(csv_file))
+    >>> data = BinaryManifest(str(csv_file)[:-4], {"data_root": "/data"})
+    >>> list(data), data["utt1"]["wav"], data["utt1"]["duration"]
+    (['utt1', 'utt2'], '/data/a.flac', 1.5)
+    """
+
+    def __init__(self, prefix, replacements=None):
+        # plain views of the maps: slicing np.memmap objects is much slower
+        self.index = np.asarray(np.load(prefix + "_index.npy", mmap_mode="r"))
+        self.strings = b""
+        if os.path.getsize(prefix + "_strings.bin"):
+            self.strings = memoryview(
+                np.memmap(prefix + "_strings.bin", dtype=np.uint8, mode="r")
+            )
+        self.ids = self.index["ID"]
+        self.columns = self.index.dtype.names[2:]
+        self.replacements = [
+            ("$" + key, str(value))
+            for key, value in (replacements or {}).items()
+        ]
+        # columns added after loading, e.g. token counts
+        self.extra = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        for utt_id in self.ids:
+            yield utt_id.decode("utf-8")
+
+    def __contains__(self, utt_id):
+        try:
+            self._row(utt_id)
+        except KeyError:
+            return False
+        return True
+
+    def _row(self, utt_id):
+        key = utt_id.encode("utf-8")
+        row = int(np.searchsorted(self.ids, key))
+        if row == len(self.ids) or self.ids[row] != key:
+            raise KeyError(utt_id)
+        return row
+
+    def __getitem__(self, utt_id):
+        row = self._row(utt_id)
+        _, duration, *spans = self.index[row].tolist()
+        data_point = {"duration": duration}
+        for column, (start, length) in zip(self.columns, spans):
+            value = bytes(self.strings[start : start + length]).decode("utf-8")
+            for key, replacement in self.replacements:
+                value = value.replace(key, replacement)
+            data_point[column] = value
+        for column, values in self.extra.items():
+            data_point[column] = values[row]
+        return data_point
+
+    def durations(self):
+        """Duration of every utterance, in the order of the IDs."""
+        return self.index["duration"]
+
+    def add_column(self, name, values):
+        """
+        Adds a column to the data points.
+
+        Arguments
+        ---------
+        name : str
+            Name of the column, e.g. 'n_tokens'.
+        values : dict
+            Value of every utterance, by utterance ID.
+        """
+        column = [None] * len(self)
+        for utt_id, value in values.items():
+            if utt_id in self:
+                column[self._row(utt_id)] = value
+        self.extra[name] = column
+
+
+class BinaryManifestDataset(sb.dataio.dataset.DynamicItemDataset):
+    """
+    DynamicItemDataset over a BinaryManifest, sorting by duration without
+    decoding the data points.
+
+    Arguments
+    ---------
+    data : BinaryManifest
+        The manifest.
+    dynamic_items : list
+        Configuration of the dynamic items, as in DynamicItemDataset.
+    output_keys : dict, list
+        Output keys, as in DynamicItemDataset.
+    """
+
+    def _filtered_sorted_ids(
+        self,
+        key_min_value={},
+        key_max_value={},
+        key_test={},
+        sort_key=None,
+        reverse=False,
+        select_n=None,
+    ):
+        if (
+            sort_key != "duration"
+            or key_min_value
+            or key_max_value
+            or key_test
+            or select_n is not None
+        ):
+            return super()._filtered_sorted_ids(
+                key_min_value,
+                key_max_value,
+                key_test,
+                sort_key,
+                reverse,
+                select_n,
+            )
+        # same order as sorting (duration, position) tuples
+        durations = self.data.durations()
+        order = np.lexsort((np.arange(len(durations)), durations))
+        if reverse:
+            order = order[::-1]
+        return [self.data_ids[i] for i in order]
+
+
+def load_manifest(csv_file, replacements=None, binary=False):
+    """
+    Loads a manifest as a DynamicItemDataset, from its binary manifest if
+    binary is True (written next to csv_file by the data preparation).
+
+    Arguments
+    ---------
+    csv_file : str
+        Manifest written by the data preparation.
+    replacements : dict
+        Replacements of '$key' by value in the string columns.
+    binary : bool
+        Whether to read the binary manifest.
+
+    Returns
+    -------
+    speechbrain.dataio.dataset.DynamicItemDataset
+        The dataset.
+    """
+    if not binary:
+        return sb.dataio.dataset.DynamicItemDataset.from_csv(
+            csv_path=csv_file, replacements=replacements
+        )
+    prefix = os.path.splitext(csv_file)[0]
+    if not binary_manifest_exists(prefix):
+        raise ValueError("Unexpected missing binary manifest {}".format(prefix))
+    return BinaryManifestDataset(BinaryManifest(prefix, replacements))
@@ -14,8 +14,12 @@ Author
 
 import csv
 import functools
+import io
+import json
 import os
 import random
+import tarfile
+import zlib
 from collections import Counter
 from dataclasses import dataclass
 
@@ -29,6 +33,8 @@ from speechbrain.utils.data_utils import download_file, get_all_files
 from speechbrain.utils.logger import get_logger
 from speechbrain.utils.parallel import parallel_map
 
+from binary_manifest import binary_manifest_exists, write_binary_manifest
+
 logger = get_logger(__name__)
 OPT_FILE = "opt_librispeech_prepare.pkl"
 SAMPLERATE = 16000
@@ -52,6 +58,7 @@ def prepare_librispeech(
     merge_name=None,
     create_lexicon=False,
     skip_prep=False,
+    binary_manifest=False,
 ):
     """
     This class prepares the csv files for the LibriSpeech dataset.
@@ -83,6 +90,9 @@ def prepare_librispeech(
         to phonemes. Use it for training a G2P system.
     skip_prep: bool
         If True, data preparation is skipped.
+    binary_manifest: bool
+        If True, every csv file is also written as a memory-mapped binary
+        manifest (see binary_manifest.py), next to it.
 
     Returns
     -------
@@ -115,8 +125,15 @@ def prepare_librispeech(
 
     save_opt = os.path.join(save_folder, OPT_FILE)
 
+    # Binary manifests expected next to the csv files
+    binary_manifests = []
+    if binary_manifest:
+        binary_manifests = list(splits)
+        if merge_lst and merge_name is not None:
+            binary_manifests.append(os.path.splitext(merge_name)[0])
+
     # Check if this phase is already done (if so, skip it)
-    if skip(splits, save_folder, conf):
+    if skip(splits, save_folder, conf, binary_manifests):
         logger.info("Skipping preparation, completed in previous run.")
         return
     else:
@@ -155,6 +172,11 @@ def prepare_librispeech(
             data_folder=save_folder, csv_lst=merge_files, merged_csv=merge_name
         )
 
+    # Write the binary manifests, again as the csv files may have changed
+    for name in binary_manifests:
+        prefix = os.path.join(save_folder, name)
+        write_binary_manifest(prefix + ".csv", prefix)
+
     # Create lexicon.csv and oov.csv
     if create_lexicon:
         create_lexicon_and_oov_csv(all_texts, save_folder)
@@ -377,7 +399,117 @@ def create_csv(save_folder, wav_lst, text_dict, split, select_n_sentences):
     logger.info(msg)
 
 
-def skip(splits, save_folder, conf):
+def export_tar_shards(
+    csv_file,
+    shard_folder,
+    samples_per_shard=1000,
+    tokenizer=None,
+    replacements=None,
+    seed=1234,
+):
+    """
+    Exports a csv file as shuffled tar shards of samples_per_shard
+    utterances (WebDataset layout), to stream the data from a network
+    filesystem. Every utterance is stored as three members named after its
+    ID: the audio file ('.flac'), the transcript ('.txt') and a '.json'
+    holding the duration, the speaker and, if a tokenizer is given, the
+    token ids. The shards are listed in an index file written last,
+    shard_folder/<csv name>.json, with a checksum of the csv file, the
+    tokenizer and the layout. Nothing is done if the index exists with the
+    same checksum; otherwise the shards are exported again.
+
+    Arguments
+    ---------
+    csv_file : str
+        The csv file to export, e.g. train.csv.
+    shard_folder : str
+        The directory where to store the shards.
+    samples_per_shard : int
+        Number of utterances per shard (the last shard may hold fewer).
+    tokenizer : sentencepiece.SentencePieceProcessor
+        If given, the token ids of every transcript are stored.
+    replacements : dict
+        Replacements of '$key' by value in the audio paths.
+    seed : int
+        Seed of the shuffling of the utterances.
+    """
+    name = os.path.splitext(os.path.basename(csv_file))[0]
+    index_file = os.path.join(shard_folder, name + ".json")
+    checksum = _export_checksum(csv_file, tokenizer, samples_per_shard, seed)
+    if os.path.isfile(index_file):
+        with open(index_file, encoding="utf-8") as f:
+            index = json.load(f)
+        if index.get("checksum") == checksum:
+            logger.info("Tar shards %s exist, skipping", index_file)
+            return
+        logger.info("Tar shards %s are outdated, exporting", index_file)
+        # the index first, so that an interrupted export is not used
+        os.remove(index_file)
+        for shard in index["shards"]:
+            path = os.path.join(shard_folder, shard["path"])
+            if os.path.isfile(path):
+                os.remove(path)
+
+    with open(csv_file, newline="", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    random.Random(seed).shuffle(rows)
+
+    os.makedirs(shard_folder, exist_ok=True)
+    shards = []
+    for start in range(0, len(rows), samples_per_shard):
+        shard = "{}-{:06d}.tar".format(name, len(shards))
+        shard_rows = rows[start : start + samples_per_shard]
+        with tarfile.open(os.path.join(shard_folder, shard), "w") as tar:
+            for row in shard_rows:
+                wav = row["wav"]
+                for key, value in (replacements or {}).items():
+                    wav = wav.replace("$" + key, str(value))
+                meta = {
+                    "duration": float(row["duration"]),
+                    "spk_id": row["spk_id"],
+                }
+                if tokenizer is not None:
+                    meta["tokens"] = tokenizer.encode_as_ids(row["wrd"])
+                with open(wav, "rb") as f:
+                    audio = f.read()
+                extension = os.path.splitext(wav)[1]
+                _add_tar_member(tar, row["ID"] + extension, audio)
+                _add_tar_member(tar, row["ID"] + ".txt", row["wrd"].encode())
+                _add_tar_member(
+                    tar, row["ID"] + ".json", json.dumps(meta).encode()
+                )
+        shards.append({"path": shard, "samples": len(shard_rows)})
+
+    with open(index_file, "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "checksum": checksum,
+                "samples_per_shard": samples_per_shard,
+                "shards": shards,
+            },
+            f,
+        )
+    logger.info("%d tar shards written in %s" % (len(shards), shard_folder))
+
+
+def _export_checksum(csv_file, tokenizer, samples_per_shard, seed):
+    """CRC32 of the csv file, the serialized SentencePiece model (if any)
+    and the layout of the shards."""
+    with open(csv_file, "rb") as f:
+        checksum = zlib.crc32(f.read())
+    if tokenizer is not None:
+        checksum = zlib.crc32(tokenizer.serialized_model_proto(), checksum)
+    layout = "{}-{}".format(samples_per_shard, seed).encode()
+    return zlib.crc32(layout, checksum)
+
+
+def _add_tar_member(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+def skip(splits, save_folder, conf, binary_manifests=None):
     """
     Detect when the librispeech data prep can be skipped.
 
@@ -389,6 +521,8 @@ def skip(splits, save_folder, conf):
         The location of the save directory
     conf : dict
         The configuration options to ensure they haven't changed.
+    binary_manifests : list
+        Names of the binary manifests expected in the save directory.
 
     Returns
     -------
@@ -404,6 +538,10 @@ def skip(splits, save_folder, conf):
         if not os.path.isfile(os.path.join(save_folder, split + ".csv")):
             skip = False
 
+    for name in binary_manifests or []:
+        if not binary_manifest_exists(os.path.join(save_folder, name)):
+            skip = False
+
     #  Checking saved options
     save_opt = os.path.join(save_folder, OPT_FILE)
     if skip is True:
@@ -0,0 +1,204 @@
+"""
+Streaming dataset over the tar shards of librispeech_prepare.export_tar_shards.
+
+On a network filesystem, opening hundreds of thousands of small FLAC files
+per epoch is much slower than reading a few large files sequentially. The
+shards are read as streams: the order of the shards is shuffled at every
+epoch, every process (DDP) and dataloader worker reads its own subset of
+shards, and the utterances go through a bounded shuffle buffer.
+"""
+
+import io
+import json
+import os
+import random
+import tarfile
+
+import soundfile
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+
+class TarShardDataset(IterableDataset):
+    """
+    Iterates over the utterances of tar shards, as dicts with the keys 'id',
+    'sig', 'wrd', 'duration', 'spk_id' and, if exported, 'tokens'.
+
+    With DDP, every process reads the same number of shards (the remaining
+    shards, different at every epoch, are left out), and the short last
+    shard is completed with utterances of the process' first shards, so that
+    all the processes run the same number of steps.
+
+    Arguments
+    ---------
+    index_file : str
+        Index of the shards, written by export_tar_shards.
+    pipeline : callable
+        Maps every utterance dict to the dict returned by the dataset, e.g.
+        to compute the tokens of the recipe.
+    shuffle : bool
+        If True, the order of the shards and of the utterances is shuffled.
+    shuffle_buffer : int
+        Number of utterances in the shuffle buffer.
+    seed : int
+        Seed of the shuffling.
+    epoch_counter : speechbrain.utils.epoch_loop.EpochCounter
+        If given, its current epoch seeds the shuffling, so that every epoch
+        and worker sees a new order.
+
+    Example
+    -------
+    >>> import numpy as np
+    >>> from librispeech_prepare import export_tar_shards
+    >>> tmpdir = getfixture("tmpdir")
+    >>> lines = ["ID,duration,wav,spk_id,wrd"]
+    >>> for i in range(5):
+    ...     soundfile.write(str(tmpdir / "{}.flac".format(i)),
+    ...         np.zeros(160 * (i + 1)), 16000)
+    ...     lines.append("utt{0},0.01,$data_root/{0}.flac,1,WORD".format(i))
+    >>> _ = (tmpdir / "train.csv").write("\\n".join(lines) + "\\n")
+    >>> export_tar_shards(str(tmpdir / "train.csv"), str(tmpdir / "shards"),
+    ...     samples_per_shard=2, replacements={"data_root": str(tmpdir)})
+    >>> dataset = TarShardDataset(str(tmpdir / "shards" / "train.json"))
+    >>> len(dataset), sorted(len(x["sig"]) for x in dataset)
+    (5, [160, 320, 480, 640, 800])
+    """
+
+    def __init__(
+        self,
+        index_file,
+        pipeline=None,
+        shuffle=True,
+        shuffle_buffer=1000,
+        seed=42,
+        epoch_counter=None,
+    ):
+        super().__init__()
+        with open(index_file, encoding="utf-8") as fin:
+            index = json.load(fin)
+        folder = os.path.dirname(os.path.abspath(index_file))
+        self.shards = [
+            (os.path.join(folder, shard["path"]), shard["samples"])
+            for shard in index["shards"]
+        ]
+        self.samples_per_shard = index["samples_per_shard"]
+        self.pipeline = pipeline
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch_counter = epoch_counter
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        """Sets the epoch of the shuffling, if there is no epoch_counter."""
+        self.epoch = epoch
+
+    def _world(self):
+        distributed = torch.distributed
+        if distributed.is_available() and distributed.is_initialized():
+            return distributed.get_rank(), distributed.get_world_size()
+        return 0, 1
+
+    def __len__(self):
+        """Number of utterances read by this process per epoch."""
+        _, world_size = self._world()
+        if world_size == 1:
+            return sum(samples for _, samples in self.shards)
+        shards_per_process = len(self.shards) // world_size
+        return shards_per_process * self.samples_per_shard
+
+    def _shards(self, epoch):
+        """Shards of the process and worker, and utterances to read."""
+        shards = list(self.shards)
+        if self.shuffle:
+            random.Random(self.seed + epoch).shuffle(shards)
+
+        rank, world_size = self._world()
+        if world_size > 1:
+            shards_per_process = len(shards) // world_size
+            start = rank * shards_per_process
+            shards = shards[start : start + shards_per_process]
+
+        worker = get_worker_info()
+        if worker is not None:
+            shards = shards[worker.id :: worker.num_workers]
+        if world_size == 1:
+            return shards, sum(samples for _, samples in shards)
+        return shards, len(shards) * self.samples_per_shard
+
+    def _read(self, shards, num_samples):
+        """Utterances of the shards, cycling until num_samples are read."""
+        count = 0
+        while shards and count < num_samples:
+            for path, _ in shards:
+                for sample in _read_shard(path):
+                    if count == num_samples:
+                        return
+                    yield sample
+                    count += 1
+
+    def __iter__(self):
+        epoch = self.epoch
+        if self.epoch_counter is not None:
+            epoch = self.epoch_counter.current
+        worker = get_worker_info()
+        worker_id = 0 if worker is None else worker.id
+        rank, _ = self._world()
+        # a buffer order of its own for every epoch, process and worker
+        rng = random.Random(
+            "{}-{}-{}-{}".format(self.seed, epoch, rank, worker_id)
+        )
+
+        shards, num_samples = self._shards(epoch)
+        samples = self._read(shards, num_samples)
+        if self.shuffle and self.shuffle_buffer > 1:
+            samples = _shuffled(samples, self.shuffle_buffer, rng)
+        for sample in samples:
+            if self.pipeline is not None:
+                sample = self.pipeline(sample)
+            yield sample
+
+
+def _read_shard(path):
+    """Groups the consecutive members of a tar shard by utterance ID."""
+    sample = {}
+    with tarfile.open(path, "r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            utt_id, extension = member.name.split(".", 1)
+            if sample and sample["id"] != utt_id:
+                yield _decode(sample)
+                sample = {}
+            sample["id"] = utt_id
+            sample[extension] = tar.extractfile(member).read()
+    if sample:
+        yield _decode(sample)
+
+
+def _decode(sample):
+    meta = json.loads(sample.pop("json"))
+    utt = {
+        "id": sample.pop("id"),
+        "wrd": sample.pop("txt").decode("utf-8"),
+    }
+    # the remaining member is the audio
+    (audio,) = sample.values()
+    sig, _ = soundfile.read(io.BytesIO(audio), dtype="float32")
+    utt["sig"] = torch.from_numpy(sig)
+    utt.update(meta)
+    return utt
+
+
+def _shuffled(samples, buffer_size, rng):
+    """Shuffles a stream through a buffer of buffer_size items."""
+    buffer = []
+    for sample in samples:
+        if len(buffer) < buffer_size:
+            buffer.append(sample)
+            continue
+        i = rng.randrange(buffer_size)
+        yield buffer[i]
+        buffer[i] = sample
+    rng.shuffle(buffer)
+    yield from buffer
@@ -42,9 +42,14 @@ import torch
 from hyperpyyaml import load_hyperpyyaml
 
 import speechbrain as sb
+from speechbrain.dataio.batch import PaddedBatch
 from speechbrain.utils.distributed import if_main_process, run_on_main
 from speechbrain.utils.logger import get_logger
 
+from binary_manifest import load_manifest
+from profiler import NO_PROFILER
+from tar_shards import TarShardDataset
+
 logger = get_logger(__name__)
 
 
@@ -52,14 +57,19 @@ logger = get_logger(__name__)
 class ASR(sb.core.Brain):
     def compute_forward(self, batch, stage):
         """Forward computations from the waveform batches to the output probabilities."""
+        profiler = self.step_profiler
         batch = batch.to(self.device)
         wavs, wav_lens = batch.sig
-        tokens_bos, _ = batch.tokens_bos
+        tokens_bos, tokens_bos_lens = batch.tokens_bos
 
         # compute features
-        feats = self.hparams.compute_features(wavs)
+        with profiler.stage("features"):
+            feats = self.hparams.compute_features(wavs)
         current_epoch = self.hparams.epoch_counter.current
-        feats = self.modules.normalize(feats, wav_lens, epoch=current_epoch)
+        with profiler.stage("normalize"):
+            feats = self.modules.normalize(
+                feats, wav_lens, epoch=current_epoch
+            )
 
         # Add feature augmentation if specified.
         augment_warmup = 0
@@ -67,25 +77,37 @@ class ASR(sb.core.Brain):
             augment_warmup = self.hparams.augment_warmup
         if stage == sb.Stage.TRAIN and hasattr(self.hparams, "fea_augment"):
             if self.optimizer_step > augment_warmup:
-                feats, fea_lens = self.hparams.fea_augment(feats, wav_lens)
-                tokens_bos = self.hparams.fea_augment.replicate_labels(
-                    tokens_bos
-                )
+                with profiler.stage("fea_augment"):
+                    feats, fea_lens = self.hparams.fea_augment(feats, wav_lens)
+                    tokens_bos = self.hparams.fea_augment.replicate_labels(
+                        tokens_bos
+                    )
 
         # forward modules
-        src = self.modules.CNN(feats)
-
-        enc_out, pred = self.modules.Transformer(
-            src, tokens_bos, wav_lens, pad_idx=self.hparams.pad_index
-        )
+        with profiler.stage("cnn"):
+            src = self.modules.CNN(feats)
 
-        # output layer for ctc log-probabilities
-        logits = self.modules.ctc_lin(enc_out)
-        p_ctc = self.hparams.log_softmax(logits)
+        with profiler.stage("transformer"):
+            enc_out, pred = self.modules.Transformer(
+                src, tokens_bos, wav_lens, pad_idx=self.hparams.pad_index
+            )
 
-        # output layer for seq2seq log-probabilities
-        pred = self.modules.seq_lin(pred)
-        p_seq = self.hparams.log_softmax(pred)
+        with profiler.stage("heads"):
+            # output layer for ctc log-probabilities
+            logits = self.modules.ctc_lin(enc_out)
+            p_ctc = self.hparams.log_softmax(logits)
+
+            # output layer for seq2seq log-probabilities
+            pred = self.modules.seq_lin(pred)
+            p_seq = self.hparams.log_softmax(pred)
+        profiler.record(
+            B=enc_out.shape[0],
+            T=enc_out.shape[1],
+            U=tokens_bos.shape[1],
+            V=pred.shape[-1],
+            wav_padding=1 - wav_lens.mean(),
+            token_padding=1 - tokens_bos_lens.mean(),
+        )
 
         # Compute outputs
         hyps = None
@@ -101,14 +123,15 @@ class ASR(sb.core.Brain):
             # limited capacity and no LM to give user some idea of how the AM is doing
 
             # Decide searcher for inference: valid or test search
-            if stage == sb.Stage.VALID:
-                hyps, _, _, _ = self.hparams.valid_search(
-                    enc_out.detach(), wav_lens
-                )
-            else:
-                hyps, _, _, _ = self.hparams.test_search(
-                    enc_out.detach(), wav_lens
-                )
+            with profiler.stage("search"):
+                if stage == sb.Stage.VALID:
+                    hyps, _, _, _ = self.hparams.valid_search(
+                        enc_out.detach(), wav_lens
+                    )
+                else:
+                    hyps, _, _, _ = self.hparams.test_search(
+                        enc_out.detach(), wav_lens
+                    )
 
         return p_ctc, p_seq, wav_lens, hyps
 
@@ -116,6 +139,7 @@ class ASR(sb.core.Brain):
         """Computes the loss (CTC+NLL) given predictions and targets."""
 
         (p_ctc, p_seq, wav_lens, hyps) = predictions
+        profiler = self.step_profiler
 
         ids = batch.id
         tokens_eos, tokens_eos_lens = batch.tokens_eos
@@ -140,13 +164,15 @@ class ASR(sb.core.Brain):
                     tokens, tokens_lens, tokens_eos, tokens_eos_lens
                 )
 
-        loss_seq = self.hparams.seq_cost(
-            p_seq, tokens_eos, length=tokens_eos_lens
-        ).sum()
+        with profiler.stage("seq_loss"):
+            loss_seq = self.hparams.seq_cost(
+                p_seq, tokens_eos, length=tokens_eos_lens
+            ).sum()
 
-        loss_ctc = self.hparams.ctc_cost(
-            p_ctc, tokens, wav_lens, tokens_lens
-        ).sum()
+        with profiler.stage("ctc_loss"):
+            loss_ctc = self.hparams.ctc_cost(
+                p_ctc, tokens, wav_lens, tokens_lens
+            ).sum()
 
         loss = (
             self.hparams.ctc_weight * loss_ctc
@@ -159,17 +185,26 @@ class ASR(sb.core.Brain):
             if current_epoch % valid_search_interval == 0 or (
                 stage == sb.Stage.TEST
             ):
-                # Decode token terms to words
-                predicted_words = [
-                    tokenizer.decode_ids(utt_seq).split(" ") for utt_seq in hyps
-                ]
-                target_words = [wrd.split(" ") for wrd in batch.wrd]
-                self.wer_metric.append(ids, predicted_words, target_words)
+                with profiler.stage("wer"):
+                    # Decode token terms to words
+                    predicted_words = [
+                        tokenizer.decode_ids(utt_seq).split(" ")
+                        for utt_seq in hyps
+                    ]
+                    target_words = [wrd.split(" ") for wrd in batch.wrd]
+                    self.wer_metric.append(ids, predicted_words, target_words)
 
             # compute the accuracy of the one-step-forward prediction
             self.acc_metric.append(p_seq, tokens_eos, tokens_eos_lens)
+
+        profiler.step(stage)
         return loss
 
+    @property
+    def step_profiler(self):
+        """Opt-in profiler of the stages of a step, a no-op by default."""
+        return getattr(self.hparams, "step_profiler", NO_PROFILER)
+
     def on_evaluate_start(self, max_key=None, min_key=None):
         """perform checkpoint average if needed"""
         super().on_evaluate_start()
@@ -193,6 +228,8 @@ class ASR(sb.core.Brain):
 
     def on_stage_end(self, stage, stage_loss, epoch):
         """Gets called at the end of a epoch."""
+        self.step_profiler.summary()
+
         # Compute/store important stats
         stage_stats = {"loss": stage_loss}
         if stage == sb.Stage.TRAIN:
@@ -262,9 +299,10 @@ def dataio_prepare(hparams):
     """
     data_folder = hparams["data_folder"]
 
-    train_data = sb.dataio.dataset.DynamicItemDataset.from_csv(
-        csv_path=hparams["train_csv"],
-        replacements={"data_root": data_folder},
+    binary = hparams.get("binary_manifest", False)
+
+    train_data = load_manifest(
+        hparams["train_csv"], {"data_root": data_folder}, binary
     )
 
     if hparams["sorting"] == "ascending":
@@ -287,9 +325,8 @@ def dataio_prepare(hparams):
         raise NotImplementedError(
             "sorting must be random, ascending or descending"
         )
-    valid_data = sb.dataio.dataset.DynamicItemDataset.from_csv(
-        csv_path=hparams["valid_csv"],
-        replacements={"data_root": data_folder},
+    valid_data = load_manifest(
+        hparams["valid_csv"], {"data_root": data_folder}, binary
     )
     valid_data = valid_data.filtered_sorted(sort_key="duration")
 
@@ -297,8 +334,8 @@ def dataio_prepare(hparams):
     test_datasets = {}
     for csv_file in hparams["test_csv"]:
         name = Path(csv_file).stem
-        test_datasets[name] = sb.dataio.dataset.DynamicItemDataset.from_csv(
-            csv_path=csv_file, replacements={"data_root": data_folder}
+        test_datasets[name] = load_manifest(
+            csv_file, {"data_root": data_folder}, binary
         )
         test_datasets[name] = test_datasets[name].filtered_sorted(
             sort_key="duration"
@@ -379,6 +416,58 @@ def dataio_prepare(hparams):
             **dynamic_hparams_valid,
         )
 
+    # 6. Streaming of the training set from tar shards (e.g. on a network
+    # filesystem), in batches of batch_size utterances.
+    if hparams.get("tar_shard_folder"):
+        from librispeech_prepare import export_tar_shards  # noqa
+
+        run_on_main(
+            export_tar_shards,
+            args=[hparams["train_csv"], hparams["tar_shard_folder"]],
+            kwargs={
+                "samples_per_shard": hparams["tar_samples_per_shard"],
+                "tokenizer": tokenizer,
+                "replacements": {"data_root": data_folder},
+            },
+        )
+
+        def tar_pipeline(utt):
+            """Outputs of the pipelines above, for an utterance of a shard."""
+            sig = utt["sig"]
+            if "speed_perturb" in hparams:
+                sig = hparams["speed_perturb"](sig.unsqueeze(0)).squeeze(0)
+            if "tokens" in utt:
+                tokens_list = utt["tokens"]
+            else:
+                tokens_list = tokenizer.encode_as_ids(utt["wrd"])
+            return {
+                "id": utt["id"],
+                "sig": sig,
+                "wrd": utt["wrd"],
+                "tokens_bos": torch.LongTensor(
+                    [hparams["bos_index"]] + tokens_list
+                ),
+                "tokens_eos": torch.LongTensor(
+                    tokens_list + [hparams["eos_index"]]
+                ),
+                "tokens": torch.LongTensor(tokens_list),
+            }
+
+        name = Path(hparams["train_csv"]).stem
+        index_file = os.path.join(hparams["tar_shard_folder"], name + ".json")
+        train_data = TarShardDataset(
+            index_file,
+            pipeline=tar_pipeline,
+            shuffle=hparams["sorting"] == "random",
+            shuffle_buffer=hparams["tar_shuffle_buffer"],
+            epoch_counter=hparams["epoch_counter"],
+        )
+        train_batch_sampler = None
+        # the dataset shuffles by itself, through its shuffle buffer
+        hparams["train_dataloader_opts"].pop("shuffle", None)
+        hparams["train_dataloader_opts"].pop("sampler", None)
+        hparams["train_dataloader_opts"]["collate_fn"] = PaddedBatch
+
     return (
         train_data,
         valid_data,
@@ -420,9 +509,16 @@ if __name__ == "__main__":
             "merge_lst": hparams["train_splits"],
             "merge_name": "train.csv",
             "skip_prep": hparams["skip_prep"],
+            "binary_manifest": hparams.get("binary_manifest", False),
         },
     )
 
+    # We download the pretrained LM from HuggingFace (or elsewhere depending on
+    # the path given in the YAML file). The tokenizer is loaded at the same
+    # time, before the tar shards of the training set are built with it.
+    hparams["pretrainer"].collect_files()
+    hparams["pretrainer"].load_collected()
+
     # here we create the datasets objects as well as tokenization and encoding
     (
         train_data,
@@ -433,11 +529,6 @@ if __name__ == "__main__":
         valid_bsampler,
     ) = dataio_prepare(hparams)
 
-    # We download the pretrained LM from HuggingFace (or elsewhere depending on
-    # the path given in the YAML file). The tokenizer is loaded at the same time.
-    hparams["pretrainer"].collect_files()
-    hparams["pretrainer"].load_collected()
-
     # Trainer initialization
     asr_brain = ASR(
         modules=hparams["modules"],